@@ -11,9 +11,11 @@ from pathlib import Path
 from transformers import BertTokenizer, AutoTokenizer, RobertaTokenizer
 import datautils as utils
 from datautils import NerExample, Any2Id
-import time, copy
+import time, os, json, shutil, itertools
+from collections import OrderedDict
 import ipdb
 from types import MethodType
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     from prefetch_generator import BackgroundGenerator  # prefetch-generator
@@ -73,6 +75,46 @@ def get_char_tokenize_fn(tokenizer):
 # if index is None:
 #     return self.unk_token_id
 
+def bert_tokenize_char_lst_lst(tokenizer, char_lst_lst):
+    """ 批量bert tokenize已分词的样本 返回[(tok_char_lst, word_ids)] 结果同NerExample.update_to_bert_tokenize
+        slow tokenizer没有word_ids 逐词tokenize
+    """
+    if tokenizer.is_fast:
+        tokenized_inputs = tokenizer(char_lst_lst, is_split_into_words=True, add_special_tokens=False)  # 去掉[CLS]和[SEP]
+        return [(tokenizer.convert_ids_to_tokens(ids), tokenized_inputs.word_ids(k))
+                for k, ids in enumerate(tokenized_inputs['input_ids'])]
+    ret = []
+    for char_lst in char_lst_lst:
+        tok_char_lst, word_ids = [], []
+        for word_id, word in enumerate(char_lst):
+            sub_tokens = tokenizer.tokenize(word)
+            tok_char_lst.extend(sub_tokens)
+            word_ids.extend([word_id] * len(sub_tokens))
+        ret.append((tok_char_lst, word_ids))
+    return ret
+
+
+_pool_tokenizer = None
+
+
+def _init_pool_tokenizer(tokenizer):
+    global _pool_tokenizer
+    _pool_tokenizer = tokenizer
+
+
+def _pool_tokenize(char_lst_lst):
+    return bert_tokenize_char_lst_lst(_pool_tokenizer, char_lst_lst)
+
+
+def subword_gather_index(strip_len, ori_2_tok):
+    """
+    去掉bert输出的[CLS]和第strip_len+1个位置([SEP]) 再按ori_2_tok取每个词的首个子词, 合并为原bert输出上一次gather的下标
+    cat([t[1: 1 + s], t[2 + s:]])[v] == t[v + 1 + (v >= s)]
+    strip_len: [b]  ori_2_tok: [b,l']  支持np.ndarray和torch.Tensor
+    """
+    return ori_2_tok + 1 + (ori_2_tok >= strip_len[:, None])
+
+
 class NerDataReader:
     def __init__(self, tokenizer_path, max_len, ent_file_or_ent_lst, loss_type=None, args=None):
         self.tokenizer_path = tokenizer_path
@@ -118,7 +160,7 @@ class NerDataReader:
         self.args.pretrain_mode = 'fine_tuning'
         self.args.use_refine_mask = False
 
-    def post_process(self, exm: NerExample, lang='ENG', train=True, arch='seq', loss_type='sigmoid'):
+    def post_process(self, exm: NerExample, lang='ENG', train=True, arch='seq', loss_type='sigmoid', max_span_width=None, distilled_logits=None):
         """
         对NerExample对象进行后处理。
 
@@ -128,6 +170,8 @@ class NerDataReader:
             train (bool, optional): 是否用于训练，默认为True。
             arch (str, optional): 架构类型，默认为'seq'。
             loss_type (str, optional): 损失类型，默认为'sigmoid'。
+            max_span_width (int, optional): span最大宽度, None为全部上三角span, 否则为带状布局(见NerExample.span_index)。
+            distilled_logits (np.ndarray, optional): TeacherLogitStore中该样本的teacher logits, span为[num_spans, 截至上一任务的ent], seq为[ori_len, 截至上一任务的tag]。
 
         Returns:
             dict: 包含处理后的NerExample对象和其他信息的字典。
@@ -136,7 +180,10 @@ class NerDataReader:
         if not hasattr(exm, 'train_cache'):
             # 如果语言是英文，使用BERT分词器对字符列表进行编码
             if lang == 'ENG':
-                input_ids = self.tokenizer.convert_tokens_to_ids(exm.bert_tok_char_lst)
+                if hasattr(exm, 'bert_tok_ids'):  # 来自预编译的MmapExmList 已经是id
+                    input_ids = exm.bert_tok_ids.tolist()
+                else:
+                    input_ids = self.tokenizer.convert_tokens_to_ids(exm.bert_tok_char_lst)
             # 如果语言是中文，对每个字符进行分词
             elif lang == 'ZH':
                 input_ids = self.tokenizer.convert_tokens_to_ids(self.char_tokenize_fn(exm.char_lst))
@@ -162,21 +209,16 @@ class NerDataReader:
                 elif arch == 'span':
                     # 检查损失类型是否为'sigmoid'或'softmax'
                     assert loss_type in ['sigmoid', 'softmax']
-                    # 获取实体的数量
-                    ent_size = len(self.ent2id)
-                    # 获取跨度级别的NER目标列表
-                    span_ner_tgt_lst = exm.get_span_level_ner_tgt_lst(neg_symbol='O')
                     # 如果损失类型是'sigmoid'
                     if loss_type == 'sigmoid':
-                        # 使用one-hot编码
-                        span_tgt_onehot = np.zeros([len(span_ner_tgt_lst), ent_size], dtype='float32')  # [num_spans, ent]
-                        for i, tag in enumerate(span_ner_tgt_lst):
-                            if tag != 'O' and tag in self.ent2id:
-                                span_tgt_onehot[i][self.ent2id[tag]] = 1.
-                        # 更新跨度目标
-                        exm.train_cache.update(span_tgt=span_tgt_onehot)
+                        # 只缓存正例的(span下标, ent_id) 在batcher中再还原为one-hot [num_spans, ent]
+                        length = len(exm.char_lst)
+                        exm.train_cache.update(span_tgt_pos=exm.get_span_level_ner_tgt_pos(self.ent2id, max_span_width),
+                                               num_spans=NerExample.num_spans(length, max_span_width))
                     # 如果损失类型是'softmax'
                     elif loss_type == 'softmax':
+                        # 获取跨度级别的NER目标列表
+                        span_ner_tgt_lst = exm.get_span_level_ner_tgt_lst(neg_symbol='O', max_width=max_span_width)
                         # 将跨度级别的NER目标列表转换为实体ID列表
                         span_tgt = [self.ent2id[e] for e in span_ner_tgt_lst]
                         # 更新跨度目标
@@ -185,11 +227,8 @@ class NerDataReader:
                     raise NotImplementedError
 
         # other setting
-        if hasattr(exm, 'distilled_span_ner_pred_lst'):
-            num_spans, so_far_ent_size = exm.distilled_span_ner_pred_lst.shape
-            distilled_span_ner_tgt_lst = copy.deepcopy(exm.train_cache['span_tgt'])  # [num_spans, ent]
-            distilled_span_ner_tgt_lst[:, :so_far_ent_size] = exm.distilled_span_ner_pred_lst
-            exm.train_cache['distilled_span_tgt'] = distilled_span_ner_tgt_lst
+        if hasattr(exm, 'distilled_span_ner_pred_lst'):  # 只保存teacher logits 不与span_tgt拼成稠密矩阵 由模型按列范围分别取用
+            exm.train_cache['distilled_span_logits'] = exm.distilled_span_ner_pred_lst
             delattr(exm, 'distilled_span_ner_pred_lst')
 
         if hasattr(exm, 'distilled_task_ent_output'):
@@ -198,9 +237,13 @@ class NerDataReader:
             if 'distilled_task_ent_output' in exm.train_cache:
                 exm.train_cache.pop('distilled_task_ent_output')
         # ipdb.set_trace()
-        return dict(ner_exm=exm, **exm.train_cache)
+        item = dict(ner_exm=exm, **exm.train_cache)
+        if distilled_logits is not None:  # 来自TeacherLogitStore 不缓存在样本上
+            item['distilled_span_logits' if arch == 'span' else 'distilled_task_ent_output'] = distilled_logits
+        return item
 
-    def get_batcher_fn(self, gpu=False, device=None, arch='span'):
+    def get_batcher_fn(self, arch='span'):
+        """collate_fn只产生CPU tensor, 可在DataLoader的worker中运行, 由ner_loader.DevicePrefetcher搬到GPU"""
 
         def tensorize(array, dtype='int'):
             """
@@ -231,16 +274,12 @@ class NerDataReader:
                     ret = torch.DoubleTensor(array)
                 else:
                     raise NotImplementedError
-            if gpu:
-                if device is not None:
-                    ret = ret.to(device)
-                else:
-                    ret = ret.cuda()
             return ret
 
         def span_batcher(batch_e):
             """
             对批量的数据进行处理，生成模型需要的输入。
+            预分配np.int64数组后按切片填充 再torch.from_numpy 避免list拼接padding和从list构建tensor。
 
             Args:
                 batch_e (list): 包含多个字典的列表，每个字典对应一个样本的信息。
@@ -248,23 +287,26 @@ class NerDataReader:
             Returns:
                 dict: 包含处理后的批量数据的字典。
             """
+            bsz = len(batch_e)
             # 获取批量数据中最长的序列长度
             max_len = max(e['len'] for e in batch_e)
 
-            # 初始化各种需要的列表
-            batch_input_ids = []
-            batch_bert_token_type_ids = []
-            batch_bert_attention_mask = []
-            batch_seq_len = []
+            # 预分配 pad位置直接是初值
+            batch_input_ids = np.full([bsz, max_len], self.pad_id, dtype=np.int64)
+            batch_bert_token_type_ids = np.zeros([bsz, max_len], dtype=np.int64)
+            batch_bert_attention_mask = np.zeros([bsz, max_len], dtype=np.int64)
+            batch_seq_len = np.zeros([bsz], dtype=np.int64)
             batch_span_tgt_lst = []
             batch_ner_exm = []
-
-            batch_ori_seq_len = []
-            batch_ori_2_tok = []
+            batch_exm_idx = []
 
             # 如果样本中包含原始长度信息
             if 'ori_len' in batch_e[0]:
                 ori_max_len = max(e['ori_len'] for e in batch_e)
+                batch_ori_seq_len = np.zeros([bsz], dtype=np.int64)
+                batch_ori_2_tok = np.zeros([bsz, ori_max_len], dtype=np.int64)
+            else:
+                batch_ori_2_tok = np.zeros([0], dtype=np.int64)
 
             # 如果使用refine_mask
             if self.args.use_refine_mask:
@@ -274,48 +316,76 @@ class NerDataReader:
             if self.args.pretrain_mode == 'feature_based':
                 batch_input_pts = []
 
-            batch_span_tgt_lst_distilled = []
+            # 稀疏标签 (span下标, ent_id) 加上该样本在batch中的span偏移后一起还原为one-hot
+            batch_num_spans = []
+            batch_span_tgt_pos = []
+            span_offset = 0  # 前面样本的span总数
+            batch_num_spans_distilled = []
 
             # 对批量数据中的每个样本进行处理
             for bdx, e in enumerate(batch_e):
-                batch_seq_len.append(e['len'] - 2)  # -2 for [CLS] and [SEP]
-                batch_input_ids.append(e['input_ids'] + [self.pad_id] * (max_len - e['len'])) # pad
-                batch_bert_token_type_ids.append([0] * max_len)
-                batch_bert_attention_mask.append([1] * e['len'] + [0] * (max_len - e['len']))
+                batch_seq_len[bdx] = e['len'] - 2  # -2 for [CLS] and [SEP]
+                batch_input_ids[bdx, :e['len']] = e['input_ids']
+                batch_bert_attention_mask[bdx, :e['len']] = 1
                 batch_ner_exm.append(e['ner_exm'])
+                batch_exm_idx.append(e.get('exm_idx', -1))
 
                 if 'ori_len' in batch_e[0]:
-                    batch_ori_seq_len.append(e['ori_len'])
-                    batch_ori_2_tok.append(e['ori_2_tok'] + [0] * (ori_max_len - e['ori_len'])) # pad
+                    batch_ori_seq_len[bdx] = e['ori_len']
+                    batch_ori_2_tok[bdx, :e['ori_len']] = e['ori_2_tok']
 
                 if self.args.pretrain_mode == 'feature_based': # feature-based pt
-                    if hasattr(e['ner_exm'], 'pt'):
+                    if 'input_pts' in e:  # LazyDataset从FeatureStore按需读取的切片
+                        assert e['input_pts'].shape[0] == e.get('ori_len', e['len'] - 2)
+                        batch_input_pts.append(e['input_pts'])
+                    elif hasattr(e['ner_exm'], 'pt'):
                         assert e['ner_exm'].pt.shape[0] == e['ori_len']
                         batch_input_pts.append(e['ner_exm'].pt)
 
-                if 'span_tgt' in e: 
-                    batch_span_tgt_lst.append(tensorize(e['span_tgt']))  
+                if 'span_tgt_pos' in e:  # sigmoid
+                    span_tgt_pos = e['span_tgt_pos'].copy()
+                    span_tgt_pos[:, 0] += span_offset
+                    batch_span_tgt_pos.append(span_tgt_pos)
+                    batch_num_spans.append(e['num_spans'])
+                    span_offset += e['num_spans']
+                elif 'span_tgt' in e:  # softmax
+                    batch_span_tgt_lst.append(tensorize(e['span_tgt']))
+                if 'span_tgt_pos' in e or 'span_tgt' in e:
                     if self.args.use_refine_mask:
                         batch_refine_mask[bdx, :e['ori_len'], :e['ori_len']] = e['ner_exm'].refine_mask  
 
-                if 'distilled_span_tgt' in e:
-                    batch_span_tgt_lst_distilled.append(tensorize(e['distilled_span_tgt']))  
+                if 'distilled_span_logits' in e:
+                    batch_num_spans_distilled.append(e['distilled_span_logits'].shape[0])
 
             if 'ori_len' not in batch_e[0]:
                 batch_ori_seq_len = batch_seq_len  # 方便兼容ZH时也能使用ori_seq_len
-
-            if self.args.pretrain_mode == 'feature_based':
-                batch_input_pts = torch.nn.utils.rnn.pad_sequence(batch_input_pts, batch_first=True, padding_value=0.)  
-
-            if batch_span_tgt_lst:
+            # bert输出[b,max_len,h]去掉[CLS][SEP]并取词首子词的下标 ZH时保留全部max_len-2个位置
+            batch_tok_gather_idx = subword_gather_index(
+                batch_seq_len, batch_ori_2_tok if batch_ori_2_tok.shape[0] else np.broadcast_to(np.arange(max_len - 2), [bsz, max_len - 2]))
+
+            if self.args.pretrain_mode == 'feature_based':  # 抽取特征时还没有特征
+                batch_input_pts = torch.nn.utils.rnn.pad_sequence(batch_input_pts, batch_first=True, padding_value=0.) if batch_input_pts else None
+
+            if batch_span_tgt_pos:
+                batch_span_tgt_pos = np.concatenate(batch_span_tgt_pos, axis=0)  # [num_pos, 2]
+                batch_span_tgt = torch.zeros([sum(batch_num_spans), len(self.ent2id)], dtype=torch.float32)  # [bsz*num_spans, ent]
+                batch_span_tgt[torch.from_numpy(batch_span_tgt_pos[:, 0]), torch.from_numpy(batch_span_tgt_pos[:, 1])] = 1.
+                batch_span_tgt = tensorize(batch_span_tgt)
+                batch_span_tgt_lst = list(torch.split(batch_span_tgt, batch_num_spans))
+            elif batch_span_tgt_lst:
                 batch_span_tgt = torch.cat(batch_span_tgt_lst, dim=0) 
             else:
                 batch_span_tgt = None
 
-            if batch_span_tgt_lst_distilled:
-                batch_span_tgt_distilled = torch.cat(batch_span_tgt_lst_distilled, dim=0)
+            if batch_num_spans_distilled:
+                distilled_lst = [e['distilled_span_logits'] for e in batch_e if 'distilled_span_logits' in e]
+                batch_span_tgt_distilled = np.empty([sum(batch_num_spans_distilled), distilled_lst[0].shape[1]], dtype=distilled_lst[0].dtype)
+                np.concatenate(distilled_lst, axis=0, out=batch_span_tgt_distilled)  # [bsz*num_spans, 截至上一任务的ent] 只有teacher的列
+                batch_span_tgt_distilled = tensorize(batch_span_tgt_distilled)
+                batch_span_tgt_lst_distilled = list(torch.split(batch_span_tgt_distilled, batch_num_spans_distilled))
             else:
                 batch_span_tgt_distilled = None
+                batch_span_tgt_lst_distilled = []
 
             return {
                 'input_ids': tensorize(batch_input_ids),
@@ -323,14 +393,16 @@ class NerDataReader:
                 'bert_attention_mask': tensorize(batch_bert_attention_mask),
                 'seq_len': tensorize(batch_seq_len),
                 'batch_ner_exm': batch_ner_exm,
+                'batch_exm_idx': batch_exm_idx,  # worker中的ner_exm是副本, 用下标找回主进程的原对象
 
                 'ori_seq_len': tensorize(batch_ori_seq_len),
                 'batch_ori_2_tok': tensorize(batch_ori_2_tok),
+                'batch_tok_gather_idx': tensorize(batch_tok_gather_idx),  # 见subword_gather_index
 
                 'batch_span_tgt': batch_span_tgt,
                 'batch_span_tgt_lst': batch_span_tgt_lst,
 
-                'batch_input_pts': tensorize(batch_input_pts) if self.args.pretrain_mode == 'feature_based' else None,
+                'batch_input_pts': batch_input_pts if self.args.pretrain_mode == 'feature_based' else None,
 
                 'batch_refine_mask': tensorize(batch_refine_mask) if self.args.use_refine_mask else None,
 
@@ -338,63 +410,72 @@ class NerDataReader:
                 'batch_span_tgt_lst_distilled': batch_span_tgt_lst_distilled
             }
         def seq_batcher(batch_e):
+            bsz = len(batch_e)
             max_len = max(e['len'] for e in batch_e)
-            batch_input_ids = []
-            batch_bert_token_type_ids = []
-            batch_bert_attention_mask = []
-            batch_seq_len = []
-            batch_tag_ids = []
+            batch_input_ids = np.full([bsz, max_len], self.pad_id, dtype=np.int64)
+            batch_bert_token_type_ids = np.zeros([bsz, max_len], dtype=np.int64)  # seg0
+            batch_bert_attention_mask = np.zeros([bsz, max_len], dtype=np.int64)
+            batch_seq_len = np.zeros([bsz], dtype=np.int64)
             batch_ner_exm = []
+            batch_exm_idx = []
 
-            batch_ori_seq_len = []
-            batch_ori_2_tok = []
             if 'ori_len' in batch_e[0]:  # ori_len is the raw len, especially in ENG using tokenizer to split into longer subtokens
                 ori_max_len = max(e['ori_len'] for e in batch_e)  # length before bert tokenized: shorter list
+                batch_ori_seq_len = np.zeros([bsz], dtype=np.int64)
+                batch_ori_2_tok = np.zeros([bsz, ori_max_len], dtype=np.int64)
+            else:
+                batch_ori_2_tok = np.zeros([0], dtype=np.int64)
 
             if self.args.pretrain_mode == 'feature_based':
                 batch_input_pts = []  # container for feature-based pt
 
-            batch_distilled_task_ent_output = []
-
-            for e in batch_e:
-                batch_seq_len.append(e['len'] - 2)
-                batch_input_ids.append(e['input_ids'] + [self.pad_id] * (max_len - e['len']))
-                batch_bert_token_type_ids.append([0] * max_len)  # seg0
-                batch_bert_attention_mask.append([1] * e['len'] + [0] * (max_len - e['len']))
+            for bdx, e in enumerate(batch_e):
+                batch_seq_len[bdx] = e['len'] - 2
+                batch_input_ids[bdx, :e['len']] = e['input_ids']
+                batch_bert_attention_mask[bdx, :e['len']] = 1
                 batch_ner_exm.append(e['ner_exm'])
+                batch_exm_idx.append(e.get('exm_idx', -1))
 
                 if 'ori_len' in batch_e[0]:  # ENG
-                    batch_ori_seq_len.append(e['ori_len'])
-                    batch_ori_2_tok.append(e['ori_2_tok'] + [0] * (ori_max_len - e['ori_len']))
+                    batch_ori_seq_len[bdx] = e['ori_len']
+                    batch_ori_2_tok[bdx, :e['ori_len']] = e['ori_2_tok']
 
                 if self.args.pretrain_mode == 'feature_based':  # feature-based pt
-                    if hasattr(e['ner_exm'], 'pt'):
+                    if 'input_pts' in e:  # LazyDataset从FeatureStore按需读取的切片
+                        assert e['input_pts'].shape[0] == e.get('ori_len', e['len'] - 2)
+                        batch_input_pts.append(e['input_pts'])
+                    elif hasattr(e['ner_exm'], 'pt'):
                         assert e['ner_exm'].pt.shape[0] == e['ori_len']
-                    batch_input_pts.append(e['ner_exm'].pt)
-
-                if 'tag_ids' in e:
-                    batch_tag_ids.append(tensorize(e['tag_ids']))  # list of [len]
-
-                if 'distilled_task_ent_output' in e:
-                    batch_distilled_task_ent_output.append(tensorize(e['distilled_task_ent_output']))  # list of [len,ent]
+                        batch_input_pts.append(e['ner_exm'].pt)
 
             if 'ori_len' not in batch_e[0]:  # ZH
                 batch_ori_seq_len = batch_seq_len  # 方便兼容ZH时也能使用ori_seq_len
+            batch_tok_gather_idx = subword_gather_index(
+                batch_seq_len, batch_ori_2_tok if batch_ori_2_tok.shape[0] else np.broadcast_to(np.arange(max_len - 2), [bsz, max_len - 2]))
 
-            if self.args.pretrain_mode == 'feature_based':
-                batch_input_pts = torch.nn.utils.rnn.pad_sequence(batch_input_pts, batch_first=True, padding_value=0.)  # [b,len,1024]
+            if self.args.pretrain_mode == 'feature_based':  # 抽取特征时还没有特征
+                batch_input_pts = torch.nn.utils.rnn.pad_sequence(batch_input_pts, batch_first=True, padding_value=0.) if batch_input_pts else None  # [b,len,1024] fp16
 
-            if batch_tag_ids:
+            tag_ids_lst = [e['tag_ids'] for e in batch_e if 'tag_ids' in e]
+            if tag_ids_lst:
                 if '[PAD]' in self.tag2id:
                     padding_value = self.tag2id['[PAD]']  # 补PAD 当tag2id有pad时
                 else:
                     padding_value = self.tag2id['O']  # 补O
-                batch_tag_ids = torch.nn.utils.rnn.pad_sequence(batch_tag_ids, batch_first=True, padding_value=padding_value)  # [b,len]  # 补O
+                batch_tag_ids = np.full([len(tag_ids_lst), max(len(t) for t in tag_ids_lst)], padding_value, dtype=np.int64)  # [b,len]  # 补O
+                for bdx, tag_ids in enumerate(tag_ids_lst):
+                    batch_tag_ids[bdx, :len(tag_ids)] = tag_ids
+                batch_tag_ids = tensorize(batch_tag_ids)
             else:
                 batch_tag_ids = None
 
-            if batch_distilled_task_ent_output:
-                batch_distilled_task_ent_output = torch.nn.utils.rnn.pad_sequence(batch_distilled_task_ent_output, batch_first=True, padding_value=0.)
+            distilled_lst = [e['distilled_task_ent_output'] for e in batch_e if 'distilled_task_ent_output' in e]  # list of [len,ent]
+            if distilled_lst:
+                batch_distilled_task_ent_output = np.zeros([len(distilled_lst), max(d.shape[0] for d in distilled_lst), distilled_lst[0].shape[1]],
+                                                           dtype=distilled_lst[0].dtype)
+                for bdx, distilled in enumerate(distilled_lst):
+                    batch_distilled_task_ent_output[bdx, :distilled.shape[0]] = distilled
+                batch_distilled_task_ent_output = tensorize(batch_distilled_task_ent_output)
             else:
                 batch_distilled_task_ent_output = None
 
@@ -404,13 +485,15 @@ class NerDataReader:
                 'bert_attention_mask': tensorize(batch_bert_attention_mask),
                 'seq_len': tensorize(batch_seq_len),
                 'batch_ner_exm': batch_ner_exm,
+                'batch_exm_idx': batch_exm_idx,  # worker中的ner_exm是副本, 用下标找回主进程的原对象
 
                 'ori_seq_len': tensorize(batch_ori_seq_len),
                 'batch_ori_2_tok': tensorize(batch_ori_2_tok),
+                'batch_tok_gather_idx': tensorize(batch_tok_gather_idx),  # 见subword_gather_index
 
                 'batch_tag_ids': batch_tag_ids,
 
-                'batch_input_pts': tensorize(batch_input_pts) if self.args.pretrain_mode == 'feature_based' else None,
+                'batch_input_pts': batch_input_pts if self.args.pretrain_mode == 'feature_based' else None,
 
                 'batch_distilled_task_ent_output': batch_distilled_task_ent_output,
             }
@@ -419,17 +502,20 @@ class NerDataReader:
                 'seq': seq_batcher,
                 }.get(arch, None)
 
-    def build_dataset(self, data_source, lang='ENG', arch='span', loss_type=None):
-        """构造数据集"""
-        if isinstance(data_source, (str, Path)):
-            exm_lst = NerExample.load_from_jsonl(data_source)
-        else:
-            exm_lst = data_source
-
+    def prepare_exm_lst(self, exm_lst, lang='ENG', num_proc=0, chunk_size=1000):
+        """bert tokenize并截断到max_len
+           按chunk批量送入tokenizer, num_proc > 0 时用进程池(适合slow tokenizer)
+        """
         if lang == 'ENG':
-            for exm in exm_lst:
-                if not hasattr(exm, 'ori_2_tok') or not hasattr(exm, 'bert_tok_char_lst'):
-                    exm.update_to_bert_tokenize(self.tokenizer, is_split_into_words=True)
+            todo_exms = [exm for exm in exm_lst if not hasattr(exm, 'ori_2_tok') or not hasattr(exm, 'bert_tok_char_lst')]
+            chunks = [[exm.char_lst for exm in todo_exms[i: i + chunk_size]] for i in range(0, len(todo_exms), chunk_size)]
+            if num_proc > 0 and len(chunks) > 1:
+                with ProcessPoolExecutor(num_proc, initializer=_init_pool_tokenizer, initargs=(self.tokenizer,)) as executor:
+                    results = list(executor.map(_pool_tokenize, chunks))
+            else:
+                results = [bert_tokenize_char_lst_lst(self.tokenizer, chunk) for chunk in chunks]
+            for exm, (tok_char_lst, word_ids) in zip(todo_exms, (r for chunk_res in results for r in chunk_res)):
+                exm.set_bert_tokenized(tok_char_lst, word_ids)
         for i, exm in enumerate(exm_lst):
             if hasattr(exm, 'bert_tok_char_lst'):
                 if len(exm.bert_tok_char_lst) > self.max_len - 2:
@@ -440,10 +526,197 @@ class NerDataReader:
             else:
                 exm.truncate(max_size=self.max_len - 2, direction='tail')
 
+    def exm_cache_dir(self, jsonl_file):
+        """预编译缓存目录 与tokenizer和max_len相关"""
+        return f'{jsonl_file}.{Path(self.tokenizer_path).name}-{self.max_len}.cache'
+
+    def compile_exm_cache(self, exm_lst, jsonl_file, num_proc=0):
+        """ 一次性把(ENG)样本编译为扁平的npy数组+offsets 之后由MmapExmList以mmap方式读取 多个进程共享page cache
+            char_lst, bert_tok_ids, ori_2_tok, ent_spans(start,end,type), task_id
+        """
+        cache_dir = self.exm_cache_dir(jsonl_file)
+        self.prepare_exm_lst(exm_lst, lang='ENG', num_proc=num_proc)
+        ent_types = sorted({ent for exm in exm_lst for ent in exm.ent_dct})
+        ent_type2idx = {ent: i for i, ent in enumerate(ent_types)}
+
+        chars, tok_ids, ori_2_tok, ent_spans, task_ids = [], [], [], [], []
+        char_offsets, tok_offsets, ori_offsets, ent_offsets = [0], [0], [0], [0]
+        for exm in exm_lst:
+            chars.append('\x1f'.join(exm.char_lst).encode('utf-8'))
+            char_offsets.append(char_offsets[-1] + len(chars[-1]))
+            tok_ids.extend(self.tokenizer.convert_tokens_to_ids(exm.bert_tok_char_lst))
+            tok_offsets.append(len(tok_ids))
+            ori_2_tok.extend(exm.ori_2_tok)
+            ori_offsets.append(len(ori_2_tok))
+            for ent, pos_lst in exm.ent_dct.items():
+                ent_spans.extend([pos[0], pos[1], ent_type2idx[ent]] for pos in pos_lst)
+            ent_offsets.append(len(ent_spans))
+            task_ids.append(getattr(exm, 'task_id', -1))
+
+        tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(f'{tmp_dir}/chars.npy', np.frombuffer(b''.join(chars), dtype=np.uint8))
+        np.save(f'{tmp_dir}/tok_ids.npy', np.array(tok_ids, dtype=np.int32))
+        np.save(f'{tmp_dir}/ori_2_tok.npy', np.array(ori_2_tok, dtype=np.int32))
+        np.save(f'{tmp_dir}/ent_spans.npy', np.array(ent_spans, dtype=np.int32).reshape(-1, 3))
+        np.save(f'{tmp_dir}/task_id.npy', np.array(task_ids, dtype=np.int32))
+        for name, offsets in [('char', char_offsets), ('tok', tok_offsets), ('ori', ori_offsets), ('ent', ent_offsets)]:
+            np.save(f'{tmp_dir}/{name}_offsets.npy', np.array(offsets, dtype=np.int64))
+        src_stat = os.stat(jsonl_file)
+        with open(f'{tmp_dir}/meta.json', 'w', encoding='U8') as f:
+            json.dump(dict(num=len(exm_lst), ent_types=ent_types, tokenizer_path=str(self.tokenizer_path), max_len=self.max_len,
+                           src_size=src_stat.st_size, src_mtime=src_stat.st_mtime), f, ensure_ascii=False)
+        shutil.rmtree(cache_dir, ignore_errors=True)  # 源文件变化后的旧缓存
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:  # 其他进程同时编译好了
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f'compiled {len(exm_lst)} examples into {cache_dir}')
+
+    def load_exm_cache(self, jsonl_file, keep_ent_types=None):
+        """读取预编译缓存, 不存在或源文件已变化则返回None"""
+        cache_dir = self.exm_cache_dir(jsonl_file)
+        if not os.path.exists(f'{cache_dir}/meta.json'):
+            return None
+        with open(f'{cache_dir}/meta.json', encoding='U8') as f:
+            meta = json.load(f)
+        src_stat = os.stat(jsonl_file)
+        if meta['src_size'] != src_stat.st_size or meta['src_mtime'] != src_stat.st_mtime:
+            return None
+        return MmapExmList(cache_dir, keep_ent_types=keep_ent_types)
+
+    def feature_store_dir(self, jsonl_file, encoder_path):
+        """编码器特征库目录 与编码器和max_len相关"""
+        return f'{jsonl_file}.{Path(encoder_path).name}-{self.max_len}.feat'
+
+    def extract_features(self, dataset, jsonl_file, encoder_path, device=None, batch_size=32):
+        """ 冻结的编码器按batch抽取词级特征(去[CLS][SEP] 每个词取首个子词) 以fp16写入mmap的特征库
+            feats.npy [sum ori_len, hid] + offsets.npy [num+1], 第i个样本的特征为feats[offsets[i]: offsets[i+1]]
+            dataset: build_dataset得到的LazyDataset 与jsonl_file的样本顺序一致
+        """
+        from transformers import AutoModel
+        feature_dir = self.feature_store_dir(jsonl_file, encoder_path)
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        encoder = AutoModel.from_pretrained(encoder_path).to(device).eval()
+        offsets = np.concatenate([[0], np.cumsum(dataset.get_lengths())]).astype(np.int64)
+
+        tmp_dir = f'{feature_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        feats = np.lib.format.open_memmap(f'{tmp_dir}/feats.npy', mode='w+', dtype=np.float16,
+                                          shape=(int(offsets[-1]), encoder.config.hidden_size))
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                                 collate_fn=self.get_batcher_fn(arch=dataset.post_process_args['arch']))
+        with torch.no_grad():
+            for inputs_dct in dataloader:
+                bert_out = encoder(input_ids=inputs_dct['input_ids'].to(device),
+                                   token_type_ids=inputs_dct['bert_token_type_ids'].to(device),
+                                   attention_mask=inputs_dct['bert_attention_mask'].to(device)).last_hidden_state  # [b,l,hid]
+                gather_idx = inputs_dct['batch_tok_gather_idx'].to(device)
+                word_out = torch.gather(bert_out, 1, gather_idx[..., None].expand(-1, -1, bert_out.shape[-1]))  # [b,ori_len,hid]
+                word_out = word_out.half().cpu().numpy()
+                for exm_idx, length, out in zip(inputs_dct['batch_exm_idx'], inputs_dct['ori_seq_len'].tolist(), word_out):
+                    feats[offsets[exm_idx]: offsets[exm_idx] + length] = out[:length]
+        self.save_feature_store(tmp_dir, feature_dir, feats, offsets, jsonl_file, encoder_path)
+
+    def convert_pt_to_feature_store(self, pt_file, jsonl_file, encoder_path):
+        """ 旧的{jsonl}.pt (list of [len, hid] tensor 整体pickle) 转为mmap特征库 只需转一次 """
+        pt_lst = torch.load(pt_file)
+        feature_dir = self.feature_store_dir(jsonl_file, encoder_path)
+        offsets = np.concatenate([[0], np.cumsum([pt.shape[0] for pt in pt_lst])]).astype(np.int64)
+        tmp_dir = f'{feature_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        feats = np.lib.format.open_memmap(f'{tmp_dir}/feats.npy', mode='w+', dtype=np.float16,
+                                          shape=(int(offsets[-1]), pt_lst[0].shape[-1]))
+        for i, pt in enumerate(pt_lst):
+            feats[offsets[i]: offsets[i + 1]] = torch.as_tensor(pt).half().numpy()
+        del pt_lst
+        self.save_feature_store(tmp_dir, feature_dir, feats, offsets, jsonl_file, encoder_path)
+
+    def save_feature_store(self, tmp_dir, feature_dir, feats, offsets, jsonl_file, encoder_path):
+        feats.flush()
+        np.save(f'{tmp_dir}/offsets.npy', offsets)
+        src_stat = os.stat(jsonl_file)
+        with open(f'{tmp_dir}/meta.json', 'w', encoding='U8') as f:
+            json.dump(dict(num=len(offsets) - 1, hidden_size=feats.shape[1], encoder_path=str(encoder_path), max_len=self.max_len,
+                           src_size=src_stat.st_size, src_mtime=src_stat.st_mtime), f, ensure_ascii=False)
+        del feats
+        shutil.rmtree(feature_dir, ignore_errors=True)  # 源文件变化后的旧特征
+        try:
+            os.replace(tmp_dir, feature_dir)
+        except OSError:  # 其他进程同时抽取好了
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f'saved {len(offsets) - 1} examples features into {feature_dir}')
+
+    def load_feature_store(self, jsonl_file, encoder_path):
+        """读取特征库, 不存在或源文件已变化则返回None"""
+        feature_dir = self.feature_store_dir(jsonl_file, encoder_path)
+        if not os.path.exists(f'{feature_dir}/meta.json'):
+            return None
+        with open(f'{feature_dir}/meta.json', encoding='U8') as f:
+            meta = json.load(f)
+        src_stat = os.stat(jsonl_file)
+        if meta['src_size'] != src_stat.st_size or meta['src_mtime'] != src_stat.st_mtime:
+            return None
+        return FeatureStore(feature_dir)
+
+    def jsonl_index_file(self, jsonl_file):
+        """jsonl行偏移索引文件 ori_len是截断后的 与tokenizer和max_len相关"""
+        return f'{jsonl_file}.{Path(self.tokenizer_path).name}-{self.max_len}.idx.npz'
+
+    def build_jsonl_index(self, jsonl_file, token_deli=' ', chunk_size=2000):
+        """ 一次性扫描jsonl 记录每行的字节偏移, 截断后的ori_len, task_id和实体类型 供JsonlExmList随机读取 """
+        offsets, ori_lens, task_ids, ent_type_ids, ent_offsets = [0], [], [], [], [0]
+        ent_type2idx = {}
+        with open(jsonl_file, 'rb') as f:
+            while True:
+                lines = list(itertools.islice(f, chunk_size))
+                if not lines:
+                    break
+                exm_lst = [utils._parse_jsonl_obj(json.loads(line), token_deli=token_deli,
+                                                  external_attrs=['task_id', 'bert_tok_char_lst', 'ori_2_tok']) for line in lines]
+                self.prepare_exm_lst(exm_lst, lang='ENG')
+                for line, exm in zip(lines, exm_lst):
+                    offsets.append(offsets[-1] + len(line))
+                    ori_lens.append(len(exm.char_lst))
+                    task_ids.append(getattr(exm, 'task_id', -1))
+                    ent_type_ids.extend(ent_type2idx.setdefault(ent, len(ent_type2idx)) for ent in exm.ent_dct)
+                    ent_offsets.append(len(ent_type_ids))
+        src_stat = os.stat(jsonl_file)
+        index_file = self.jsonl_index_file(jsonl_file)
+        tmp_file = f'{index_file}.tmp{os.getpid()}.npz'
+        np.savez(tmp_file, offsets=np.array(offsets, dtype=np.int64), ori_lens=np.array(ori_lens, dtype=np.int64),
+                 task_id=np.array(task_ids, dtype=np.int32), ent_type_ids=np.array(ent_type_ids, dtype=np.int32),
+                 ent_offsets=np.array(ent_offsets, dtype=np.int64), ent_types=np.array(list(ent_type2idx), dtype=str),
+                 src_stat=np.array([src_stat.st_size, src_stat.st_mtime], dtype=np.float64))
+        os.replace(tmp_file, index_file)
+        print(f'indexed {len(ori_lens)} examples into {index_file}')
+
+    def load_jsonl_lazily(self, jsonl_file, keep_ent_types=None, external_attrs=None, cache_size=10000):
+        """ JsonlExmList 按需seek解析样本 索引不存在或源文件已变化时先建索引 """
+        index_file = self.jsonl_index_file(jsonl_file)
+        src_stat = os.stat(jsonl_file)
+        if not os.path.exists(index_file) or \
+                np.load(index_file)['src_stat'].tolist() != [float(src_stat.st_size), src_stat.st_mtime]:
+            self.build_jsonl_index(jsonl_file)
+        return JsonlExmList(jsonl_file, index_file, self, keep_ent_types=keep_ent_types, external_attrs=external_attrs,
+                            cache_size=cache_size)
+
+    def build_dataset(self, data_source, lang='ENG', arch='span', loss_type=None, num_proc=0, max_span_width=None):
+        """构造数据集 num_proc: 进程池tokenize  max_span_width: 带状span布局的最大宽度"""
+        if isinstance(data_source, (str, Path)):
+            exm_lst = NerExample.load_from_jsonl(data_source)
+        else:
+            exm_lst = data_source
+
+        if not isinstance(exm_lst, (MmapExmList, JsonlExmList)):  # 预编译时或实例化时tokenize和截断
+            self.prepare_exm_lst(exm_lst, lang=lang, num_proc=num_proc)
+
         if loss_type is None:
             loss_type = self.loss_type
         return LazyDataset(exm_lst, self.post_process,
-                           post_process_args=dict(lang=lang, train=True, arch=arch, loss_type=loss_type)
+                           post_process_args=dict(lang=lang, train=True, arch=arch, loss_type=loss_type,
+                                                  max_span_width=max_span_width)
                            )
 
 
@@ -451,20 +724,274 @@ class NerDataReader:
 class LazyDataset(torch.utils.data.Dataset):
     """LazyDataset"""
 
-    def __init__(self, instances, post_process_fn, post_process_args):
+    def __init__(self, instances, post_process_fn, post_process_args, feature_store=None, teacher_store=None):
         self.instances = instances
         self.post_process_fn = post_process_fn
         self.post_process_args = post_process_args
+        self.feature_store = feature_store  # feature_based时的FeatureStore 按下标读取该样本的编码器特征
+        self.teacher_store = teacher_store  # 蒸馏时当前任务的TeacherLogitStore 按下标读取该样本的teacher logits
 
     def __getitem__(self, idx):
         """Get the instance with index idx"""
-        return self.post_process_fn(self.instances[idx], **self.post_process_args)  # 在DataLoader的时候才对输入进行处理(wrapper) 所以叫Lazy
+        post_process_args = self.post_process_args
+        if self.teacher_store is not None and idx in self.teacher_store:
+            post_process_args = dict(post_process_args, distilled_logits=self.teacher_store[idx])
+        item = self.post_process_fn(self.instances[idx], **post_process_args)  # 在DataLoader的时候才对输入进行处理(wrapper) 所以叫Lazy
+        item['exm_idx'] = idx
+        if self.feature_store is not None:
+            item['input_pts'] = self.feature_store[idx]
+        return item
 
     def __len__(self):
         return len(self.instances)
 
+    def pin_exm(self, idx):
+        """ 要在第idx个样本上写入属性(如蒸馏结果)时用它取样本 JsonlExmList中会固定该样本 不被LRU淘汰 """
+        if isinstance(self.instances, JsonlExmList):
+            return self.instances.pin(idx)
+        return self.instances[idx]
+
+    def get_lengths(self):
+        """ori_len of each instance, MmapExmList/JsonlExmList不需要实例化样本"""
+        if isinstance(self.instances, (MmapExmList, JsonlExmList)):
+            return self.instances.ori_lens.tolist()
+        return [len(exm.char_lst) for exm in self.instances]
+
     def __str__(self):
         return f"<LazyDataset> Num:{len(self)}"
 
     def __repr__(self):
         return str(self)
+
+
+class FeatureStore:
+    """ NerDataReader.extract_features写的fp16编码器特征 以只读mmap打开 按样本下标读取[ori_len, hid]切片 不整体读入内存 """
+
+    def __init__(self, feature_dir):
+        self.feature_dir = feature_dir
+        with open(f'{feature_dir}/meta.json', encoding='U8') as f:
+            self.meta = json.load(f)
+        self.feats = np.load(f'{feature_dir}/feats.npy', mmap_mode='r')  # [sum ori_len, hid] fp16
+        self.offsets = np.load(f'{feature_dir}/offsets.npy', mmap_mode='r')  # [num+1]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.feats[self.offsets[idx]: self.offsets[idx + 1]]))  # 只拷贝出该样本的切片 [ori_len, hid]
+
+
+class TeacherLogitStore:
+    """ 上一个任务模型(teacher)对当前任务训练集打出的span logits [num_spans, 截至上一任务的ent] 以只读mmap打开
+        (baseline为token logits [ori_len, 截至上一任务的tag])
+        fp16, 或int8加每个span一个fp16的scale; offsets按整个训练集的样本下标, 不属于该任务的样本没有span
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(f'{store_dir}/meta.json', encoding='U8') as f:
+            self.meta = json.load(f)
+        self.logits = np.load(f'{store_dir}/logits.npy', mmap_mode='r')  # [sum num_spans, ent] fp16/int8
+        self.scales = np.load(f'{store_dir}/scales.npy', mmap_mode='r') if self.meta['dtype'] == 'int8' else None  # [sum num_spans]
+        self.offsets = np.load(f'{store_dir}/offsets.npy', mmap_mode='r')  # [num+1]
+
+    @classmethod
+    def load(cls, store_dir, num_exm):
+        """ 写完的store(有meta.json) 且样本数一致时才读取 否则返回None """
+        if not os.path.exists(f'{store_dir}/meta.json'):
+            return None
+        store = cls(store_dir)
+        if len(store) != num_exm:
+            return None
+        return store
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, idx):
+        return self.offsets[idx + 1] > self.offsets[idx]
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        logits = np.asarray(self.logits[start: end], dtype=np.float32)  # [num_spans, ent]
+        if self.scales is not None:
+            logits *= self.scales[start: end, None]
+        return logits
+
+
+class TeacherLogitStoreWriter:
+    """ 按样本下标写入teacher logits, close()后原子地换成store_dir 只在写完后才能被TeacherLogitStore.load读到
+        num_spans: [num] 每个样本的行数(SpanKL为span数 baseline为token数) 不需要写的样本为0
+    """
+
+    def __init__(self, store_dir, num_spans, num_ents, dtype='fp16', meta=None):
+        assert dtype in ['fp16', 'int8']
+        self.store_dir = str(store_dir)
+        self.dtype = dtype
+        self.meta = meta or {}
+        self.tmp_dir = f'{self.store_dir}.tmp{os.getpid()}'
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.offsets = np.concatenate([[0], np.cumsum(num_spans)]).astype(np.int64)
+        self.logits = np.lib.format.open_memmap(f'{self.tmp_dir}/logits.npy', mode='w+', dtype=np.int8 if dtype == 'int8' else np.float16,
+                                                shape=(int(self.offsets[-1]), num_ents))
+        self.scales = np.lib.format.open_memmap(f'{self.tmp_dir}/scales.npy', mode='w+', dtype=np.float16,
+                                                shape=(int(self.offsets[-1]),)) if dtype == 'int8' else None
+
+    def write(self, idx, logits):
+        """ logits: [num_spans, ent] float """
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        assert logits.shape == (end - start, self.logits.shape[1])
+        if self.scales is None:
+            self.logits[start: end] = logits
+        else:  # 每个span按其最大的|logit|对称量化到[-127, 127]
+            scales = (np.abs(logits).max(-1) / 127.).astype(np.float16)
+            safe_scales = np.where(scales > 0, scales, 1.).astype(np.float32)[:, None]
+            self.logits[start: end] = np.clip(np.rint(logits / safe_scales), -127, 127)
+            self.scales[start: end] = scales
+
+    def close(self):
+        self.logits.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        np.save(f'{self.tmp_dir}/offsets.npy', self.offsets)
+        with open(f'{self.tmp_dir}/meta.json', 'w', encoding='U8') as f:
+            json.dump(dict(self.meta, num=len(self.offsets) - 1, num_ents=self.logits.shape[1], dtype=self.dtype), f, ensure_ascii=False)
+        del self.logits, self.scales
+        try:
+            os.replace(self.tmp_dir, self.store_dir)
+        except OSError:  # 其他进程同时写好了
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        print(f'saved teacher logits of {int(np.count_nonzero(np.diff(self.offsets)))} examples into {self.store_dir}')
+        return TeacherLogitStore(self.store_dir)
+
+
+class MmapExmList:
+    """ NerDataReader.compile_exm_cache编译的样本 以只读mmap打开 按下标首次访问时才实例化NerExample并缓存
+        (之后蒸馏等设置的属性会保留在该实例上)
+    """
+
+    def __init__(self, cache_dir, keep_ent_types=None, token_deli=' '):
+        self.cache_dir = cache_dir
+        with open(f'{cache_dir}/meta.json', encoding='U8') as f:
+            self.meta = json.load(f)
+        self.ent_types = self.meta['ent_types']
+        self.keep_ent_types = keep_ent_types  # 同remove_ent_by_type(keep_ent_types, input_keep=True)
+        self.token_deli = token_deli
+        for name in ['chars', 'tok_ids', 'ori_2_tok', 'ent_spans', 'task_id',
+                     'char_offsets', 'tok_offsets', 'ori_offsets', 'ent_offsets']:
+            setattr(self, name, np.load(f'{cache_dir}/{name}.npy', mmap_mode='r'))
+        self.ori_lens = np.diff(self.ori_offsets)
+        self.exms = [None] * self.meta['num']
+
+    def __len__(self):
+        return len(self.exms)
+
+    def __getitem__(self, idx):
+        if self.exms[idx] is None:
+            self.exms[idx] = self.build_exm(idx)
+        return self.exms[idx]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def ent_type_lst(self, idx):
+        """第idx个样本(已按keep_ent_types过滤)的实体类型 不需要实例化样本"""
+        ent_types = {self.ent_types[t] for t in self.ent_spans[self.ent_offsets[idx]: self.ent_offsets[idx + 1], 2]}
+        if self.keep_ent_types is not None:
+            ent_types = {ent for ent in ent_types if ent in self.keep_ent_types}
+        return sorted(ent_types)
+
+    def build_exm(self, idx):
+        s, e = self.char_offsets[idx], self.char_offsets[idx + 1]
+        char_lst = bytes(self.chars[s:e]).decode('utf-8').split('\x1f') if e > s else []
+        ent_dct = {}
+        for start, end, t in self.ent_spans[self.ent_offsets[idx]: self.ent_offsets[idx + 1]].tolist():
+            ent = self.ent_types[t]
+            if self.keep_ent_types is None or ent in self.keep_ent_types:
+                ent_dct.setdefault(ent, []).append([start, end])
+        exm = NerExample(char_lst=char_lst, ent_dct=ent_dct, token_deli=self.token_deli)
+        exm.update(anchor='ent_dct')
+        exm.bert_tok_ids = np.array(self.tok_ids[self.tok_offsets[idx]: self.tok_offsets[idx + 1]], dtype=np.int64)
+        exm.ori_2_tok = self.ori_2_tok[self.ori_offsets[idx]: self.ori_offsets[idx + 1]].tolist()
+        if self.task_id[idx] >= 0:
+            exm.task_id = int(self.task_id[idx])
+        exm.eid = idx
+        return exm
+
+
+class JsonlExmList:
+    """ 按NerDataReader.build_jsonl_index的行偏移索引 只在访问时seek并解析对应行, 解析后的NerExample放在大小为cache_size的LRU中
+        被淘汰时若样本属性被修改过(如蒸馏结果, 伪标签) 则保留该样本不丢弃; train_cache可重建 不算修改,
+        但post_process移入train_cache的蒸馏结果不能重建 仍要保留; 要写入属性时用pin先固定样本 以免写到已被淘汰的副本上
+    """
+
+    distilled_keys = ('distilled_span_logits', 'distilled_task_ent_output')  # post_process从样本属性移入train_cache的蒸馏结果
+
+    def __init__(self, jsonl_file, index_file, datareader, keep_ent_types=None, external_attrs=None, token_deli=' ', cache_size=10000):
+        self.jsonl_file = jsonl_file
+        self.datareader = datareader  # 实例化时tokenize和截断
+        self.keep_ent_types = keep_ent_types  # 同remove_ent_by_type(keep_ent_types, input_keep=True)
+        self.external_attrs = external_attrs
+        self.token_deli = token_deli
+        self.cache_size = cache_size
+        index = np.load(index_file)
+        self.offsets = index['offsets']
+        self.ori_lens = index['ori_lens']
+        self.task_id = index['task_id']
+        self.ent_type_ids = index['ent_type_ids']
+        self.ent_offsets = index['ent_offsets']
+        self.ent_types = index['ent_types'].tolist()
+        self.lru = OrderedDict()  # idx -> (exm, 实例化时各属性的id)
+        self.pinned = {}  # idx -> 被修改过的exm
+        self._file, self._pid = None, None
+
+    def __len__(self):
+        return len(self.ori_lens)
+
+    def __getitem__(self, idx):
+        if idx in self.pinned:
+            return self.pinned[idx]
+        if idx in self.lru:
+            self.lru.move_to_end(idx)
+            return self.lru[idx][0]
+        exm = self.build_exm(idx)
+        self.lru[idx] = (exm, self.attr_ids(exm))
+        if len(self.lru) > self.cache_size:
+            old_idx, (old_exm, attr_ids) = self.lru.popitem(last=False)
+            if self.attr_ids(old_exm) != attr_ids or any(k in getattr(old_exm, 'train_cache', {}) for k in self.distilled_keys):
+                self.pinned[old_idx] = old_exm
+        return exm
+
+    @staticmethod
+    def attr_ids(exm):
+        return {k: id(v) for k, v in exm.__dict__.items() if k != 'train_cache'}
+
+    def pin(self, idx):
+        """ 固定第idx个样本 之后不再被淘汰 在其上写入蒸馏结果等属性前调用 """
+        exm = self[idx]
+        self.lru.pop(idx, None)
+        self.pinned[idx] = exm
+        return exm
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def ent_type_lst(self, idx):
+        """第idx个样本(已按keep_ent_types过滤)的实体类型 不需要实例化样本"""
+        ent_types = {self.ent_types[t] for t in self.ent_type_ids[self.ent_offsets[idx]: self.ent_offsets[idx + 1]]}
+        if self.keep_ent_types is not None:
+            ent_types = {ent for ent in ent_types if ent in self.keep_ent_types}
+        return sorted(ent_types)
+
+    def build_exm(self, idx):
+        if self._pid != os.getpid():  # DataLoader worker中重新打开
+            self._file, self._pid = open(self.jsonl_file, 'rb'), os.getpid()
+        self._file.seek(self.offsets[idx])
+        exm = utils._parse_jsonl_obj(json.loads(self._file.readline()), token_deli=self.token_deli, external_attrs=self.external_attrs)
+        if self.keep_ent_types is not None:
+            exm.remove_ent_by_type(self.keep_ent_types, input_keep=True)
+        self.datareader.prepare_exm_lst([exm], lang='ENG')
+        exm.eid = idx
+        return exm
@@ -15,7 +15,9 @@ import ipdb
 import numpy as np
 import logging
 import logging.handlers
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
+import bisect, functools, itertools
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import xlrd, xlwt, openpyxl
@@ -1152,6 +1154,67 @@ class Time_Recorder:
         self.previous_value = time.time()
 
 
+def _resolve_compact_pos_lst(pos_lst, char_lst, token_deli, cum_offsets):
+    """ 精简模式 [start, mention] -> [start, end]
+        cum_offsets[k] = sum(len(char_lst[i]) + len(token_deli) for i < k)
+        end为最小的使 len(token_deli.join(char_lst[start:end])) >= len(mention) 的下标 二分查找
+    """
+    deli_len = len(token_deli)
+    for pos in pos_lst:
+        start = pos[0]
+        if isinstance(pos[1], str):  # 精简模式 start, mention
+            mention = pos[1]
+            if len(mention) == 0:
+                end = start
+            else:
+                end = bisect.bisect_left(cum_offsets, cum_offsets[start] + deli_len + len(mention), lo=start + 1)
+                end = min(end, len(char_lst))
+            pos[1] = end
+        if isinstance(pos[-1], str) and pos[-1] == token_deli.join(char_lst[pos[0]:pos[1]]):  # 如果最后是4h的text 则去掉
+            pos.pop(-1)
+
+
+def _parse_jsonl_obj(obj, token_deli='', external_attrs=None, dedup=True):
+    """ jsonl中的一行dict -> NerExample (不含eid) """
+    if 'char_lst' in obj:
+        char_lst = obj['char_lst']
+    else:
+        if 'text' in obj:  # 只有text
+            if token_deli == '':
+                char_lst = list(obj['text'])
+            else:
+                char_lst = obj['text'].split(token_deli)
+        else:
+            raise Exception('there should exist either of char_lst or text field')
+
+    cum_offsets = [0]
+    for c in char_lst:
+        cum_offsets.append(cum_offsets[-1] + len(c) + len(token_deli))
+
+    ent_dct = obj['ent_dct']
+    for k, pos_lst in ent_dct.items():
+        _resolve_compact_pos_lst(pos_lst, char_lst, token_deli, cum_offsets)
+
+    exm = NerExample(char_lst=char_lst, ent_dct=ent_dct, token_deli=token_deli, dedup=dedup)
+    exm.remove_invalid_ent_dct()
+    exm.update(anchor='ent_dct', dedup=dedup)
+
+    if 'pred_ent_dct' in obj:
+        pred_ent_dct = obj['pred_ent_dct']
+        for k, pos_lst in pred_ent_dct.items():
+            _resolve_compact_pos_lst(pos_lst, char_lst, token_deli, cum_offsets)
+        exm.pred_ent_dct = pred_ent_dct
+
+    if external_attrs is not None:
+        [exm.__setattr__(attr, obj[attr]) for attr in external_attrs if attr in obj]
+    return exm
+
+
+def _parse_jsonl_lines(lines, token_deli='', external_attrs=None, dedup=True):
+    return [_parse_jsonl_obj(json.loads(line.strip()), token_deli=token_deli, external_attrs=external_attrs, dedup=dedup)
+            for line in lines]
+
+
 class NerExample:
     def __init__(self, char_lst, ent_dct, ent_span_dct=None, tag_lst=None, token_deli='', dedup=True):
         """
@@ -1873,9 +1936,10 @@ class NerExample:
                 f.write(exm.to_json_str(val_at_end=val_at_end, only_pred_str=only_pred_str, flat_pred_ent=flat_pred_ent, external_attrs=external_attrs) + '\n')
 
     @staticmethod
-    def load_from_jsonl(jsonl_file, token_deli='', external_attrs=None, dedup=True, eid=True):
+    def load_from_jsonl(jsonl_file, token_deli='', external_attrs=None, dedup=True, eid=True, num_proc=0):
             """ 
             Load data from a JSONL file and convert it into a list of NerExample objects.
+            Thin wrapper of NerExample.iter_from_jsonl.
 
             Parameters:
             - jsonl_file (str): The path to the JSONL file.
@@ -1883,6 +1947,7 @@ class NerExample:
             - external_attrs (list): A list of external attributes to be added to each NerExample object. Default is None.
             - dedup (bool): Whether to deduplicate entities. Default is True.
             - eid (bool): Whether to assign an entity ID to each NerExample object. Default is True.
+            - num_proc (int): Parse in a process pool if > 0. Default is 0.
 
             Returns:
             - exm_lst (list): A list of NerExample objects.
@@ -1891,63 +1956,38 @@ class NerExample:
             - Exception: If the JSONL file does not contain either 'char_lst' or 'text' field.
 
             """
-            with open(jsonl_file, 'r', encoding='U8') as f:
-                obj_lst = [json.loads(line.strip()) for line in f]
-            exm_lst = []
-            for obj in obj_lst:
-                if 'char_lst' in obj:
-                    char_lst = obj['char_lst']
-                else:
-                    if 'text' in obj:  # 只有text
-                        if token_deli == '':
-                            char_lst = list(obj['text'])
-                        else:
-                            char_lst = obj['text'].split(token_deli)
-                    else:
-                        raise Exception('there should exist either of char_lst or text field')
+            return list(NerExample.iter_from_jsonl(jsonl_file, token_deli=token_deli, external_attrs=external_attrs,
+                                                   dedup=dedup, eid=eid, num_proc=num_proc))
 
-                ent_dct = obj['ent_dct']
-                for k, pos_lst in ent_dct.items():
-                    for pos in pos_lst:
-                        start = pos[0]
-                        if isinstance(pos[1], str):  # 精简模式 start, mention
-                            mention = pos[1]
-                            end = start
-                            while len(token_deli.join(char_lst[start: end])) < len(mention):
-                                # while token_deli.join(char_lst[start: end]) != mention:  # 当mention有误时会死循环
-                                end += 1
-                            # end = start + len(mention)  # 仅对于字符级样本有用
-                            pos[1] = end
-                        if isinstance(pos[-1], str) and pos[-1] == token_deli.join(char_lst[pos[0]:pos[1]]):  # 如果最后是4h的text 则去掉
-                            pos.pop(-1)
-
-                exm = NerExample(char_lst=char_lst, ent_dct=ent_dct, token_deli=token_deli, dedup=dedup)
-                exm.remove_invalid_ent_dct()
-                exm.update(anchor='ent_dct', dedup=dedup)
-
-                if 'pred_ent_dct' in obj:
-                    pred_ent_dct = obj['pred_ent_dct']
-                    for k, pos_lst in pred_ent_dct.items():
-                        for pos in pos_lst:
-                            start = pos[0]
-                            if isinstance(pos[1], str):  # 精简模式 start, mention
-                                mention = pos[1]
-                                end = start
-                                while len(token_deli.join(char_lst[start: end])) < len(mention):
-                                    end += 1
-                                # end = start + len(mention)  # 仅对于字符级样本有用
-                                pos[1] = end
-                            if isinstance(pos[-1], str) and pos[-1] == token_deli.join(char_lst[pos[0]:pos[1]]):  # 如果最后是4h的text 则去掉
-                                pos.pop(-1)
-                    exm.pred_ent_dct = pred_ent_dct
-
-                if external_attrs is not None:
-                    [exm.__setattr__(attr, obj[attr]) for attr in external_attrs if attr in obj]
-                if eid:
-                    exm.eid = len(exm_lst)
-                exm_lst.append(exm)
-
-            return exm_lst
+    @staticmethod
+    def iter_from_jsonl(jsonl_file, token_deli='', external_attrs=None, dedup=True, eid=True, num_proc=0, chunk_size=2000):
+        """ 按chunk流式读取jsonl并逐个yield NerExample, 不同时持有全部dict和对象
+            num_proc > 0 时chunk在进程池中解析 最多2*num_proc个chunk在途 保持原顺序
+        """
+        parse_fn = functools.partial(_parse_jsonl_lines, token_deli=token_deli, external_attrs=external_attrs, dedup=dedup)
+        num_exm = 0
+        with open(jsonl_file, 'r', encoding='U8') as f:
+            chunks = iter(lambda: list(itertools.islice(f, chunk_size)), [])
+            if num_proc > 0:
+                with ProcessPoolExecutor(num_proc) as executor:
+                    futures = deque(executor.submit(parse_fn, chunk) for chunk in itertools.islice(chunks, 2 * num_proc))
+                    while futures:
+                        exm_lst = futures.popleft().result()
+                        chunk = next(chunks, None)
+                        if chunk is not None:
+                            futures.append(executor.submit(parse_fn, chunk))
+                        for exm in exm_lst:
+                            if eid:
+                                exm.eid = num_exm
+                            num_exm += 1
+                            yield exm
+            else:
+                for chunk in chunks:
+                    for exm in parse_fn(chunk):
+                        if eid:
+                            exm.eid = num_exm
+                        num_exm += 1
+                        yield exm
 
     @staticmethod
     def load_from_jsonl_4h(jsonl_file):
@@ -1972,7 +2012,7 @@ class NerExample:
 
         return list(text2exms_dct.values())
 
-    def get_span_level_ner_tgt_lst(self, neg_symbol: str = 'O') -> List:
+    def get_span_level_ner_tgt_lst(self, neg_symbol: str = 'O', max_width=None) -> List:
         # TODO 每个span只能属于一个ent
         """
         只有上三角
@@ -1980,6 +2020,7 @@ class NerExample:
         span_index_lst:  [(0,0)-(0,1)-(0,2)-(0,3)-(0,4)-(1,1)-(1,2)-(1,3)-(1,4)-(2,2)-(2,3)-(2,4)-(3,3)-(3,4)-(4,4)]
         span_index_lst_len:  n * (n+1) / 2 = 15  (n=5)
         option: ent_len_lst 可选，用以存储实体长度，方便统计平均实体长度
+        max_width: 只保留宽度不超过max_width的span (带状), 长度见num_spans
         @return: span_ner_tgt_lst: [0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,]
         """
         if self.ent_span_dct is None:
@@ -1988,12 +2029,77 @@ class NerExample:
         # length = len(self.ori_char_lst) if hasattr(self, 'ori_char_lst') else len(self.char_lst)  # TODO
         length = len(self.char_lst)
         for i in range(length):
-            for j in range(i, length):
+            for j in range(i, length if max_width is None else min(length, i + max_width)):
                 span_ner_tgt_lst.append(self.ent_span_dct.get((i, j + 1), neg_symbol))  # 要记得加1，因为end是闭区间
         # if ret == 'int':
         #     span_ner_tgt_lst = [int(e) if isinstance(e, str) and e.isdigit() else e for e in span_ner_tgt_lst]
         return span_ner_tgt_lst
 
+    @staticmethod
+    def num_spans(length, max_width=None):
+        """
+        展平后的span数  不限宽度时为上三角 len*(len+1)//2
+        限制宽度(j-i<max_width)时为带状: 减去宽度超出的 M*(M+1)//2 个span, M=max(len-max_width,0)  即O(len*max_width)
+        支持int / np.ndarray / torch.Tensor
+        """
+        num = length * (length + 1) // 2
+        if max_width is None:
+            return num
+        exceed = length - max_width
+        exceed = exceed * (exceed > 0)  # max(len-max_width,0) 对int/np/torch都适用
+        return num - exceed * (exceed + 1) // 2
+
+    @staticmethod
+    def span_index(start, end, length, max_width=None):
+        """
+        上三角展平后(i,j)的下标, end为闭区间, 与get_span_level_ner_tgt_lst的遍历顺序一致
+        (i,j) -> i * length - i * (i - 1) / 2 + (j - i)   支持np.ndarray
+        e.g. length=5: (0,0)->0 (1,1)->5 (2,3)->10
+        max_width: 带状布局(每行只有j-i<max_width的span), 前i行中被截掉的span数为
+                   m * (length - max_width) - m * (m - 1) / 2, m = min(i, max(length - max_width, 0))
+        """
+        idx = start * length - start * (start - 1) // 2 + (end - start)
+        if max_width is None or max_width >= length:
+            return idx
+        m = np.minimum(start, length - max_width)
+        return idx - (m * (length - max_width) - m * (m - 1) // 2)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def span_start_end(length, max_width=None):
+        """
+        展平后各span的(start, end)表 end为闭区间 与span_index互逆 按(length, max_width)缓存 只读
+        @return: starts, ends  np.int32 [num_spans]
+        """
+        starts, ends = np.triu_indices(length)  # 按行展平 (0,0)-(0,1)-...-(1,1)-... 与span_index一致
+        if max_width is not None:
+            keep = ends - starts < max_width
+            starts, ends = starts[keep], ends[keep]
+        starts, ends = starts.astype(np.int32), ends.astype(np.int32)
+        starts.flags.writeable = False
+        ends.flags.writeable = False
+        return starts, ends
+
+    def get_span_level_ner_tgt_pos(self, ent2id, max_width=None):
+        """
+        稀疏的span级别标签 只保留正例 (sigmoid)
+        max_width: 宽度超过max_width的实体不在带状布局中, 直接丢弃
+        @return: span_tgt_pos: np.int64 [num_pos, 2] 每行为(span下标, ent_id)  span下标见span_index
+        """
+        if self.ent_span_dct is None:
+            self.update(anchor='ent_dct')
+        length = len(self.char_lst)
+        starts, ends, ent_ids = [], [], []
+        for (start, end), ent_type in self.ent_span_dct.items():
+            if 0 <= start < end <= length and ent_type != 'O' and ent_type in ent2id.keys():
+                if max_width is not None and end - start > max_width:
+                    continue
+                starts.append(start)
+                ends.append(end - 1)  # end 变为闭区间
+                ent_ids.append(ent2id[ent_type])
+        span_ids = NerExample.span_index(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), length, max_width)
+        return np.stack([span_ids, np.array(ent_ids, dtype=np.int64)], axis=-1)  # [num_pos, 2]
+
     def get_link_lst(self) -> List:
         link_lst = [0.] * (len(self.char_lst) - 1)
         for ent, v_lst in self.ent_dct.items():
@@ -2081,35 +2187,14 @@ class NerExample:
         return dict(pred_ent_dct)
 
     @staticmethod
-    def from_span_level_ner_tgt_lst_sigmoid(span_ner_tgt_lst, length: int, id2ent: dict, threshold=0.5):
+    def from_span_level_ner_tgt_lst_sigmoid(span_ner_tgt_lst, length: int, id2ent: dict, threshold=0.5, max_width=None):
         """
-        上三角
-        span_ner_tgt_lst: 2维 [len*(len+1)//2, num_label]
+        上三角 (max_width不为None时为带状, 见span_index)
+        span_ner_tgt_lst: 2维 [num_spans(len, max_width), num_label]
+        整个batch一次解码见BatchSpanPred / modules.decode_span_sigmoid
         """
-        assert len(span_ner_tgt_lst) == length * (length + 1) // 2
-        ent_lst = []
-
-        # pred_ent_probs = span_ner_tgt_lst.tolist()  # [len*(len+1)//2, num_ent]  >0就是存在实体 <0不存在实体  sigmoid后则是>0.5 < 0.5
-        # [len*(len+1)//2, num_ent]  >0就是存在实体 <0不存在实体  sigmoid后则是>0.5 < 0.5
-        span_index_lst = [(i, j) for i in range(length) for j in range(i, length)]  # (0,0)-(0,1)-(0,2)-(0,3)-(0,4)...
-
-        # for pred_ent_prob, (start, end) in zip(pred_ent_probs, span_index_lst):
-        #     for ent_id, ent_pred_ent_prob in enumerate(pred_ent_prob):
-        #         if ent_pred_ent_prob >= 0.5:
-        #             ent_lst.append([ent_id, start, end + 1, ent_pred_ent_prob])
-
-        pred_ent_dct = defaultdict(list)
-        pred_ent_probs = np.array(span_ner_tgt_lst)  # [num_span, num_ent]
-        for span_idx, ent_id in zip(*np.where(pred_ent_probs >= threshold)):
-            start, end = span_index_lst[span_idx]
-            pred_ent_prob = pred_ent_probs[span_idx, ent_id]
-            pred_ent_dct[id2ent[ent_id]].append([int(start), int(end) + 1, float(pred_ent_prob)])
-
-        # pred_ent_dct = defaultdict(list)
-        # for pred_ent_id, start, end, pred_ent_prob in ent_lst:
-        #     pred_ent_dct[id2ent[pred_ent_id]].append([start, end, pred_ent_prob])
-
-        return dict(pred_ent_dct)
+        assert len(span_ner_tgt_lst) == NerExample.num_spans(length, max_width)
+        return BatchSpanPred.from_prob(np.asarray(span_ner_tgt_lst), [length], threshold=threshold, max_width=max_width).ent_dct(0, id2ent)
 
     def get_conj_info(self, conj_scores: List, decimal=None):
         # conj_res: tok1 conj_score1 tok2 conj_score2...
@@ -2638,6 +2723,10 @@ class NerExample:
         tokenized_char_lst = bert_tokenizer.convert_ids_to_tokens(tokenized_ids_lst)
         # word_ids 分字词后的字符在原来文本中的位置
         tokenized_word_ids = tokenized_inputs.word_ids()  # [0, 1, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+        self.set_bert_tokenized(tokenized_char_lst, tokenized_word_ids)
+
+    def set_bert_tokenized(self, tokenized_char_lst, tokenized_word_ids):
+        """ 由分词结果和word_ids得到bert_tok_char_lst和ori_2_tok 批量tokenize时也用这个 """
         ori_char_lst_2_tok_char_lst = [-1] * len(self.char_lst)  # ori_char_lst[i] -> tok_char_lst[ori_char_lst_2_tok_char_lst[i]]
         for idx, word_id in enumerate(tokenized_word_ids):
             if ori_char_lst_2_tok_char_lst[word_id] == -1:
@@ -2742,6 +2831,62 @@ class NerExample:
         return nested_sub_tokens  # [[Austria],[1996,-,12,-,07],[Brian]]
 
 
+class BatchSpanPred:
+    """
+    一个batch的span阈值解码结果 紧凑数组: 每个命中一行(exm_ids, starts, ends, ent_ids, probs) ends为开区间 按(样本, span, ent)排序
+    需要时才用ent_dct/ent_dct_lst转为pred_ent_dct {ent: [[start, end, prob], ...]}
+    """
+
+    def __init__(self, exm_ids, starts, ends, ent_ids, probs, bsz):
+        self.exm_ids = exm_ids
+        self.starts = starts
+        self.ends = ends
+        self.ent_ids = ent_ids
+        self.probs = probs
+        self.bsz = bsz
+        self.exm_ofs = np.searchsorted(exm_ids, np.arange(bsz + 1))  # 第bdx个样本的命中为[exm_ofs[bdx], exm_ofs[bdx+1])
+
+    @classmethod
+    def from_flat_hits(cls, span_ids, ent_ids, probs, lengths, max_width=None):
+        """
+        packed [sum num_spans, ent]上命中的(span下标, ent_id) span_ids升序
+        -> 所属样本和(start, end) 只查有命中的样本长度的span_start_end表
+        """
+        lengths = np.asarray(lengths)
+        span_ofs = np.concatenate([[0], np.cumsum(NerExample.num_spans(lengths, max_width))])
+        exm_ids = np.searchsorted(span_ofs, span_ids, side='right') - 1
+        local_ids = span_ids - span_ofs[exm_ids]
+        starts = np.empty(len(span_ids), dtype=np.int64)
+        ends = np.empty(len(span_ids), dtype=np.int64)
+        exm_ofs = np.searchsorted(exm_ids, np.arange(len(lengths) + 1))
+        for bdx in np.flatnonzero(np.diff(exm_ofs)):  # 只遍历有命中的样本
+            s, e = exm_ofs[bdx], exm_ofs[bdx + 1]
+            span_starts, span_ends = NerExample.span_start_end(int(lengths[bdx]), max_width)
+            starts[s:e] = span_starts[local_ids[s:e]]
+            ends[s:e] = span_ends[local_ids[s:e]] + 1  # 开区间
+        return cls(exm_ids, starts, ends, ent_ids, probs, len(lengths))
+
+    @classmethod
+    def from_prob(cls, batch_prob, lengths, threshold=0.5, max_width=None):
+        """ batch_prob: np [sum num_spans, ent] sigmoid后的概率 """
+        span_ids, ent_ids = np.nonzero(batch_prob >= threshold)
+        return cls.from_flat_hits(span_ids, ent_ids, batch_prob[span_ids, ent_ids], lengths, max_width=max_width)
+
+    def __len__(self):
+        return self.bsz
+
+    def ent_dct(self, bdx, id2ent):
+        """ 第bdx个样本的pred_ent_dct 同from_span_level_ner_tgt_lst_sigmoid """
+        s, e = self.exm_ofs[bdx], self.exm_ofs[bdx + 1]
+        pred_ent_dct = defaultdict(list)
+        for start, end, ent_id, prob in zip(self.starts[s:e].tolist(), self.ends[s:e].tolist(), self.ent_ids[s:e].tolist(), self.probs[s:e].tolist()):
+            pred_ent_dct[id2ent[ent_id]].append([start, end, prob])
+        return dict(pred_ent_dct)
+
+    def ent_dct_lst(self, id2ent):
+        return [self.ent_dct(bdx, id2ent) for bdx in range(self.bsz)]
+
+
 def mean(lst):
     return sum(lst) / len(lst)
 
@@ -1,11 +1,14 @@
-import sys, random, copy, math
+import sys, random, copy, math, time
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from typing import *
 from transformers import BertConfig, BertModel, AdamW, get_cosine_schedule_with_warmup, get_constant_schedule_with_warmup
 import ipdb
 import logging
+from datautils import NerExample, BatchSpanPred
+from data_reader import subword_gather_index
 
 logger = logging.getLogger(__name__)
 
@@ -90,6 +93,60 @@ def sequence_mask(lengths, maxlen=None, dtype=torch.bool):
     return mask
 
 
+def gather_word_hidden(bert_out, gather_idx):
+    """ bert_out [b,l,h] 沿序列维按gather_idx [b,l'] 取, 一次gather代替逐样本去[CLS][SEP]和取词首子词 下标见subword_gather_index """
+    return torch.gather(bert_out, 1, gather_idx[..., None].expand(-1, -1, bert_out.shape[-1]))  # [b,l',h]
+
+
+def select_micro_batch(inputs_dct, exm_ids, num_spans=None):
+    """
+    从collate得到的batch中取出exm_ids这些样本组成micro-batch
+    [b,...]的张量按样本取出后截掉多余的pad, packed的[sum num_spans, ent]按num_spans([b])取出对应的段
+    """
+    seq_len = inputs_dct['ori_seq_len']
+    bsz = seq_len.shape[0]
+    idx = torch.tensor(exm_ids, device=seq_len.device)
+    ori_len = int(seq_len[idx].max())
+    tok_len = int(inputs_dct['seq_len'][idx].max()) + 2  # [CLS][SEP]
+    span_idx = None
+    if num_spans is not None:
+        span_ofs = torch.cumsum(num_spans, 0) - num_spans
+        span_idx = torch.cat([torch.arange(span_ofs[i], span_ofs[i] + num_spans[i], device=seq_len.device) for i in exm_ids])
+
+    micro_dct = {}
+    for key, val in inputs_dct.items():
+        if key in ('batch_span_tgt', 'batch_span_tgt_distilled') and val is not None:
+            micro_dct[key] = val[span_idx.to(val.device)]
+        elif isinstance(val, torch.Tensor) and val.dim() > 0 and val.shape[0] == bsz:
+            val = val[idx.to(val.device)]
+            if key in ('input_ids', 'bert_token_type_ids', 'bert_attention_mask'):
+                val = val[:, :tok_len]
+            elif key == 'batch_refine_mask':
+                val = val[:, :ori_len, :ori_len]
+            elif val.dim() > 1:  # batch_ori_2_tok batch_tok_gather_idx batch_input_pts batch_tag_ids batch_distilled_task_ent_output
+                val = val[:, :ori_len]
+            micro_dct[key] = val
+        elif isinstance(val, list) and len(val) == bsz:
+            micro_dct[key] = [val[i] for i in exm_ids]
+        elif hasattr(val, 'exm_ids') and len(val) == bsz:  # ner_loader.LazyExms 取子集时不实例化样本
+            micro_dct[key] = val[list(exm_ids)]
+        else:
+            micro_dct[key] = val
+    return micro_dct
+
+
+def decode_span_sigmoid(batch_prob, seq_len, max_width=None, threshold=0.5, ent_offset=0):
+    """
+    packed [sum num_spans, ent]的概率在其所在设备上阈值化 只把命中的(span下标, ent_id, prob)拷回CPU
+    再按长度缓存的span表映射为(样本, start, end) -> BatchSpanPred  pred_ent_dct的转换在需要时才做
+    ent_offset: batch_prob第0列的ent_id (只算了部分实体的头时)
+    """
+    span_ids, ent_ids = torch.nonzero(batch_prob >= threshold, as_tuple=True)  # 按(span, ent)升序
+    probs = batch_prob[span_ids, ent_ids].float()
+    return BatchSpanPred.from_flat_hits(span_ids.cpu().numpy(), ent_ids.cpu().numpy() + ent_offset, probs.cpu().numpy(),
+                                        seq_len.cpu().numpy(), max_width=max_width)
+
+
 def count_params(model_or_params: Union[torch.nn.Module, torch.nn.Parameter, List[torch.nn.Parameter]],
                  return_trainable=True, verbose=True):
     """
@@ -152,7 +209,10 @@ class NerModel(torch.nn.Module):
             map_location = None
         dct = torch.load(path, **kwargs, map_location=map_location)
         self.load_state_dict(dct['state_dict'])
-        self.opt.load_state_dict(dct['opt'])
+        try:
+            self.opt.load_state_dict(dct['opt'])
+        except ValueError as e:  # 参数分组不一致 如旧ckpt每个任务一个task layer
+            logger.warning(f'[{info}] optimizer state not loaded: {e}')
         logger.info(f'[{info}] Loaded Model: {path}')
 
     def init_opt(self):
@@ -162,14 +222,126 @@ class NerModel(torch.nn.Module):
             params = self.parameters()
         self.opt = torch.optim.AdamW(params, lr=self.lr)  # default weight_decay=1e-2
         # self.opt = AdamW(params, lr=self.lr)  # Transformer impl. default weight_decay=0.
+        self.init_amp()
+
+    def init_amp(self):
+        """ --amp bf16/fp16: 编码器和span头在autocast下前向, loss仍在fp32下计算; fp16需要GradScaler做loss scaling """
+        self.amp = getattr(self.args, 'amp', 'off')
+        self.amp_device_type = torch.device(getattr(self.args, 'device', 'cpu')).type
+        if self.amp == 'fp16' and self.amp_device_type != 'cuda':
+            logger.warning('fp16 autocast needs cuda, fall back to bf16')
+            self.amp = 'bf16'
+        self.amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(self.amp, None)
+        self.grad_scaler = torch.amp.GradScaler(self.amp_device_type, enabled=self.amp == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(self.amp_device_type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def backward_and_step(self, step=True):
+        """ 反向传播self.total_loss并更新参数 fp16时loss先scale  step=False时只反向不更新 """
+        self.opt.zero_grad()
+        self.grad_scaler.scale(self.total_loss).backward()
+        if step:
+            self.optimizer_step()
 
-    def init_lrs(self, num_step_per_epo=None, epo=None, num_warmup_steps=None):
+    def optimizer_step(self):
+        """ 用已累加的梯度更新一次参数 裁剪梯度前先unscale """
+        if self.grad_clip is None:
+            self.total_norm = 0
+        else:
+            self.grad_scaler.unscale_(self.opt)
+            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
+
+        self.grad_scaler.step(self.opt)  # 梯度有inf/nan时跳过该步
+        self.grad_scaler.update()
+
+        if self.use_schedual:
+            self.lrs.step()
+
+        self.curr_lr = self.opt.param_groups[0]['lr']
+
+    def set_grad_checkpoint(self, enable):
+        """ --grad_checkpoint: bert每层的激活不保存 反向时重算 (SpanKL的任务层+span打分同样重算) """
+        self.grad_checkpoint = enable
+        if self.use_bert:
+            if enable:
+                self.bert_layer.gradient_checkpointing_enable()
+            else:
+                self.bert_layer.gradient_checkpointing_disable()
+
+    def report_grad_checkpoint(self, run_loss):
+        """
+        --report_grad_checkpoint: 在同一个batch上比较关/开grad_checkpoint时一次前向+反向的峰值显存和耗时 并打印
+        run_loss: 只前向+反向不更新参数的闭包(observe/runloss的step=False)
+        前后恢复随机数状态(dropout, gumbel门)和grad_checkpoint设置 不影响之后的训练
+        """
+        cuda = self.amp_device_type == 'cuda'
+        prev_grad_checkpoint = self.grad_checkpoint
+        rng_state = torch.get_rng_state()
+        cuda_rng_state = torch.cuda.get_rng_state_all() if cuda else None
+        gumbel_state = self.gumbel_generator.get_state() if hasattr(self, 'gumbel_generator') else None
+        teacher_time = getattr(self, 'teacher_time', None)  # --online_teacher的计时
+        stats = {}
+        try:
+            for enable in [False, True, False, True]:  # 前两次用于预热
+                self.set_grad_checkpoint(enable)
+                if cuda:
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                start = time.time()
+                run_loss()
+                if cuda:
+                    torch.cuda.synchronize()
+                stats[enable] = (torch.cuda.max_memory_allocated() / 2 ** 20 if cuda else float('nan'), time.time() - start)
+        finally:
+            self.opt.zero_grad()
+            self.set_grad_checkpoint(prev_grad_checkpoint)
+            torch.set_rng_state(rng_state)
+            if cuda:
+                torch.cuda.set_rng_state_all(cuda_rng_state)
+            if gumbel_state is not None:
+                self.gumbel_generator.set_state(gumbel_state)
+            if teacher_time is not None:
+                self.teacher_time = teacher_time
+        (mem_off, time_off), (mem_on, time_on) = stats[False], stats[True]
+        logger.info(f'grad_checkpoint: peak memory {mem_off:.0f}MB -> {mem_on:.0f}MB (saved {mem_off - mem_on:.0f}MB), '
+                    f'fwd+bwd time {time_off:.3f}s -> {time_on:.3f}s ({time_on / time_off - 1:+.1%})')
+
+    def micro_batch_cost(self, length):
+        """ 长度为length的样本在micro-batch中的开销 baseline按token数 """
+        return length
+
+    def split_micro_batches(self, inputs_dct):
+        """
+        --micro_batch_budget: 把batch按长度排序后贪心切成 len(micro)*cost(最长样本) <= budget 的micro-batch (同SpanBudgetBatchSampler.pack)
+        各micro-batch的张量截到其中最长的样本, 峰值显存只与budget有关 有效batch大小不变
+        """
+        budget = getattr(self.args, 'micro_batch_budget', None)
+        if not budget:
+            return [inputs_dct]
+        lengths = inputs_dct['ori_seq_len'].tolist()
+        groups, group = [], []
+        for idx in sorted(range(len(lengths)), key=lengths.__getitem__):
+            if group and (len(group) + 1) * self.micro_batch_cost(lengths[idx]) > budget:
+                groups.append(group)
+                group = []
+            group.append(idx)
+        groups.append(group)
+        if len(groups) == 1:
+            return [inputs_dct]
+        num_spans = None
+        if inputs_dct.get('batch_span_tgt', None) is not None:  # packed的span张量需要每个样本的span数
+            num_spans = NerExample.num_spans(inputs_dct['ori_seq_len'], getattr(self, 'max_span_width', None))
+        return [select_micro_batch(inputs_dct, exm_ids, num_spans) for exm_ids in groups]
+
+    def init_lrs(self, num_step_per_epo=None, epo=None, num_warmup_steps=None, num_training_steps=None):
         if epo is None:
             epo = self.args.num_epochs
         if num_step_per_epo is None:
             # num_step_per_epo = (num_training_instancs - 1) // self.args.batch_size + 1
             num_step_per_epo = 1234
-        num_training_steps = num_step_per_epo * epo
+        if num_training_steps is None:  # given directly when steps per epoch vary (span_budget batching)
+            num_training_steps = num_step_per_epo * epo
         if num_warmup_steps is None:
             ratio = 0.1
             num_warmup_steps = ratio * num_training_steps
@@ -259,6 +431,7 @@ class BaselineExtend(NerModel):
 
             check_param_groups(self, self.grouped_params)
 
+        self.set_grad_checkpoint(getattr(args, 'grad_checkpoint', False))
         self.init_opt()
         if self.use_schedual:
             self.init_lrs()
@@ -267,40 +440,34 @@ class BaselineExtend(NerModel):
         batch_input_pts = inputs_dct['batch_input_pts']  # [bsz, len, 1024]
         seq_len = inputs_dct['ori_seq_len']
 
-        if self.use_bert:
-            bert_outputs = self.bert_layer(input_ids=inputs_dct['input_ids'],
-                                           token_type_ids=inputs_dct['bert_token_type_ids'],
-                                           attention_mask=inputs_dct['bert_attention_mask'],
-                                           output_hidden_states=True,
-                                           )
-            seq_len_lst = seq_len.tolist()
-            bert_out = bert_outputs.last_hidden_state
-            # 去除bert_output[CLS]和[SEP]
-            bert_out_lst = [t for t in bert_out]  # split along batch
-            for i, t in enumerate(bert_out_lst):  # iter along batch
-                # tensor [len, hid]
-                bert_out_lst[i] = torch.cat([t[1: 1 + seq_len_lst[i]], t[2 + seq_len_lst[i]:]], 0)
-            bert_out = torch.stack(bert_out_lst, 0)  # stack along batch
-
-            batch_ori_2_tok = inputs_dct['batch_ori_2_tok']
-            if batch_ori_2_tok.shape[0]:  # 只取子词的第一个字  ENG
-                bert_out_lst = [t for t in bert_out]
-                for bdx, t in enumerate(bert_out_lst):
-                    ori_2_tok = batch_ori_2_tok[bdx]
-                    bert_out_lst[bdx] = bert_out_lst[bdx][ori_2_tok]
-                bert_out = torch.stack(bert_out_lst, 0)
-
-            bert_out = self.dropout_layer(bert_out)  # don't forget
-            encode_output = bert_out
-
-        else:  # bilstm
-            pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts, seq_len.cpu(), batch_first=True, enforce_sorted=False)
-            pack_out, _ = self.bilstm_layer(pack_embed)
-            rnn_output_x, _ = torch.nn.utils.rnn.pad_packed_sequence(pack_out, batch_first=True)  # [bat,len,hid]
-            encode_output = rnn_output_x
-
-        # ffn
-        encode_output = self.ent_layer(encode_output)
+        with self.autocast():  # --amp 编码器和ffn在bf16/fp16下前向
+            if self.use_bert:
+                bert_outputs = self.bert_layer(input_ids=inputs_dct['input_ids'],
+                                               token_type_ids=inputs_dct['bert_token_type_ids'],
+                                               attention_mask=inputs_dct['bert_attention_mask'],
+                                               output_hidden_states=True,
+                                               )
+                bert_out = bert_outputs.last_hidden_state
+                # 去除bert_output[CLS]和[SEP] 并只取子词的第一个字 一次gather
+                batch_ori_2_tok = inputs_dct['batch_ori_2_tok']
+                if batch_ori_2_tok.shape[0]:  # ENG 按ori_seq_len去除 与逐样本cat的原实现保持一致
+                    gather_idx = subword_gather_index(seq_len, batch_ori_2_tok)
+                else:  # ZH ori_seq_len即seq_len
+                    gather_idx = inputs_dct['batch_tok_gather_idx']
+                bert_out = gather_word_hidden(bert_out, gather_idx)
+
+                bert_out = self.dropout_layer(bert_out)  # don't forget
+                encode_output = bert_out
+
+            else:  # bilstm
+                pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts.float(), seq_len.cpu(), batch_first=True, enforce_sorted=False)  # 特征库中为fp16
+                pack_out, _ = self.bilstm_layer(pack_embed)
+                rnn_output_x, _ = torch.nn.utils.rnn.pad_packed_sequence(pack_out, batch_first=True)  # [bat,len,hid]
+                encode_output = rnn_output_x
+
+            # ffn
+            encode_output = self.ent_layer(encode_output)
+        encode_output = encode_output.float()  # [b,l,t] 很小 之后的loss和解码用fp32
         self.batch_tag_tensor = encode_output
         return encode_output
 
@@ -326,14 +493,15 @@ class BaselineExtend(NerModel):
         decode_ids = viterbi_decode(ent_output_prob, mask, start_transitions, end_transitions, trans_mask)
         return decode_ids
 
-    def calc_ce_loss(self, target, predict, seq_len_mask, ce_mask):
-        # target [b,l]  predict [b,l,tag]
+    def calc_ce_loss(self, target, predict, seq_len_mask, ce_mask, num_ce=None):
+        # target [b,l]  predict [b,l,tag]  num_ce: micro-batch时传入整batch的token数
         ce_loss = self.ce_loss_layer(predict.transpose(1, 2), target)  # [b,ent,l] [b,l] -> [b,l]
         ce_loss = ce_loss * seq_len_mask
         ce_loss = ce_loss * ce_mask
         # return span_loss。mean()  # [b,l]
 
-        num_ce = torch.sum(torch.logical_and(seq_len_mask, ce_mask))
+        if num_ce is None:
+            num_ce = torch.sum(torch.logical_and(seq_len_mask, ce_mask))
         if num_ce == 0.:
             ce_loss = 0.
         else:
@@ -341,7 +509,7 @@ class BaselineExtend(NerModel):
         # print(num_ce, ce_loss)
         return ce_loss  # [b,l]
 
-    def calc_kl_loss(self, predict, target, seq_len_mask, kl_mask, ofs, ofe):
+    def calc_kl_loss(self, predict, target, seq_len_mask, kl_mask, ofs, ofe, num_kl=None):
         # kl_loss = torch.nn.functional.kl_div(log_kl_pred.double(), target.double(), reduction='none')  # [num_spans, ent, 2]
         # target = target / 2
         # print('target', target)
@@ -364,7 +532,8 @@ class BaselineExtend(NerModel):
         kl_loss = kl_loss * seq_len_mask
         kl_loss = kl_loss * kl_mask
 
-        num_kl = torch.sum(torch.logical_and(seq_len_mask, kl_mask))
+        if num_kl is None:
+            num_kl = torch.sum(torch.logical_and(seq_len_mask, kl_mask))
         if num_kl == 0.:
             kl_loss = 0.
         else:
@@ -373,20 +542,29 @@ class BaselineExtend(NerModel):
         # print(seq_len_mask.sum())
         return kl_loss  # [b,l]
 
-    def calc_loss(self, ce_target, kl_target, ent_output, seq_len, curr_task_id):
+    def calc_loss_norm(self, ce_target, seq_len, curr_task_id):
+        """ 整batch中计算ce和kl的token数 切成micro-batch时各micro的loss都除以它 """
+        seq_len_mask = sequence_mask(seq_len)  # b,l
+        ofs, ofe = self.task_offset_lst[curr_task_id]
+        if curr_task_id == 0:
+            return torch.sum(seq_len_mask), 0
+        ce_mask = torch.logical_and(ce_target >= ofs, ce_target < ofe)
+        return torch.sum(torch.logical_and(seq_len_mask, ce_mask)), torch.sum(torch.logical_and(seq_len_mask, ~ce_mask))
+
+    def calc_loss(self, ce_target, kl_target, ent_output, seq_len, curr_task_id, num_ce=None, num_kl=None):
         # task_ent_output  # :截至当前任务的 0:offset_e
         seq_len_mask = sequence_mask(seq_len)  # b,l
         ofs, ofe = self.task_offset_lst[curr_task_id]  # 当前任务的offset是
         if curr_task_id == 0:  # 第一个任务
             ce_mask = seq_len_mask  # ce_mask [b,l] 哪些是要计算ce_loss的 第一个任务所有都要。
             predict = ent_output[:, :, :ofe]
-            ce_loss = self.calc_ce_loss(ce_target, predict, seq_len_mask, ce_mask)
+            ce_loss = self.calc_ce_loss(ce_target, predict, seq_len_mask, ce_mask, num_ce=num_ce)
             kl_loss = torch.tensor(0.)
 
         else:  # 后续任务
             ce_mask = torch.logical_and(ce_target >= ofs, ce_target < ofe).float()  # 之后的任务当前token属于新任务的ent时要
             predict = ent_output[:, :, :ofe]
-            ce_loss = self.calc_ce_loss(ce_target, predict, seq_len_mask, ce_mask)
+            ce_loss = self.calc_ce_loss(ce_target, predict, seq_len_mask, ce_mask, num_ce=num_ce)
 
             kl_mask = 1. - ce_mask
             # kl_predict = ent_output[:, :, :ofs]
@@ -396,55 +574,43 @@ class BaselineExtend(NerModel):
             # print(kl_target.shape)
             # print(kl_predict.shape)
             # ipdb.set_trace()
-            kl_loss = self.calc_kl_loss(kl_predict, kl_target, seq_len_mask, kl_mask, ofs, ofe)
+            kl_loss = self.calc_kl_loss(kl_predict, kl_target, seq_len_mask, kl_mask, ofs, ofe, num_kl=num_kl)
 
         return ce_loss, kl_loss
 
-    def runloss(self, inputs_dct, task_id):
-        seq_len = inputs_dct['ori_seq_len']
-        batch_tag_ids = inputs_dct['batch_tag_ids']  # [b,l]
-
-        batch_distilled_task_ent_output = inputs_dct['batch_distilled_task_ent_output']
-
-        ent_output = self.encode(inputs_dct)
-
+    def runloss(self, inputs_dct, task_id, step=True):
         # 过滤其他任务的ent
         ofs, ofe = self.task_offset_lst[task_id]  # 当前任务的offset是
-        curr_task_batch_tag_ids = batch_tag_ids.masked_fill(torch.logical_or(batch_tag_ids >= ofe, batch_tag_ids < ofs), 0.)  # [b,l]
-        # print(inputs_dct['batch_ner_exm'][0])
-        # print(batch_tag_ids[0])
-        # print(curr_task_batch_tag_ids[0])
-        # ipdb.set_trace()
-        ce_loss, kl_loss = self.calc_loss(curr_task_batch_tag_ids, batch_distilled_task_ent_output, ent_output, seq_len, task_id)
 
-        self.ce_loss = ce_loss
-        # self.ce_loss = ce_loss.mean()
-        self.kl_loss = kl_loss
-        # self.kl_loss = kl_loss.mean()
+        def filter_tag_ids(batch_tag_ids):
+            return batch_tag_ids.masked_fill(torch.logical_or(batch_tag_ids >= ofe, batch_tag_ids < ofs), 0.)  # [b,l]
 
-        self.total_loss = self.ce_loss + self.kl_loss
+        # 按整batch的token数归一 切成micro-batch累加梯度后与整batch一次计算相同
+        num_ce, num_kl = self.calc_loss_norm(filter_tag_ids(inputs_dct['batch_tag_ids']), inputs_dct['ori_seq_len'], task_id)
 
+        self.ce_loss = 0.
+        self.kl_loss = 0.
         self.opt.zero_grad()
-        self.total_loss.backward()
-
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
+        for micro_dct in self.split_micro_batches(inputs_dct):  # --micro_batch_budget
+            ent_output = self.encode(micro_dct)
+            curr_task_batch_tag_ids = filter_tag_ids(micro_dct['batch_tag_ids'])
+            ce_loss, kl_loss = self.calc_loss(curr_task_batch_tag_ids, micro_dct['batch_distilled_task_ent_output'], ent_output,
+                                              micro_dct['ori_seq_len'], task_id, num_ce=num_ce, num_kl=num_kl)
+            self.grad_scaler.scale(ce_loss + kl_loss).backward()
+            self.ce_loss += float(ce_loss)
+            self.kl_loss += float(kl_loss)
 
-        if self.use_schedual:
-            self.lrs.step()
+        self.total_loss = self.ce_loss + self.kl_loss
 
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        if step:
+            self.optimizer_step()
 
         return (float(self.total_loss),
                 float(self.ce_loss),
                 float(self.kl_loss),
                 )
 
-    def run_loss_non_cl(self, inputs_dct, task_id):
+    def run_loss_non_cl(self, inputs_dct, task_id, step=True):
         seq_len = inputs_dct['ori_seq_len']
         batch_tag_ids = inputs_dct['batch_tag_ids']  # [b,l]
 
@@ -465,20 +631,7 @@ class BaselineExtend(NerModel):
 
         self.total_loss = self.ce_loss + self.kl_loss
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
-
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
-
-        if self.use_schedual:
-            self.lrs.step()
-
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        self.backward_and_step(step)
 
         return (float(self.total_loss),
                 float(self.ce_loss),
@@ -542,6 +695,11 @@ class BaselineAdd(NerModel):
         self.offset_split = [e[0] for e in self.task_offset_lst][1:]  # 用以np.split
         # np.split(tag_logtis, offset_split, axis=-1) split each task of ent_layer [O,B,I][O,B,I]...
 
+        # 各任务的列补齐为[num_tasks, max_dim]的下标和mask 供calc_multitask_kl_loss一次算完之前所有任务的kl (不存入state_dict)
+        max_task_dim = max(ofe - ofs for ofs, ofe in self.task_offset_lst)
+        self.register_buffer('task_col_index', torch.tensor([[min(ofs + i, ofe - 1) for i in range(max_task_dim)] for ofs, ofe in self.task_offset_lst]), persistent=False)
+        self.register_buffer('task_col_valid', torch.tensor([[i < ofe - ofs for i in range(max_task_dim)] for ofs, ofe in self.task_offset_lst]), persistent=False)
+
         self.taskid2tagid_range = {}  # the BIO-tag id in tag2id dict, use to process the original input label.
         for task_id in range(self.num_tasks):
             start_ent = self.loader.entity_task_lst[task_id][0]
@@ -589,6 +747,7 @@ class BaselineAdd(NerModel):
 
             check_param_groups(self, self.grouped_params)
 
+        self.set_grad_checkpoint(getattr(args, 'grad_checkpoint', False))
         self.init_opt()
         if self.use_schedual:
             self.init_lrs()
@@ -597,40 +756,34 @@ class BaselineAdd(NerModel):
         batch_input_pts = inputs_dct['batch_input_pts']  # [bsz, len, 1024]
         seq_len = inputs_dct['ori_seq_len']
 
-        if self.use_bert:
-            bert_outputs = self.bert_layer(input_ids=inputs_dct['input_ids'],
-                                           token_type_ids=inputs_dct['bert_token_type_ids'],
-                                           attention_mask=inputs_dct['bert_attention_mask'],
-                                           output_hidden_states=True,
-                                           )
-            seq_len_lst = seq_len.tolist()
-            bert_out = bert_outputs.last_hidden_state
-            # 去除bert_output[CLS]和[SEP]
-            bert_out_lst = [t for t in bert_out]  # split along batch
-            for i, t in enumerate(bert_out_lst):  # iter along batch
-                # tensor [len, hid]
-                bert_out_lst[i] = torch.cat([t[1: 1 + seq_len_lst[i]], t[2 + seq_len_lst[i]:]], 0)
-            bert_out = torch.stack(bert_out_lst, 0)  # stack along batch
-
-            batch_ori_2_tok = inputs_dct['batch_ori_2_tok']
-            if batch_ori_2_tok.shape[0]:  # 只取子词的第一个字  ENG
-                bert_out_lst = [t for t in bert_out]
-                for bdx, t in enumerate(bert_out_lst):
-                    ori_2_tok = batch_ori_2_tok[bdx]
-                    bert_out_lst[bdx] = bert_out_lst[bdx][ori_2_tok]
-                bert_out = torch.stack(bert_out_lst, 0)
-
-            bert_out = self.dropout_layer(bert_out)  # don't forget
-            encode_output = bert_out
-
-        else:  # bilstm
-            pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts, seq_len.cpu(), batch_first=True, enforce_sorted=False)
-            pack_out, _ = self.bilstm_layer(pack_embed)
-            rnn_output_x, _ = torch.nn.utils.rnn.pad_packed_sequence(pack_out, batch_first=True)  # [bat,len,hid]
-            encode_output = rnn_output_x
-
-        # ffn
-        encode_output = self.ent_layer(encode_output)  # [b,l,t]
+        with self.autocast():  # --amp 编码器和ffn在bf16/fp16下前向
+            if self.use_bert:
+                bert_outputs = self.bert_layer(input_ids=inputs_dct['input_ids'],
+                                               token_type_ids=inputs_dct['bert_token_type_ids'],
+                                               attention_mask=inputs_dct['bert_attention_mask'],
+                                               output_hidden_states=True,
+                                               )
+                bert_out = bert_outputs.last_hidden_state
+                # 去除bert_output[CLS]和[SEP] 并只取子词的第一个字 一次gather
+                batch_ori_2_tok = inputs_dct['batch_ori_2_tok']
+                if batch_ori_2_tok.shape[0]:  # ENG 按ori_seq_len去除 与逐样本cat的原实现保持一致
+                    gather_idx = subword_gather_index(seq_len, batch_ori_2_tok)
+                else:  # ZH ori_seq_len即seq_len
+                    gather_idx = inputs_dct['batch_tok_gather_idx']
+                bert_out = gather_word_hidden(bert_out, gather_idx)
+
+                bert_out = self.dropout_layer(bert_out)  # don't forget
+                encode_output = bert_out
+
+            else:  # bilstm
+                pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts.float(), seq_len.cpu(), batch_first=True, enforce_sorted=False)  # 特征库中为fp16
+                pack_out, _ = self.bilstm_layer(pack_embed)
+                rnn_output_x, _ = torch.nn.utils.rnn.pad_packed_sequence(pack_out, batch_first=True)  # [bat,len,hid]
+                encode_output = rnn_output_x
+
+            # ffn
+            encode_output = self.ent_layer(encode_output)  # [b,l,t]
+        encode_output = encode_output.float()  # [b,l,t] 很小 之后的loss和解码用fp32
         self.batch_tag_tensor = encode_output
         return encode_output
 
@@ -700,65 +853,66 @@ class BaselineAdd(NerModel):
 
         return kl_loss  # [b,l]
 
-    def runloss(self, inputs_dct, task_id):
-        seq_len = inputs_dct['ori_seq_len']
-        batch_tag_ids = inputs_dct['batch_tag_ids']  # [b,l]
-        seq_len_mask = sequence_mask(seq_len)
+    def calc_multitask_kl_loss(self, predict, target, seq_len_mask, task_id):
+        """
+        之前各任务(task_offset_lst[:task_id])的列各自softmax后的kl 补齐成[b,l,task_id,max_dim]一次算完 与逐任务calc_kl_loss相同
+        predict [b,l,t]  target [b,l,截至上一任务的dim] -> [b,l,task_id]
+        """
+        index, valid = self.task_col_index[:task_id], self.task_col_valid[:task_id]  # [T,w]
+        predict = predict[:, :, index].masked_fill(~valid, -1e4)  # [b,l,T,w] 补齐的列softmax后为0 不贡献kl
+        target = target[:, :, index].float().masked_fill(~valid, -1e4)
+        kl_loss = torch.nn.functional.kl_div(torch.log_softmax(predict, dim=-1), torch.log_softmax(target, dim=-1), log_target=True, reduction='none')
+        kl_loss = kl_loss.sum(-1)  # [b,l,T]
+        return kl_loss * seq_len_mask.unsqueeze(-1)
+
+    def runloss(self, inputs_dct, task_id, step=True):
+        # 整batch [b,l]上的.mean() (含pad位置) 切成micro-batch后各micro的loss求和再除以它 与整batch一次计算相同
+        num_tok = inputs_dct['batch_tag_ids'].numel()
+
+        self.ce_loss = 0.
+        self.kl_loss = 0.
+        self.opt.zero_grad()
+        for micro_dct in self.split_micro_batches(inputs_dct):  # --micro_batch_budget
+            seq_len = micro_dct['ori_seq_len']
+            batch_tag_ids = micro_dct['batch_tag_ids']  # [b,l]
+            seq_len_mask = sequence_mask(seq_len)
 
-        batch_distilled_task_ent_output = inputs_dct['batch_distilled_task_ent_output']
+            batch_distilled_task_ent_output = micro_dct['batch_distilled_task_ent_output']
 
-        ent_output = self.encode(inputs_dct)
+            ent_output = self.encode(micro_dct)
 
-        # 过滤其他任务的ent
-        ofs, ofe = self.task_offset_lst[task_id]  # 当前任务的offset是
-        tagid_s, tagid_e = self.taskid2tagid_range[task_id]
-
-        need_to_change_mask = torch.logical_and(batch_tag_ids >= tagid_s, batch_tag_ids <= tagid_e)
-
-        curr_task_batch_tag_ids = batch_tag_ids + need_to_change_mask.int() * (-ofs + task_id)
-
-        curr_task_batch_tag_ids = curr_task_batch_tag_ids.masked_fill(torch.logical_not(need_to_change_mask), 0.)  # [b,l]
-        self.ce_loss = self.calc_ce_loss(curr_task_batch_tag_ids, ent_output[:, :, ofs:ofe], seq_len_mask, seq_len_mask)
-        self.ce_loss = self.ce_loss.mean()
-        # self.ce_loss = self.ce_loss.mean(-1)
-        # self.ce_loss = self.ce_loss.mean(-1)
-
-        if task_id > 0:
-            all_task_kl_loss = []
-            for tid in range(task_id):
-                ofs, ofe = self.task_offset_lst[tid]
-                task_kl_loss = self.calc_kl_loss(ent_output[:, :, ofs:ofe],
-                                                 batch_distilled_task_ent_output[:, :, ofs:ofe],
-                                                 seq_len_mask, kl_mask=seq_len_mask)  # [b,l]
-                task_kl_loss = torch.mean(task_kl_loss)
-                all_task_kl_loss.append(task_kl_loss)
-            self.kl_loss = sum(all_task_kl_loss) / len(all_task_kl_loss)
-        else:
-            self.kl_loss = 0
+            # 过滤其他任务的ent
+            ofs, ofe = self.task_offset_lst[task_id]  # 当前任务的offset是
+            tagid_s, tagid_e = self.taskid2tagid_range[task_id]
 
-        self.total_loss = self.ce_loss + self.kl_loss
+            need_to_change_mask = torch.logical_and(batch_tag_ids >= tagid_s, batch_tag_ids <= tagid_e)
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
+            curr_task_batch_tag_ids = batch_tag_ids + need_to_change_mask.int() * (-ofs + task_id)
 
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
+            curr_task_batch_tag_ids = curr_task_batch_tag_ids.masked_fill(torch.logical_not(need_to_change_mask), 0.)  # [b,l]
+            ce_loss = self.calc_ce_loss(curr_task_batch_tag_ids, ent_output[:, :, ofs:ofe], seq_len_mask, seq_len_mask)
+            ce_loss = ce_loss.sum() / num_tok
 
-        self.opt.step()
+            if task_id > 0:  # 之前各任务的kl 按任务平均
+                kl_loss = self.calc_multitask_kl_loss(ent_output, batch_distilled_task_ent_output, seq_len_mask, task_id).sum() / num_tok / task_id
+            else:
+                kl_loss = 0
 
-        if self.use_schedual:
-            self.lrs.step()
+            self.grad_scaler.scale(ce_loss + kl_loss).backward()
+            self.ce_loss += float(ce_loss)
+            self.kl_loss += float(kl_loss)
 
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        self.total_loss = self.ce_loss + self.kl_loss
+
+        if step:
+            self.optimizer_step()
 
         return (float(self.total_loss),
                 float(self.ce_loss),
                 float(self.kl_loss),
                 )
 
-    def run_loss_non_cl(self, inputs_dct, task_id):
+    def run_loss_non_cl(self, inputs_dct, task_id, step=True):
         seq_len = inputs_dct['ori_seq_len']
         batch_tag_ids = inputs_dct['batch_tag_ids']  # [b,l]
         seq_len_mask = sequence_mask(seq_len)
@@ -788,20 +942,7 @@ class BaselineAdd(NerModel):
 
         self.total_loss = self.ce_loss + self.kl_loss
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
-
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
-
-        if self.use_schedual:
-            self.lrs.step()
-
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        self.backward_and_step(step)
 
         return (float(self.total_loss),
                 float(self.ce_loss),
@@ -809,6 +950,72 @@ class BaselineAdd(NerModel):
                 )
 
 
+class GroupedTaskLinear(torch.nn.Module):
+    """
+    所有任务的task layer合并为一个连续参数, 一次GEMM得到全部任务的start/end hidden
+    weight: [2*ent*hid, in]  行按(start/end, ent, hid)排列, ent按任务顺序拼接 与taskid2offset一致
+    gates: [num_tasks, in] 任务门控 encoder_output * gate_t 经过W_t 等价于 (W_t * gate_t) 作用于encoder_output
+    frozen_tasks: 这些任务的行不回传梯度
+    ent_ids: 只计算这些实体的头(slice或下标列表) 输出的ent维按ent_ids顺序
+    输出: [2,b,ent,l,hid] output[0]为start_hidden output[1]为end_hidden
+    兼容旧ckpt中每个任务一个nn.Linear的task_layers.{tid}.weight/bias (行按(start/end, hid, ent)排列)
+    """
+
+    def __init__(self, in_features, num_ents_per_task, hidden_size_per_ent, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.num_ents_per_task = list(num_ents_per_task)
+        self.hidden_size_per_ent = hidden_size_per_ent
+        self.num_ents = sum(self.num_ents_per_task)
+        self.weight = nn.Parameter(torch.empty(2 * self.num_ents * hidden_size_per_ent, in_features))
+        self.bias = nn.Parameter(torch.empty(2 * self.num_ents * hidden_size_per_ent)) if bias else None
+        ent2task = [tid for tid, num_ents in enumerate(self.num_ents_per_task) for _ in range(num_ents)]
+        self.register_buffer('ent2task', torch.tensor(ent2task, dtype=torch.long), persistent=False)  # [ent]
+        self.frozen_tasks = set()
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        torch.nn.init.kaiming_normal_(self.weight)  # fan_in=in_features 与每个任务单独初始化同分布
+        if self.bias is not None:
+            torch.nn.init.zeros_(self.bias)
+
+    def forward(self, x, gates=None, ent_ids=None):
+        weight = self.weight.view(2, self.num_ents, self.hidden_size_per_ent, self.in_features)  # 2,e,h,in
+        bias = self.bias.view(2, self.num_ents, self.hidden_size_per_ent) if self.bias is not None else None  # 2,e,h
+        ent2task = self.ent2task
+        if ent_ids is not None:  # 只取需要的实体的行 slice时为view不拷贝
+            weight = weight[:, ent_ids]
+            bias = bias[:, ent_ids] if bias is not None else None
+            ent2task = ent2task[ent_ids]
+        num_ents = weight.shape[1]
+        if self.frozen_tasks:
+            frozen = torch.tensor([tid in self.frozen_tasks for tid in range(len(self.num_ents_per_task))], device=weight.device)[ent2task]  # [ent]
+            weight = torch.where(frozen[None, :, None, None], weight.detach(), weight)
+            if bias is not None:
+                bias = torch.where(frozen[None, :, None], bias.detach(), bias)
+        if gates is not None:
+            weight = weight * gates[ent2task][None, :, None, :]  # 2,e,h,in * 1,e,1,in
+        output = torch.nn.functional.linear(x, weight.reshape(-1, self.in_features),
+                                            bias.reshape(-1) if bias is not None else None)  # [b,l,2*e*h]
+        return output.view(*x.shape[:-1], 2, num_ents, self.hidden_size_per_ent).permute(2, 0, 3, 1, 4)  # 2,b,e,l,h
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        old_keys = [f'{prefix}{tid}.weight' for tid in range(len(self.num_ents_per_task))]
+        if prefix + 'weight' not in state_dict and all(k in state_dict for k in old_keys):  # 旧ckpt: ModuleList of nn.Linear
+            h = self.hidden_size_per_ent
+            weight_lst, bias_lst = [], []
+            for tid, num_ents in enumerate(self.num_ents_per_task):
+                w = state_dict.pop(f'{prefix}{tid}.weight')  # [2*h*ent_t, in] 行按(start/end, hid, ent)
+                weight_lst.append(w.view(2, h, num_ents, -1).permute(0, 2, 1, 3))  # 2,ent_t,h,in
+                b = state_dict.pop(f'{prefix}{tid}.bias', None)
+                if b is not None:
+                    bias_lst.append(b.view(2, h, num_ents).permute(0, 2, 1))  # 2,ent_t,h
+            state_dict[prefix + 'weight'] = torch.cat(weight_lst, 1).reshape(-1, self.in_features)
+            if bias_lst:
+                state_dict[prefix + 'bias'] = torch.cat(bias_lst, 1).reshape(-1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class SpanKL(NerModel):
     def __init__(self, args, loader):
         """
@@ -835,6 +1042,9 @@ class SpanKL(NerModel):
         self.gumbel_generator.manual_seed(self.args.seed)  # 设置随机种子
         self.ep = None  # 未使用的变量
         self.use_slr = False  # 在发布的论文中未使用
+        self.keep_dense_span_tensor = False  # 是否保留稠密的[b,l,l,e] span打分到self.batch_span_tensor 仅save_prob_dct探针需要
+        self.span_block_size = 32  # 上三角打分时每次计算的行数
+        self.max_span_width = getattr(args, 'max_span_width', None)  # 只给j-i<max_span_width的span打分(带状) None为全部上三角
 
         self.use_bert = args.pretrain_mode == 'fine_tuning'  # 是否使用BERT预训练模型
         if self.use_bert:  # 如果使用BERT
@@ -867,11 +1077,7 @@ class SpanKL(NerModel):
 
         # task dense layer
         self.output_dim_per_task_lst = [2 * self.hidden_size_per_ent * num_ents for num_ents in self.num_ents_per_task]  # 计算每个任务的输出维度 # 论文中的2K
-        self.task_layers = nn.ModuleList([torch.nn.Linear(encoder_dim, output_dim_per_task) for output_dim_per_task in self.output_dim_per_task_lst])  # 为每个任务创建一个独立的线性层
-        for layer in self.task_layers:
-            torch.nn.init.kaiming_normal_(layer.weight)  # 使用kaiming正态分布初始化权重
-            if layer.bias is not None:
-                torch.nn.init.zeros_(layer.bias)  # 初始化偏置为0
+        self.task_layers = GroupedTaskLinear(encoder_dim, self.num_ents_per_task, self.hidden_size_per_ent)  # 所有任务的线性层合并为一个参数 一次GEMM
 
         self.bce_loss_layer = torch.nn.BCEWithLogitsLoss(reduction='none')  # 创建二元交叉熵损失层
         self.mse_loss_layer = torch.nn.MSELoss(reduction='none')  # 创建均方误差损失层
@@ -914,6 +1120,7 @@ class SpanKL(NerModel):
             """ """
             check_param_groups(self, self.grouped_params)
 
+        self.set_grad_checkpoint(getattr(args, 'grad_checkpoint', False))
         self.init_opt()
         if self.use_schedual:
             self.init_lrs()
@@ -922,28 +1129,14 @@ class SpanKL(NerModel):
 
     def encoder_forward(self, inputs_dct):
         if self.use_bert:
-            seq_len = inputs_dct['seq_len']  # seq_len [bat]
             bert_outputs = self.bert_layer(input_ids=inputs_dct['input_ids'],
                                            token_type_ids=inputs_dct['bert_token_type_ids'],
                                            attention_mask=inputs_dct['bert_attention_mask'],
                                            output_hidden_states=True,
                                            )
-            seq_len_lst = seq_len.tolist()
             bert_out = bert_outputs.last_hidden_state # shape: [b,l,hid]([32,49,768])
-            # 去除bert_output[CLS]和[SEP]
-            bert_out_lst = [t for t in bert_out]  # split along batch
-            for i, t in enumerate(bert_out_lst):  # iter along batch
-                # tensor [len, hid]
-                bert_out_lst[i] = torch.cat([t[1: 1 + seq_len_lst[i]], t[2 + seq_len_lst[i]:]], 0) # remove [CLS] and [SEP]
-            bert_out = torch.stack(bert_out_lst, 0)  # stack along batch
-
-            batch_ori_2_tok = inputs_dct['batch_ori_2_tok']
-            if batch_ori_2_tok.shape[0]:  # 如果batch_ori_2_tok的第一维（即批次大小）大于0
-                bert_out_lst = [t for t in bert_out]  # 将bert_out转换为列表
-                for bdx, t in enumerate(bert_out_lst):  # 遍历bert_out_lst中的每个元素
-                    ori_2_tok = batch_ori_2_tok[bdx]  # 获取当前批次的原始到标记映射(不包含#开头的符号)
-                    bert_out_lst[bdx] = bert_out_lst[bdx][ori_2_tok]  # 使用映射更新bert_out_lst中的对应元素
-                bert_out = torch.stack(bert_out_lst, 0)  # 将更新后的bert_out_lst堆叠回一个张量
+            # 去除bert_output[CLS]和[SEP] 并只取子词的第一个字(ENG) 下标在collate中已按seq_len偏移好 一次gather
+            bert_out = gather_word_hidden(bert_out, inputs_dct['batch_tok_gather_idx'])
 
             bert_out = self.dropout_layer(bert_out)  # don't forget
 
@@ -953,13 +1146,13 @@ class SpanKL(NerModel):
         else:
             batch_input_pts = inputs_dct['batch_input_pts']  # [bsz, len, 1024]
             seq_len = inputs_dct['ori_seq_len']
-            pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts, seq_len.cpu(), batch_first=True, enforce_sorted=False)
+            pack_embed = torch.nn.utils.rnn.pack_padded_sequence(batch_input_pts.float(), seq_len.cpu(), batch_first=True, enforce_sorted=False)  # 特征库中为fp16
             pack_out, _ = self.bilstm_layer(pack_embed)
             rnn_output_x, _ = torch.nn.utils.rnn.pad_packed_sequence(pack_out, batch_first=True)  # [bat,len,hid]
             return rnn_output_x
 
     def task_layer_forward(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, deterministic=False):
-        output_per_task_lst = []  # list of [b,l,h~]
+        gate_lst = []  # list of [in] 每个任务对encoder_output的门控
         for task_id in range(self.num_tasks):
             if use_task_embed:
                 gate_logit = self.task_embed[task_id]  # [1024]
@@ -975,17 +1168,11 @@ class SpanKL(NerModel):
                 else:
                     gate = torch.sigmoid(gate_logit)  # [0~1] prob
 
-                input_per_task = encoder_output * gate[None, None, :]
-            else:
-                input_per_task = encoder_output
-
-            output_per_task = self.task_layers[task_id](input_per_task)
-            output_per_task_lst.append(output_per_task)
-        output_per_task_lst = torch.cat(output_per_task_lst, dim=-1)  # [b,l,h+]
-        return output_per_task_lst
+                gate_lst.append(gate)
+        return self.task_layers(encoder_output, torch.stack(gate_lst) if gate_lst else None)  # 2,b,e,l,h
 
     def task_layer_forward1(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, deterministic_tasks=None):
-        output_per_task_lst = []  # list of [b,l,h~]
+        gate_lst = []  # list of [in] 每个任务对encoder_output的门控
         for task_id in range(self.num_tasks):
             if use_task_embed:
                 gate_logit = self.task_embed[task_id]  # [1024]
@@ -1002,22 +1189,20 @@ class SpanKL(NerModel):
                 else:
                     gate = torch.sigmoid(gate_logit)  # [0~1] prob
 
-                input_per_task = encoder_output * gate[None, None, :]
-            else:
-                input_per_task = encoder_output
+                gate_lst.append(gate)
+        return self.task_layers(encoder_output, torch.stack(gate_lst) if gate_lst else None)  # 2,b,e,l,h
 
-            output_per_task = self.task_layers[task_id](input_per_task)
-            output_per_task_lst.append(output_per_task)
-        output_per_task_lst = torch.cat(output_per_task_lst, dim=-1)  # [b,l,h+]
-        return output_per_task_lst
-
-    def task_layer_forward2(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, gumbel_tasks=None):
-            output_per_task_lst = []  # 初始化一个空列表，用于存储每个任务的输出
+    def task_layer_forward2(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, gumbel_tasks=None, ent_ids=None, gumbel_gates=None):
+            # ent_ids: 只计算这些实体的头(slice或下标列表) None为全部实体
+            # gumbel_gates: {task_id: gate} sample_gumbel_gates预先采样好的门 各micro-batch共用 不再重新采样
+            gate_lst = []  # 初始化一个空列表，用于存储每个任务对encoder_output的门控
             for task_id in range(self.num_tasks):  # 遍历每个任务
                 if use_task_embed:  # 如果使用任务嵌入
                     gate_logit = self.task_embed[task_id]  # 获取当前任务的嵌入
                     if use_gumbel_softmax:  # 如果使用Gumbel Softmax
-                        if task_id in gumbel_tasks:  # 如果当前任务在gumbel_tasks中
+                        if gumbel_gates is not None and task_id in gumbel_gates:
+                            gate = gumbel_gates[task_id]
+                        elif task_id in gumbel_tasks:  # 如果当前任务在gumbel_tasks中
                             gate = gumbel_sigmoid(gate_logit, hard=True, generator=self.gumbel_generator)  # 使用Gumbel Sigmoid生成门控信号
                             self.gate_tensor_lst[task_id] = gate  # 将门控信号存储在列表中
                         else:  # 如果当前任务不在gumbel_tasks中
@@ -1025,13 +1210,10 @@ class SpanKL(NerModel):
                     else:  # 如果不使用Gumbel Softmax
                         gate = torch.sigmoid(gate_logit)  # 使用Sigmoid函数生成门控信号
 
-                    input_per_task = encoder_output * gate[None, None, :]  # 使用门控信号调整编码器的输出，得到每个任务的输入
-                else:  # 如果不使用任务嵌入
-                    input_per_task = encoder_output  # 直接使用编码器的输出作为每个任务的输入
+                    gate_lst.append(gate)  # 门控作用于任务层输入 在GroupedTaskLinear中等价地乘到权重上
 
-                output_per_task = self.task_layers[task_id](input_per_task)  # 通过任务linear层得到每个任务的输出 shape:[32,40,100]
-                output_per_task_lst.append(output_per_task)  # 将每个任务的输出添加到列表中
-            output_per_task_lst = torch.cat(output_per_task_lst, dim=-1)  # 将所有任务的输出沿最后一个维度拼接起来
+            # 所有任务的linear层一次GEMM得到start/end hidden shape:[2,32,ent,40,50]
+            output_per_task_lst = self.task_layers(encoder_output, torch.stack(gate_lst) if gate_lst else None, ent_ids=ent_ids)
 
             if self.use_slr:  # 如果使用SLR
                 slr_output = self.slr_layer(encoder_output)  # 通过SLR层得到输出
@@ -1043,8 +1225,9 @@ class SpanKL(NerModel):
 
             return output_per_task_lst  # 返回每个任务的输出
 
-    def task_layer_forward3(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, gumbel_tasks=None, ep=None):
-        output_per_task_lst = []  # list of [b,l,h~]
+    def task_layer_forward3(self, encoder_output, use_task_embed=True, use_gumbel_softmax=True, gumbel_tasks=None, ep=None, gumbel_gates=None):
+        # gumbel_gates: {task_id: gate} observe中预先算好的门 各micro-batch共用
+        gate_lst = []  # list of [in] 每个任务对encoder_output的门控
         for task_id in range(self.num_tasks):
             if use_task_embed:
                 gate_logit = self.task_embed[task_id]  # [1024]
@@ -1066,7 +1249,9 @@ class SpanKL(NerModel):
                         # else:
                         #     gate = (gate_logit > 0.).float()
                         #     self.gate_tensor_lst[task_id] = gate
-                        if ep is not None:
+                        if gumbel_gates is not None and task_id in gumbel_gates:
+                            gate = gumbel_gates[task_id]
+                        elif ep is not None:
                             gate = (gate_logit >= 0.).float()
                             self.gate_tensor_lst[task_id] = gate
 
@@ -1077,41 +1262,119 @@ class SpanKL(NerModel):
                 else:
                     gate = torch.sigmoid(gate_logit)  # [0~1] prob
 
-                input_per_task = encoder_output * gate[None, None, :]
-            else:
-                input_per_task = encoder_output
+                gate_lst.append(gate)
+        return self.task_layers(encoder_output, torch.stack(gate_lst) if gate_lst else None)  # 2,b,e,l,h
 
-            output_per_task = self.task_layers[task_id](input_per_task)
-            output_per_task_lst.append(output_per_task)
-        output_per_task_lst = torch.cat(output_per_task_lst, dim=-1)  # [b,l,h+]
-        return output_per_task_lst
+    def init_online_teacher(self, dtype='fp32'):
+        """
+        --online_teacher: 把当前模型(即刚载入的上一个任务的模型)冻结复制一份放在同一设备上, observe中只对当前batch算teacher logits
+        只复制网络 不复制优化器和loader; 不注册为子模块 所以不进入state_dict/parameters()/optimizer
+        dtype: bf16/fp16时teacher权重转为低精度 并在同精度的autocast下前向
+        """
+        self.teacher = None
+        memo = {id(self.loader): self.loader, id(self.args): self.args, id(self.gumbel_generator): self.gumbel_generator}
+        for name in ['opt', 'lrs', 'grad_scaler']:
+            if hasattr(self, name):
+                memo[id(getattr(self, name))] = None
+        teacher = copy.deepcopy(self, memo)
+        teacher.eval().requires_grad_(False)
+        teacher_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(dtype, None)
+        if teacher_dtype is not None:
+            teacher.to(teacher_dtype)
+            teacher.amp_dtype = teacher_dtype
+        object.__setattr__(self, 'teacher', teacher)  # 绕过nn.Module.__setattr__ 不注册为子模块
+        self.teacher_time = 0.
+        return teacher
+
+    def teacher_forward(self, inputs_dct, task_id):
+        """ 在线蒸馏: 冻结的teacher对当前(micro-)batch打分 只算之前任务的ent -> [bsz*num_spans, ofs_s] fp32 """
+        ofs_s, ofs_e = self.compute_offsets(task_id)
+        start = time.time()
+        with torch.no_grad():
+            teacher_logits = self.teacher.span_forward(inputs_dct, ent_ids=slice(0, ofs_s))
+        if self.amp_device_type == 'cuda':
+            torch.cuda.synchronize()
+        self.teacher_time += time.time() - start
+        return teacher_logits
+
+    def micro_batch_cost(self, length):
+        """ 同--span_budget 按span数*实体数计 """
+        return NerExample.num_spans(length, self.max_span_width) * sum(self.num_ents_per_task)
+
+    def sample_gumbel_gates(self, gumbel_tasks):
+        """
+        每次observe只采样一次gumbel门 所有micro-batch共用 与整batch一次计算时的门相同
+        @return: {task_id: 叶子gate} 供task_layer_forward2使用; [(采样得到的gate, 叶子gate)] 供backward_gumbel_gates
+        各micro-batch反向时梯度累加在叶子上 最后经采样的计算图一次传回task_embed (采样的图只能反向一次)
+        """
+        gumbel_gates, gumbel_graph = {}, []
+        for task_id in gumbel_tasks:
+            gate = gumbel_sigmoid(self.task_embed[task_id], hard=True, generator=self.gumbel_generator)
+            self.gate_tensor_lst[task_id] = gate
+            leaf = gate.detach().requires_grad_()
+            gumbel_gates[task_id] = leaf
+            gumbel_graph.append((gate, leaf))
+        return gumbel_gates, gumbel_graph
+
+    def backward_gumbel_gates(self, gumbel_graph):
+        """ 叶子gate上累加的(已scale的)梯度经gumbel_sigmoid传回task_embed """
+        for gate, leaf in gumbel_graph:
+            if leaf.grad is not None:
+                gate.backward(leaf.grad)
+
+    def span_head_forward(self, encoder_output, seq_len, task_layer_fn):
+        """
+        任务层task_layer_fn(encoder_output) -> [2,b,ent,l,h] 后span打分 -> [bsz*num_spans, ent]
+        --grad_checkpoint时不保存start/end hidden(是encoder_output的2*ent*h/hid倍) 反向时重算
+        重算前恢复gumbel_generator的状态 使两次采样到的门相同
+        """
+        if not (self.grad_checkpoint and torch.is_grad_enabled()):
+            return self.span_matrix_forward(task_layer_fn(encoder_output), seq_len)
+        gumbel_state = self.gumbel_generator.get_state()
+
+        def run(enc):
+            self.gumbel_generator.set_state(gumbel_state)
+            return self.span_matrix_forward(task_layer_fn(enc), seq_len)
+
+        return torch.utils.checkpoint.checkpoint(run, encoder_output, use_reentrant=False)
 
     def span_matrix_forward(self, output, seq_len):
-        bsz, length = output.shape[:2]
-        # decode the output from output_per_task_lst = torch.cat(output_per_task_lst, dim=-1)
-        ent_hid_lst = torch.split(output, self.output_dim_per_task_lst, dim=-1)
-        start_hid_lst = [torch.chunk(t, 2, dim=-1)[0].reshape([bsz, length, self.hidden_size_per_ent, -1]) for t in ent_hid_lst]  # list of [b,l,hid,ent](for one task)
-        end_hid_lst = [torch.chunk(t, 2, dim=-1)[1].reshape([bsz, length, self.hidden_size_per_ent, -1]) for t in ent_hid_lst]  # list of [b,l,hid,ent](for one task)
-        start_hidden = torch.cat(start_hid_lst, dim=-1)  # b,l,h,e
-        end_hidden = torch.cat(end_hid_lst, dim=-1)  # # b,l,h,e
-        start_hidden = start_hidden.permute(0, 3, 1, 2)  # b,e,l,h
-        end_hidden = end_hidden.permute(0, 3, 1, 2)  # b,e,l,h
-
-        total_ent_size = start_hidden.shape[1]
-
-        attention_scores = torch.matmul(start_hidden, end_hidden.transpose(-1, -2))  # [bat,num_ent,len,hid] * [bat,num_ent,hid,len] = [bat,num_ent,len,len]
-        attention_scores = attention_scores / math.sqrt(self.hidden_size_per_ent) # 论文公式（3）
-        span_ner_mat_tensor = attention_scores.permute(0, 2, 3, 1)  # b,l,l,e
-        if self.use_slr:
-            span_ner_mat_tensor = span_ner_mat_tensor + self.refined_scores
-
-        self.batch_span_tensor = span_ner_mat_tensor
+        # output: task_layer_forward的输出 [2,b,e,l,h] 已是所有任务拼接好的start/end hidden
+        start_hidden, end_hidden = output[0], output[1]  # b,e,l,h
+        bsz, total_ent_size, length = start_hidden.shape[:3]
+
         # 构造下三角mask 去除了pad和下三角区域
         len_mask = sequence_mask(seq_len)  # b,l [32,40]
         matrix_mask = torch.logical_and(torch.unsqueeze(len_mask, 1), torch.unsqueeze(len_mask, 2))  # [b,1,l],[b,l,1]->[b,l,l] # 矩阵表示句子有效位置  # 小正方形mask pad为0 # 例如句子长度为5，有效部分为[5,5]
         score_mat_mask = torch.triu(matrix_mask, diagonal=0)  # b,l,l # 返回上三角部分，包括主对角线 # 下三角0 上三角和对角线1
-        span_ner_pred_lst = torch.masked_select(span_ner_mat_tensor, score_mat_mask[..., None])  # 只取True或1组成列表
-        span_ner_pred_lst = span_ner_pred_lst.view(-1, total_ent_size)  # [*,ent]
+        if self.max_span_width is not None:  # 带状 去掉j-i>=max_span_width的span 打包顺序与NerExample.span_index一致
+            score_mat_mask = score_mat_mask & ~torch.triu(matrix_mask, diagonal=self.max_span_width)
+
+        if self.keep_dense_span_tensor or self.use_slr:
+            attention_scores = torch.matmul(start_hidden, end_hidden.transpose(-1, -2))  # [bat,num_ent,len,hid] * [bat,num_ent,hid,len] = [bat,num_ent,len,len]
+            attention_scores = attention_scores / math.sqrt(self.hidden_size_per_ent) # 论文公式（3）
+            span_ner_mat_tensor = attention_scores.permute(0, 2, 3, 1)  # b,l,l,e
+            if self.use_slr:
+                span_ner_mat_tensor = span_ner_mat_tensor + self.refined_scores
+
+            self.batch_span_tensor = span_ner_mat_tensor
+            span_ner_pred_lst = torch.masked_select(span_ner_mat_tensor, score_mat_mask[..., None])  # 只取True或1组成列表
+            span_ner_pred_lst = span_ner_pred_lst.view(-1, total_ent_size)  # [*,ent]
+            return span_ner_pred_lst
+
+        # 只计算上三角: 每次取block_size行i 只与j>=行起点的列相乘, 有效(i<=j<len)的分数直接写到打包后[sum L(L+1)/2, ent]的位置
+        # 带状时列只取到行终点+max_span_width 计算量随len线性增长
+        # 不保留[b,l,l,e]的稠密矩阵, 每个block的分数选出后即可释放
+        self.batch_span_tensor = None
+        span_pos_mat = torch.cumsum(score_mat_mask.reshape(-1), dim=0).reshape(score_mat_mask.shape) - 1  # b,l,l 按b,i,j顺序的打包下标
+        span_ner_pred_lst = start_hidden.new_empty([int(score_mat_mask.sum()), total_ent_size])  # [*,ent]
+        for r0 in range(0, length, self.span_block_size):
+            r1 = min(r0 + self.span_block_size, length)
+            c1 = length if self.max_span_width is None else min(length, r1 - 1 + self.max_span_width)
+            block_mask = score_mat_mask[:, r0:r1, r0:c1]  # b,B,c1-r0
+            block_scores = torch.matmul(start_hidden[:, :, r0:r1], end_hidden[:, :, r0:c1].transpose(-1, -2))  # [b,e,B,c1-r0]
+            block_scores = block_scores.permute(0, 2, 3, 1)[block_mask] / math.sqrt(self.hidden_size_per_ent)  # [*,ent] 论文公式（3）
+            span_ner_pred_lst.index_put_((span_pos_mat[:, r0:r1, r0:c1][block_mask],), block_scores)
         return span_ner_pred_lst
 
     def compute_offsets(self, task_id, mode='train'):
@@ -1125,7 +1388,7 @@ class SpanKL(NerModel):
     def calc_loss(self, batch_span_pred, batch_span_tgt):
         # pred  batch_span_pred [num_spans,ent]
         # label batch_span_tgt  [num_spans,ent]
-        span_loss = self.bce_loss_layer(batch_span_pred, batch_span_tgt)  # [*,ent] [*,ent](target已是onehot) -> [*,ent]
+        span_loss = self.bce_loss_layer(batch_span_pred.float(), batch_span_tgt)  # [*,ent] [*,ent](target已是onehot) -> [*,ent]  --amp时logits也在fp32下算loss
         # ipdb.set_trace()
         # span_loss = torch.sum(span_loss, -1)  # [*] over ent
         span_loss = torch.mean(span_loss, -1)  # [*] over ent
@@ -1144,98 +1407,55 @@ class SpanKL(NerModel):
         f1 = torch.tensor(1.) if num_gold == num_pred == 0 else 2 * tp / (num_gold + num_pred + 1e-12)
         return f1.item(), (num_gold.item(), num_pred.item(), tp.item())
 
-    def calc_kl_loss(self, batch_target_lst_distilled, batch_predict_lst_need_distill, task_id):
-        ofs_s, ofs_e = self.compute_offsets(task_id)
-        bsz = len(batch_target_lst_distilled)
-        # kl_losses = []
-        batch_kl_loss = 0.
-        for bdx in range(bsz):  # 只蒸馏当前的样本 忽略记忆库的
-        # 这段代码计算了两个分布之间的 Kullback-Leibler (KL) 散度，这是一种衡量两个概率分布差异的方法。在这个例子中，这两个分布是 `pred_need_distill`（需要蒸馏的预测）和 `kl_tgt`（目标分布）。
-
-        # 以下是详细的步骤：
-
-        # 1. `pred_need_distill` 和 `-pred_need_distill` 被堆叠起来形成 `kl_pred`，形状为 `[num_spans, ent, 2]`。这是因为 KL 散度需要比较两个分布，所以我们创建了一个新的维度来表示这两个分布。
+    def segment_sum_per_exm(self, span_loss, batch_num_spans):
+        """ packed [sum num_spans] 的逐span loss 按样本求和 -> [bsz]  batch_num_spans: [bsz] 每个样本的span数 """
+        bsz = batch_num_spans.shape[0]
+        exm_ids = torch.repeat_interleave(torch.arange(bsz, device=span_loss.device), batch_num_spans.to(span_loss.device),
+                                          output_size=span_loss.shape[0])  # [sum num_spans] 每个span所属样本
+        return span_loss.new_zeros(bsz).index_add_(0, exm_ids, span_loss)
 
-        # 2. 对 `kl_pred` 使用 `logsigmoid` 函数，得到 `log_kl_pred`。`logsigmoid` 是 sigmoid 函数的对数形式，可以将输入映射到 `(0, 1)` 区间。
-
-        # 3. `kl_tgt` 是目标分布，它被除以 1（这实际上没有改变它的值），然后和 `-kl_tgt` 一起被堆叠起来形成 `kl_tgt_logit`，形状也是 `[num_spans, ent, 2]`。
-
-        # 4. 对 `kl_tgt_logit` 使用 `logsigmoid` 函数，得到 `log_kl_tgt`。
-
-        # 5. 使用 `torch.nn.functional.kl_div` 函数计算 `log_kl_pred` 和 `log_kl_tgt` 之间的 KL 散度，得到 `kl_loss`。`reduction='none'` 参数表示对每一个点计算，`log_target=True` 参数表示目标分布已经取了对数。`torch.nn.functional.kl_div` 函数计算的是两个概率分布之间的 Kullback-Leibler (KL) 散度。这个函数通常接受的是两个概率分布，这意味着输入通常应该是经过 softmax 或者 sigmoid 函数处理过的，以确保它们的值在 0 和 1 之间，并且所有的值的和为 1。`torch.nn.functional.kl_div` 函数计算的是两个概率分布之间的 Kullback-Leibler (KL) 散度。这个函数通常接受的是两个概率分布，这意味着输入通常应该是经过 softmax 或者 sigmoid 函数处理过的，以确保它们的值在 0 和 1 之间，并且所有的值的和为 1。
-
-        # 然而，在这段代码中，`kl_div` 函数的输入是 `log_kl_pred` 和 `log_kl_tgt`，这两个变量都是经过 `logsigmoid` 函数处理过的。`logsigmoid` 函数会将输入映射到 `(0, 1)` 区间，但是它不保证所有的值的和为 1。
-
-        # 这可能是因为这段代码实际上计算的是每个元素的 KL 散度，而不是整个分布的 KL 散度。在这种情况下，每个元素可以被视为一个独立的二元分布，所以不需要保证所有的值的和为 1。
-
-        # 另外，`kl_div` 函数的 `log_target=True` 参数表示目标分布已经取了对数。这意味着 `log_kl_tgt` 实际上表示的是目标分布的对数，而不是目标分布本身。
-
-        # 总的来说，虽然 `kl_div` 函数通常接受的是经过 softmax 或者 sigmoid 函数处理过的概率分布，但是在这段代码中，它接受的是经过 `logsigmoid` 函数处理过的对数分布。这是因为这段代码计算的是每个元素的 KL 散度，而不是整个分布的 KL 散度。
-
-
-
-        # 6. 使用 `torch.sum` 函数对 `kl_loss` 的最后一个维度进行求和，然后使用 `torch.mean` 函数对结果进行平均，得到每个 span 的 KL 损失。
-
-        # 7. 使用 `torch.sum` 函数对结果进行求和，得到所有 span 的总 KL 损失。
-
-        # 8. 最后，将这个 batch 的 KL 损失加到 `batch_kl_loss` 上。
-
-        # 这个过程计算了预测分布和目标分布之间的 KL 散度，这是一种常见的损失函数，用于训练概率模型。
-            pred_need_distill = batch_predict_lst_need_distill[bdx][:, :ofs_s]
-            kl_pred = torch.stack([pred_need_distill, -pred_need_distill], dim=-1)  # [num_spans, ent, 2]
-            log_kl_pred = torch.nn.functional.logsigmoid(kl_pred)
-
-            kl_tgt = batch_target_lst_distilled[bdx][:, :ofs_s]
-
-            # kl_tgt = torch.stack([kl_tgt, 1. - kl_tgt], dim=-1)  # [num_spans, ent, 2]  # kl_tgt为prob
-            # kl_tgt_logits = -torch.log(1 / (tgt_prob + 1e-8) - 1 + 1e-8)  # inverse of sigmoid
-            # kl_loss = torch.nn.functional.kl_div(log_kl_pred, kl_tgt, reduction='none')  # [num_spans, ent, 2]
-
-            kl_tgt = kl_tgt / 1.  # temp=1
-            kl_tgt_logit = torch.stack([kl_tgt, -kl_tgt], dim=-1)  # [num_spans, ent, 2]  # kl_tgt为logits
-            log_kl_tgt = torch.nn.functional.logsigmoid(kl_tgt_logit)
-            kl_loss = torch.nn.functional.kl_div(log_kl_pred, log_kl_tgt, reduction='none', log_target=True)  # [num_spans, ent, 2]
-
-            kl_loss = torch.sum(kl_loss, -1)  # kl definition
-            kl_loss = torch.mean(kl_loss, -1)  # over ent
-            kl_loss = torch.sum(kl_loss, -1)  # over spans
-            # kl_loss = torch.mean(kl_loss, -1)  # over spans
-
-            # kl_losses.append(kl_loss)
-            # self.kl_loss = sum(kl_losses) / len(kl_losses)
-            batch_kl_loss += kl_loss
-
-        # return torch.abs(batch_kl_loss / bsz)
-        return batch_kl_loss / bsz
-        # return torch.relu(batch_kl_loss / bsz)
-
-    def calc_kl_loss_mse(self, batch_target_lst_distilled, batch_predict_lst_need_distill, task_id):
+    def calc_kl_loss(self, batch_target_distilled, batch_predict, task_id, batch_num_spans, bsz=None):
+        """
+        在packed的[sum num_spans, ent]上一次算完 只蒸馏之前任务的实体[:, :ofs_s]
+        batch_target_distilled只有teacher的列[sum num_spans, ofs_s] 当前任务的列[ofs_s:ofs_e]由take_loss从batch_span_tgt取
+        每个span每个ent看作二元分布 pred和tgt(上一个任务模型的logits)都经logsigmoid([x,-x])后算KL
+        over ent取平均 over spans按样本求和(segment sum) 再按batch平均
+        """
         ofs_s, ofs_e = self.compute_offsets(task_id)
-        bsz = len(batch_target_lst_distilled)
-        # kl_losses = []
-        batch_kl_loss = 0.
-        for bdx in range(bsz):  # 只蒸馏当前的样本 忽略记忆库的
-            kl_tgt = batch_target_lst_distilled[bdx][:, :ofs_s]  # prob
-
-            pred_need_distill = batch_predict_lst_need_distill[bdx][:, :ofs_s]
-            mse_loss = self.mse_loss_layer(pred_need_distill.sigmoid(), kl_tgt)  # [num_spans, ent]
-
-            mse_loss = torch.mean(mse_loss, -1)  # over ent
-            mse_loss = torch.sum(mse_loss, -1)  # over spans
-            # mse_loss = torch.mean(mse_loss, -1)  # over spans
-
-            # kl_losses.append(kl_loss)
-            # self.kl_loss = sum(kl_losses) / len(kl_losses)
-            batch_kl_loss += mse_loss
+        pred_need_distill = batch_predict[:, :ofs_s].float()  # --amp时也在fp32下算kl
+        kl_pred = torch.stack([pred_need_distill, -pred_need_distill], dim=-1)  # [num_spans, ent, 2]
+        log_kl_pred = torch.nn.functional.logsigmoid(kl_pred)
+
+        kl_tgt = batch_target_distilled[:, :ofs_s].float() / 1.  # temp=1
+        kl_tgt_logit = torch.stack([kl_tgt, -kl_tgt], dim=-1)  # [num_spans, ent, 2]  # kl_tgt为logits
+        log_kl_tgt = torch.nn.functional.logsigmoid(kl_tgt_logit)
+        kl_loss = torch.nn.functional.kl_div(log_kl_pred, log_kl_tgt, reduction='none', log_target=True)  # [num_spans, ent, 2]
+
+        kl_loss = torch.sum(kl_loss, -1)  # kl definition
+        kl_loss = torch.mean(kl_loss, -1)  # over ent
+        kl_loss = self.segment_sum_per_exm(kl_loss, batch_num_spans)  # over spans [bsz]
+        if bsz is not None:  # micro-batch时按整batch的bsz平均
+            return kl_loss.sum() / bsz
+        return torch.mean(kl_loss)
+
+    def calc_kl_loss_mse(self, batch_target_distilled, batch_predict, task_id, batch_num_spans, bsz=None):
+        ofs_s, ofs_e = self.compute_offsets(task_id)
+        kl_tgt = batch_target_distilled[:, :ofs_s].float()  # prob
+        pred_need_distill = batch_predict[:, :ofs_s].float()
+        mse_loss = self.mse_loss_layer(pred_need_distill.sigmoid(), kl_tgt)  # [num_spans, ent]
 
-        return batch_kl_loss / bsz
+        mse_loss = torch.mean(mse_loss, -1)  # over ent
+        mse_loss = self.segment_sum_per_exm(mse_loss, batch_num_spans)  # over spans [bsz]
+        if bsz is not None:
+            return mse_loss.sum() / bsz
+        return torch.mean(mse_loss)
 
-    def take_loss(self, task_id, batch_predict, batch_target, f1_meaner=None, bsz=None):
-        """single task of example"""  # batch_predict,batch_target: [bsz*num_spans, ent]
+    def take_loss(self, task_id, batch_predict, batch_target, f1_meaner=None, bsz=None, ent_offset=0):
+        """single task of example"""  # batch_predict,batch_target: [bsz*num_spans, ent]  batch_predict只含从ent_offset开始的实体时传入ent_offset
         ofs_s, ofs_e = self.compute_offsets(task_id)
-        loss = self.calc_loss(batch_predict[:, ofs_s:ofs_e], batch_target[:, ofs_s:ofs_e])  # 只计算对应task的头
+        loss = self.calc_loss(batch_predict[:, ofs_s - ent_offset:ofs_e - ent_offset], batch_target[:, ofs_s:ofs_e])  # 只计算对应task的头
         if f1_meaner is not None:
-            f1, f1_detail = self.calc_f1(batch_predict[:, ofs_s:ofs_e], batch_target[:, ofs_s:ofs_e])
+            f1, f1_detail = self.calc_f1(batch_predict[:, ofs_s - ent_offset:ofs_e - ent_offset], batch_target[:, ofs_s:ofs_e])
             f1_meaner.add(*f1_detail)
         if bsz is not None:
             loss = loss / bsz
@@ -1257,37 +1477,56 @@ class SpanKL(NerModel):
     def eval_forward(self, inputs_dct, task_id, mode='train'):
         # 用于eval
         seq_len = inputs_dct['ori_seq_len']
-        encoder_output = self.encoder_forward(inputs_dct)
-        task_layer_output = self.task_layer_forward2(encoder_output,
-                                                     use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
-                                                     gumbel_tasks=[])
-        batch_span_pred = self.span_matrix_forward(task_layer_output, seq_len)  # [bsz*num_spans, ent]
-        batch_predict_lst = torch.split(batch_span_pred, (seq_len * (seq_len + 1) / 2).int().tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
-
         ofs_s, ofs_e = self.compute_offsets(task_id, mode=mode)  # make sure we predict classes within the current task
+        need_kl = self.args.use_distill and task_id > 0 and inputs_dct.get('batch_span_tgt_lst_distilled', None)
+        # 只计算[head_s, ofs_e)的头 之后任务的头不算 kl需要之前任务的头 探针需要全部的稠密打分
+        head_s = 0 if need_kl or self.keep_dense_span_tensor else ofs_s
+        head_e = None if self.keep_dense_span_tensor else ofs_e
+        batch_span_pred = self.span_forward(inputs_dct, ent_ids=slice(head_s, head_e))  # [bsz*num_spans, head_e-head_s]
 
         f1, detail_f1, span_loss, kl_loss = None, None, None, None
         if 'batch_span_tgt' in inputs_dct:  # if label had passed into
             batch_span_tgt = inputs_dct['batch_span_tgt']  # [bsz*num_spans, ent]
-            f1, detail_f1 = self.calc_f1(batch_span_pred[:, ofs_s:ofs_e], batch_span_tgt[:, ofs_s:ofs_e])
+            f1, detail_f1 = self.calc_f1(batch_span_pred[:, ofs_s - head_s:ofs_e - head_s], batch_span_tgt[:, ofs_s:ofs_e])
+
+            span_loss = self.take_loss(task_id, batch_span_pred, batch_span_tgt, bsz=len(seq_len), ent_offset=head_s)  # 默认是curr(train)
+        if need_kl:
+            kl_loss = self.calc_kl_loss(inputs_dct['batch_span_tgt_distilled'], batch_span_pred, task_id,
+                                        NerExample.num_spans(seq_len, self.max_span_width))  # 默认是so_far-curr
 
-            span_loss = self.take_loss(task_id, batch_span_pred, batch_span_tgt, bsz=len(seq_len))  # 默认是curr(train)
-        if self.args.use_distill and task_id > 0 and inputs_dct.get('batch_span_tgt_lst_distilled', None):
-            kl_loss = self.calc_kl_loss(inputs_dct['batch_span_tgt_lst_distilled'], batch_predict_lst, task_id)  # 默认是so_far-curr
+        return batch_span_pred[:, ofs_s - head_s:ofs_e - head_s], f1, detail_f1, span_loss, kl_loss
 
-        return batch_span_pred[:, ofs_s:ofs_e], f1, detail_f1, span_loss, kl_loss
+    def span_forward(self, inputs_dct, ent_ids=None):
+        """
+        不训练时的span打分 只计算ent_ids(slice或下标列表)对应实体的头
+        @return: [bsz*num_spans, len(ent_ids)] logits  ent维按ent_ids顺序
+        """
+        with self.autocast():  # --amp
+            encoder_output = self.encoder_forward(inputs_dct)
+            task_layer_output = self.task_layer_forward2(encoder_output,
+                                                         use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
+                                                         gumbel_tasks=[], ent_ids=ent_ids)
+            batch_span_pred = self.span_matrix_forward(task_layer_output, inputs_dct['ori_seq_len'])
+        return batch_span_pred.float()  # 只剩所需的头 转fp32供loss和numpy解码
+
+    def predict_ents(self, inputs_dct, ent_lst, id2ent, threshold=0.5):
+        """
+        serving: 只预测ent_lst中的实体类型 其他任务的头不计算
+        ent_lst: 实体类型名或ent_id的列表 任意子集  id2ent: loader.datareader.id2ent
+        @return: list of pred_ent_dct, 每个样本一个
+        """
+        ent2id = {ent: eid for eid, ent in id2ent.items()}
+        ent_ids = [ent2id.get(ent, ent) for ent in ent_lst]
+        with torch.no_grad():
+            batch_prob = torch.sigmoid(self.span_forward(inputs_dct, ent_ids=ent_ids))  # [bsz*num_spans, len(ent_ids)]
+        sub_id2ent = {i: id2ent[eid] for i, eid in enumerate(ent_ids)}
+        return decode_span_sigmoid(batch_prob, inputs_dct['ori_seq_len'], max_width=self.max_span_width, threshold=threshold).ent_dct_lst(sub_id2ent)
 
     def forward(self, *args, **kwargs):
         return self.eval_forward(*args, **kwargs)
 
-    def observe(self, inputs_dct, task_id, f1_meaner, ep=None):
-        batch_exm = inputs_dct['batch_ner_exm']
+    def observe(self, inputs_dct, task_id, f1_meaner, ep=None, step=True):
         batch_length = inputs_dct['ori_seq_len']
-        batch_input_pts = inputs_dct['batch_input_pts']
-
-        batch_target = inputs_dct['batch_span_tgt']
-        batch_target_lst = inputs_dct['batch_span_tgt_lst']  # list of onehot tensor [num_spans, ent]
-        batch_target_lst_distilled = inputs_dct.get('batch_span_tgt_lst_distilled', None)  # list of sigmoided prob [num_spans, ent]
         bsz = batch_length.shape[0]
 
         self.total_loss = 0.
@@ -1296,34 +1535,53 @@ class SpanKL(NerModel):
         self.kl_loss = 0.
         self.entropy_loss = 0.
 
-        encoder_output = self.encoder_forward(inputs_dct) #shape: [b,l,hid](32,40,768)
-
-        if ep is not None:
-            task_layer_output = self.task_layer_forward3(encoder_output,
-                                                         use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
-                                                         gumbel_tasks=[task_id],
-                                                         ep=ep)
-        else:
-            task_layer_output = self.task_layer_forward2(encoder_output,
-                                                         use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
-                                                         gumbel_tasks=[task_id],
-                                                         ) # shape:[32,40,600]
-
-        batch_predict = self.span_matrix_forward(task_layer_output, batch_length)  # [bsz*num_spans, ent]
-
-        batch_predict_lst = torch.split(batch_predict, (batch_length * (batch_length + 1) / 2).int().tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
-
-        # self.span_loss1 = self.take_multitask_loss([task_id] * bsz, batch_predict_lst, batch_target_lst, f1_meaner)
-        self.span_loss = self.take_loss(task_id, batch_predict, batch_target, f1_meaner=f1_meaner, bsz=bsz)  # loss按batch平均才能跟kl对齐
-        self.total_loss += self.span_loss
+        self.opt.zero_grad()
+        gumbel_gates, gumbel_graph = None, []
+        if self.args.use_task_embed and self.args.use_gumbel_softmax:  # 门只算一次 各micro-batch共用
+            if ep is None:
+                gumbel_gates, gumbel_graph = self.sample_gumbel_gates([task_id])
+            else:  # task_layer_forward3: 有ep时当前任务用确定性的门
+                gumbel_gates = {task_id: (self.task_embed[task_id] >= 0.).float()}
+                self.gate_tensor_lst[task_id] = gumbel_gates[task_id]
+        # 注意: dropout仍在每个micro-batch各自采样 所以开dropout时切分后的梯度与整batch只是同分布 不逐位相同
+        for micro_dct in self.split_micro_batches(inputs_dct):  # --micro_batch_budget 各micro-batch分别反向 梯度累加后只更新一次
+            micro_length = micro_dct['ori_seq_len']
+            with self.autocast():  # --amp 最大的[b,l,l,ent]打分在bf16/fp16下计算 loss中再转fp32
+                encoder_output = self.encoder_forward(micro_dct) #shape: [b,l,hid](32,40,768)
+
+                if ep is not None:
+                    task_layer_fn = lambda enc: self.task_layer_forward3(enc,
+                                                                         use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
+                                                                         gumbel_tasks=[task_id],
+                                                                         ep=ep, gumbel_gates=gumbel_gates)
+                else:
+                    task_layer_fn = lambda enc: self.task_layer_forward2(enc,
+                                                                         use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
+                                                                         gumbel_tasks=[task_id], gumbel_gates=gumbel_gates,
+                                                                         ) # shape:[2,32,ent,40,50]
+
+                batch_predict = self.span_head_forward(encoder_output, micro_length, task_layer_fn)  # [mb*num_spans, ent]
+
+            # 各micro-batch的loss都除以整batch的bsz 累加后与整batch一次计算相同
+            span_loss = self.take_loss(task_id, batch_predict, micro_dct['batch_span_tgt'], f1_meaner=f1_meaner, bsz=bsz)  # loss按batch平均才能跟kl对齐
+            micro_loss = span_loss
+            self.span_loss += span_loss.detach()
+
+            if self.args.use_distill and task_id > 0:
+                batch_target_distilled = micro_dct['batch_span_tgt_distilled']  # packed logits of last task model [sum num_spans, ofs_s]
+                if batch_target_distilled is None and getattr(self, 'teacher', None) is not None:  # --online_teacher
+                    batch_target_distilled = self.teacher_forward(micro_dct, task_id)
+                kl_loss = self.calc_kl_loss(batch_target_distilled, batch_predict, task_id,
+                                            NerExample.num_spans(micro_length, self.max_span_width), bsz=bsz)
+                micro_loss = micro_loss + kl_loss
+                self.kl_loss += kl_loss.detach()
+
+            self.grad_scaler.scale(micro_loss).backward()
+        self.backward_gumbel_gates(gumbel_graph)
+
+        self.total_loss = self.span_loss + self.kl_loss
         # self.total_loss += self.span_loss / (self.span_loss.detach() + 1e-7)
-
-        if self.args.use_distill and task_id > 0:
-            batch_predict_lst_need_distill = batch_predict_lst
-            self.kl_loss = self.calc_kl_loss(batch_target_lst_distilled, batch_predict_lst_need_distill, task_id)
-
-            self.total_loss += self.kl_loss
-            # self.total_loss += self.kl_loss / (self.kl_loss.detach() + 1e-7)
+        # self.total_loss += self.kl_loss / (self.kl_loss.detach() + 1e-7)
 
             # kl_coe = self.span_loss.detach() / (self.kl_loss.detach() + 1e-7)
             # self.kl_loss *= kl_coe
@@ -1355,7 +1613,9 @@ class SpanKL(NerModel):
             # self.total_loss += self.sparse_loss * sparse_coe
             # if self.ep and self.ep > 0:
             #     self.total_loss += self.sparse_loss * sparse_coe * 0.5
-            self.total_loss += self.sparse_loss * sparse_coe * 0.5
+            sparse_term = self.sparse_loss * sparse_coe * 0.5
+            self.grad_scaler.scale(sparse_term).backward()  # 与输入无关 在micro-batch之外只反向一次
+            self.total_loss += sparse_term.detach()
 
             # self-entropy loss
             # task_prob = torch.sigmoid(self.task_embed[task_id])
@@ -1381,28 +1641,8 @@ class SpanKL(NerModel):
         #         curr_task_gate = torch.sigmoid(self.task_embed[task_id])  # [emb_dim]  0~1 prob
         #     self.total_loss += self.sparse_loss / (self.sparse_loss.detach() + 1e-7)
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
-        # if task_id > 0:
-        #     ipdb.set_trace()
-
-        # ori_task_embed = copy.deepcopy(self.net.task_embed)
-        # ipdb.set_trace()
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
-        # if ep is not None:
-        #     if ep <= 6:
-        #         self.lrs.step()
-        #     else:
-        #         pass
-        if self.use_schedual:
-            self.lrs.step()
-        # self.curr_lr = self.lrs.get_last_lr()[0]
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        if step:
+            self.optimizer_step()
 
         return (float(self.total_loss),
                 float(self.span_loss),
@@ -1420,7 +1660,7 @@ class SpanKL(NerModel):
             loss = loss / bsz
         return loss
 
-    def observe_all(self, inputs_dct, f1_meaner, ep=None):
+    def observe_all(self, inputs_dct, f1_meaner, ep=None, step=True):
         batch_exm = inputs_dct['batch_ner_exm']
         batch_length = inputs_dct['ori_seq_len']
         batch_input_pts = inputs_dct['batch_input_pts']
@@ -1438,15 +1678,16 @@ class SpanKL(NerModel):
         self.kl_loss = 0.
         self.entropy_loss = 0.
 
-        encoder_output = self.encoder_forward(inputs_dct)
-        task_layer_output = self.task_layer_forward2(encoder_output,
-                                                     use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
-                                                     gumbel_tasks=list(range(self.num_tasks)),
-                                                     )
+        with self.autocast():  # --amp
+            encoder_output = self.encoder_forward(inputs_dct)
+            task_layer_fn = lambda enc: self.task_layer_forward2(enc,
+                                                                 use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
+                                                                 gumbel_tasks=list(range(self.num_tasks)),
+                                                                 )
 
-        batch_predict = self.span_matrix_forward(task_layer_output, batch_length)  # [bsz*num_spans, ent]
+            batch_predict = self.span_head_forward(encoder_output, batch_length, task_layer_fn)  # [bsz*num_spans, ent]
 
-        batch_predict_lst = torch.split(batch_predict, (batch_length * (batch_length + 1) / 2).int().tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
+        batch_predict_lst = torch.split(batch_predict, NerExample.num_spans(batch_length, self.max_span_width).tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
 
         self.span_loss = self.take_alltask_loss(batch_predict, batch_target, f1_meaner=f1_meaner, bsz=bsz)  # 这样loss不能按batch平均
         self.total_loss += self.span_loss
@@ -1464,19 +1705,7 @@ class SpanKL(NerModel):
             self.total_loss += self.sparse_loss
             # self.total_loss += self.sparse_loss / (self.sparse_loss.detach() + 1e-7)
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
-
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
-        if self.use_schedual:
-            self.lrs.step()
-        # self.curr_lr = self.lrs.get_last_lr()[0]
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        self.backward_and_step(step)
 
         return (float(self.total_loss),
                 float(self.span_loss),
@@ -1495,7 +1724,7 @@ class SpanKL(NerModel):
             loss = loss / bsz
         return loss
 
-    def observe_non_cl(self, inputs_dct, task_id, f1_meaner):
+    def observe_non_cl(self, inputs_dct, task_id, f1_meaner, step=True):
         batch_exm = inputs_dct['batch_ner_exm']
         batch_length = inputs_dct['ori_seq_len']
         batch_input_pts = inputs_dct['batch_input_pts']
@@ -1513,15 +1742,16 @@ class SpanKL(NerModel):
         self.kl_loss = 0.
         self.entropy_loss = 0.
 
-        encoder_output = self.encoder_forward(inputs_dct)
-        task_layer_output = self.task_layer_forward2(encoder_output,
-                                                     use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
-                                                     gumbel_tasks=list(range(self.num_tasks)),
-                                                     )
+        with self.autocast():  # --amp
+            encoder_output = self.encoder_forward(inputs_dct)
+            task_layer_fn = lambda enc: self.task_layer_forward2(enc,
+                                                                 use_task_embed=self.args.use_task_embed, use_gumbel_softmax=self.args.use_gumbel_softmax,
+                                                                 gumbel_tasks=list(range(self.num_tasks)),
+                                                                 )
 
-        batch_predict = self.span_matrix_forward(task_layer_output, batch_length)  # [bsz*num_spans, ent]
+            batch_predict = self.span_head_forward(encoder_output, batch_length, task_layer_fn)  # [bsz*num_spans, ent]
 
-        batch_predict_lst = torch.split(batch_predict, (batch_length * (batch_length + 1) / 2).int().tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
+        batch_predict_lst = torch.split(batch_predict, NerExample.num_spans(batch_length, self.max_span_width).tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent]
 
         self.span_loss = self.take_so_far_task_loss(task_id, batch_predict, batch_target, f1_meaner=f1_meaner, bsz=bsz)  # 这样loss不能按batch平均
         self.total_loss += self.span_loss
@@ -1539,19 +1769,7 @@ class SpanKL(NerModel):
             self.total_loss += self.sparse_loss
             # self.total_loss += self.sparse_loss / (self.sparse_loss.detach() + 1e-7)
 
-        self.opt.zero_grad()
-        self.total_loss.backward()
-
-        if self.grad_clip is None:
-            self.total_norm = 0
-        else:
-            self.total_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-
-        self.opt.step()
-        if self.use_schedual:
-            self.lrs.step()
-        # self.curr_lr = self.lrs.get_last_lr()[0]
-        self.curr_lr = self.opt.param_groups[0]['lr']
+        self.backward_and_step(step)
 
         return (float(self.total_loss),
                 float(self.span_loss),
@@ -1,4 +1,4 @@
-import sys, random, os
+import sys, random, os, copy
 from typing import *
 import ipdb
 import torch
@@ -8,7 +8,7 @@ import numpy as np
 
 import datautils as utils
 from datautils import NerExample
-from data_reader import NerDataReader
+from data_reader import NerDataReader, MmapExmList, JsonlExmList
 
 
 class SubsetSequentialSampler(Sampler[int]):
@@ -29,6 +29,277 @@ class SubsetSequentialSampler(Sampler[int]):
         return len(self.indices)
 
 
+class BucketBatchSampler(Sampler[List[int]]):
+    r"""Yields batches of indices grouped by similar length to reduce padding.
+    When shuffle, indices are permuted by `generator`, chunked into buckets of `batch_size * bucket_mult`,
+    sorted by length inside each bucket and batched, then the batch order is permuted by `generator` again.
+    Otherwise indices are sorted by length and batched sequentially.
+    Args:
+        indices (sequence): a sequence of indices
+        lengths (sequence): lengths[idx] is the length of example idx
+        batch_size (int): size of mini-batch
+        shuffle (bool): whether to shuffle
+        generator (Generator): Generator used in sampling.
+        bucket_mult (int): number of batches per bucket
+    """
+
+    def __init__(self, indices: Sequence[int], lengths: Sequence[int], batch_size: int,
+                 shuffle: bool = True, generator=None, bucket_mult: int = 50) -> None:
+        self.indices = indices
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.bucket_size = batch_size * bucket_mult
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if not self.shuffle:
+            sorted_indices = sorted(self.indices, key=lambda i: self.lengths[i])
+            for i in range(0, len(sorted_indices), self.batch_size):
+                yield sorted_indices[i: i + self.batch_size]
+            return
+        perm_indices = [self.indices[i] for i in torch.randperm(len(self.indices), generator=self.generator)]
+        batches = []
+        for b in range(0, len(perm_indices), self.bucket_size):
+            bucket = sorted(perm_indices[b: b + self.bucket_size], key=lambda i: self.lengths[i])
+            batches.extend(bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i]
+
+    def __len__(self) -> int:
+        if not self.shuffle:
+            return (len(self.indices) + self.batch_size - 1) // self.batch_size
+        num_batches = 0
+        for b in range(0, len(self.indices), self.bucket_size):
+            num_batches += (min(self.bucket_size, len(self.indices) - b) + self.batch_size - 1) // self.batch_size
+        return num_batches
+
+
+class SpanBudgetBatchSampler(Sampler[List[int]]):
+    r"""Yields batches of indices whose padded span cost `b * num_spans(maxL) * num_ents` fits in `span_budget`.
+    Indices are sorted by length (inside buckets of `bucket_size` when shuffle) and packed greedily,
+    an example exceeding the budget alone forms its own batch. The number of batches differs per epoch,
+    so the batches of each epoch are planned (once, cached) by a generator seeded with `seed + epoch`,
+    which makes `__len__` and `num_batches` exact for the LR schedule.
+    `__len__` is the number of batches of the current epoch (the one being iterated, or the next one before any).
+    Args:
+        indices (sequence): a sequence of indices
+        lengths (sequence): lengths[idx] is the length of example idx
+        span_budget (int): max padded span cost of a batch
+        num_ents (int): number of entity types (the last dim of span logits)
+        shuffle (bool): whether to shuffle
+        generator (Generator): Generator used to draw the seed.
+        bucket_size (int): number of examples per bucket
+        max_span_width (int): spans per example is `NerExample.num_spans(L, max_span_width)`, all L(L+1)/2 spans if None
+    """
+
+    def __init__(self, indices: Sequence[int], lengths: Sequence[int], span_budget: int, num_ents: int,
+                 shuffle: bool = True, generator=None, bucket_size: int = 2000, max_span_width=None) -> None:
+        self.indices = indices
+        self.lengths = lengths
+        self.span_budget = span_budget
+        self.num_ents = num_ents
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.max_span_width = max_span_width
+        self.seed = int(torch.randint(2 ** 31, (1,), generator=generator).item()) if shuffle else 0
+        self.epoch = 0  # 当前(正在迭代的)epoch
+        self.next_epoch = 0  # 下次__iter__的epoch
+        self.plans = {}  # epoch -> batches
+
+    def pack(self, sorted_indices):
+        batches, batch = [], []
+        for idx in sorted_indices:  # sorted by length, the last one is the max length
+            length = self.lengths[idx]
+            if batch and (len(batch) + 1) * NerExample.num_spans(length, self.max_span_width) * self.num_ents > self.span_budget:
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def plan(self, epoch):
+        """ batches of the given epoch (cached) """
+        if epoch not in self.plans:
+            self.plans[epoch] = self._plan(epoch)
+        return self.plans[epoch]
+
+    def _plan(self, epoch):
+        if not self.shuffle:
+            return self.pack(sorted(self.indices, key=lambda i: self.lengths[i]))
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        perm_indices = [self.indices[i] for i in torch.randperm(len(self.indices), generator=g)]
+        batches = []
+        for b in range(0, len(perm_indices), self.bucket_size):
+            batches.extend(self.pack(sorted(perm_indices[b: b + self.bucket_size], key=lambda i: self.lengths[i])))
+        return [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        self.epoch = self.next_epoch
+        self.next_epoch += 1
+        for ep in [ep for ep in self.plans if ep < self.epoch]:  # 丢弃已经过去的epoch
+            del self.plans[ep]
+        return iter(self.plan(self.epoch))
+
+    def __len__(self) -> int:
+        return len(self.plan(self.epoch))
+
+    def num_batches(self, num_epochs):
+        """ total batches of the next num_epochs epochs """
+        return sum(len(self.plan(self.next_epoch + ep)) for ep in range(num_epochs))
+
+
+class LazyExms(Sequence):
+    r"""Lightweight `batch_ner_exm`: only the example indices of the batch, `instances[i]` is looked up on access.
+    Training only needs len() of it, so JsonlExmList/MmapExmList examples are not re-parsed / re-instantiated
+    on the main process (nor churn the LRU) unless eval/distill actually reads them.
+    Indexing with a list of indices gives a LazyExms of that subset (select_micro_batch).
+    """
+
+    def __init__(self, instances, exm_ids):
+        self.instances = instances
+        self.exm_ids = list(exm_ids)
+
+    def __len__(self):
+        return len(self.exm_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyExms(self.instances, self.exm_ids[i])
+        if isinstance(i, list):
+            return LazyExms(self.instances, [self.exm_ids[j] for j in i])
+        return self.instances[self.exm_ids[i]]
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(exm, memo) for exm in self]  # 复制样本 不复制instances
+
+    def __repr__(self):
+        return f'<LazyExms> {self.exm_ids}'
+
+
+class DevicePrefetcher:
+    r"""Wraps a DataLoader yielding CPU batches and moves the tensors of the next batch to `device`
+    on a side cuda stream while the current batch is consumed.
+    `batch_ner_exm` is replaced by LazyExms handles of the main process instances via `batch_exm_idx`,
+    since with num_workers > 0 they are pickled copies (e.g. distilled preds must be set on the originals).
+    Other attributes (dataset, batch_size, batch_sampler, ...) are forwarded to the DataLoader.
+    Args:
+        dataloader (DataLoader): dataloader with a device-agnostic collate_fn
+        device (torch.device): target device, default the current cuda device (cpu if cuda is not available)
+    """
+
+    split_of = {'batch_span_tgt_lst': 'batch_span_tgt',  # list of [num_spans, ent] -> cat of them
+                'batch_span_tgt_lst_distilled': 'batch_span_tgt_distilled'}
+
+    def __init__(self, dataloader, device=None):
+        self.dataloader = dataloader
+        self.device = device
+
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, batch, device, stream=None):
+        def move(v):
+            if isinstance(v, torch.Tensor):
+                return v.to(device, non_blocking=True)
+            if isinstance(v, list) and v and isinstance(v[0], torch.Tensor):
+                return [t.to(device, non_blocking=True) for t in v]
+            return v
+
+        def move_batch():
+            moved = {}
+            for k, v in batch.items():
+                if k in self.split_of and isinstance(batch.get(self.split_of[k]), torch.Tensor) and v:
+                    continue  # 是拼接后tensor的切分, 搬运拼接的tensor后再切分 避免重复拷贝
+                moved[k] = move(v)
+            for k, cat_k in self.split_of.items():
+                if k in batch and k not in moved:
+                    moved[k] = list(torch.split(moved[cat_k], [t.shape[0] for t in batch[k]]))
+            return moved
+
+        if stream is None:
+            batch = move_batch()
+        else:
+            with torch.cuda.stream(stream):
+                batch = move_batch()
+        if 'batch_exm_idx' in batch:
+            batch['batch_ner_exm'] = LazyExms(self.dataloader.dataset.instances, batch['batch_exm_idx'])
+        return batch
+
+    def __iter__(self):
+        device = self.device
+        if device is None:
+            device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+        stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        iterator = iter(self.dataloader)
+        next_batch = next(iterator, None)
+        if next_batch is not None:
+            next_batch = self.to_device(next_batch, device, stream)
+        while next_batch is not None:
+            batch = next_batch
+            if stream is not None:
+                torch.cuda.current_stream(device).wait_stream(stream)
+                for v in batch.values():  # 在side stream上分配的显存 要告知caching allocator其在主stream上使用
+                    for t in (v if isinstance(v, list) else [v]):
+                        if isinstance(t, torch.Tensor):
+                            t.record_stream(torch.cuda.current_stream(device))
+            next_batch = next(iterator, None)
+            if next_batch is not None:
+                next_batch = self.to_device(next_batch, device, stream)
+            yield batch
+
+
+def calc_num_training_steps(dataloader, num_epochs):
+    """ 总训练步数 span_budget时每个epoch的步数不同 """
+    if hasattr(dataloader.batch_sampler, 'num_batches'):
+        return dataloader.batch_sampler.num_batches(num_epochs)
+    return len(dataloader) * num_epochs
+
+
+def calc_padding_waste(batches, lengths, max_span_width=None):
+    """ 统计一轮batch的padding浪费比例
+        token: 1 - sum(L) / sum(b * maxL)
+        span: 1 - sum(L(L+1)/2) / sum(b * maxL * maxL) 对应span_matrix_forward中[b,l,l,e]的有效部分
+              带状时为 1 - sum(num_spans(L, W)) / sum(b * maxL * min(maxL, W))
+    """
+    num_tok, num_tok_padded, num_span, num_span_padded = 0, 0, 0, 0
+    for batch in batches:
+        lens = [lengths[i] for i in batch]
+        max_len = max(lens)
+        num_tok += sum(lens)
+        num_tok_padded += max_len * len(lens)
+        num_span += sum(NerExample.num_spans(l, max_span_width) for l in lens)
+        num_span_padded += max_len * (max_len if max_span_width is None else min(max_len, max_span_width)) * len(lens)
+    if num_tok_padded == 0:
+        return 0., 0.
+    return 1. - num_tok / num_tok_padded, 1. - num_span / num_span_padded
+
+
+def count_out_of_band_ents(exm_lst, max_span_width):
+    """ 宽度超过max_span_width(不在带状span布局内)的gold实体数 return (num_out, num_total)
+        MmapExmList直接在ent_spans上统计; JsonlExmList需解析全部样本 不统计返回None """
+    if isinstance(exm_lst, JsonlExmList):
+        return None
+    if isinstance(exm_lst, MmapExmList):
+        ent_spans = exm_lst.ent_spans
+        if exm_lst.keep_ent_types is not None:
+            keep_tids = [t for t, ent in enumerate(exm_lst.ent_types) if ent in exm_lst.keep_ent_types]
+            ent_spans = ent_spans[np.isin(ent_spans[:, 2], keep_tids)]
+        return int(np.sum(ent_spans[:, 1] - ent_spans[:, 0] > max_span_width)), len(ent_spans)
+    num_out, num_total = 0, 0
+    for exm in exm_lst:
+        for pos_lst in exm.ent_dct.values():
+            for start, end, *_ in pos_lst:
+                num_out += end - start > max_span_width
+                num_total += 1
+    return num_out, num_total
+
+
 # curr_dir = os.path.dirname(__file__)
 # parent_dir = os.path.dirname(curr_dir)
 data_dir = 'data/'
@@ -129,7 +400,9 @@ class CL_Loader:
             print('id2ent', self.datareader.id2ent)  # 打印ID到实体的映射
             print('tid2entids', self.tid2entids)  # 打印任务ID到实体ID的映射
 
-    def init_data(self, datafiles=None, setup=None, bsz=14, test_bsz=64, arch='span', use_pt=False, gpu=True, quick_test=False):
+    def init_data(self, datafiles=None, setup=None, bsz=14, test_bsz=64, arch='span', use_pt=False, gpu=True, quick_test=False,
+                  bucket_batch=False, span_budget=None, num_workers=0, prefetch_factor=2, use_exm_cache=False,
+                  tokenize_num_proc=0, lazy_jsonl=False, lazy_cache_size=10000, max_span_width=None):
         self.task_train_generator = torch.Generator()  # make sure no affect by model_init (teacher model) i.e. non_cl_task0 = cl_task0
         # to make sure it's the same e.g. train single task 6 above task 5 = train task 1-6  # 要先蒸馏消耗g 再训练也消耗g
         # self.task_train_generators = [torch.Generator() for _ in range(self.num_tasks)]
@@ -141,6 +414,17 @@ class CL_Loader:
         self.test_bsz = test_bsz # test batch size
         self.arch = arch # span or base
         self.gpu = gpu
+        self.bucket_batch = bucket_batch  # group examples of similar ori_len into a batch to reduce padding
+        self.span_budget = span_budget  # train batch filled until b*ori_len*(ori_len+1)/2*num_ents reach it, instead of bsz
+        self.num_workers = num_workers  # collate in DataLoader workers, batches moved to gpu by DevicePrefetcher
+        self.prefetch_factor = prefetch_factor
+        self.worker_generator = torch.Generator()  # base_seed of workers drawn from it rather than the global rng
+        self.use_exm_cache = use_exm_cache  # load examples from the compiled mmap cache (compiled at the first run)
+        self.tokenize_num_proc = tokenize_num_proc  # parse jsonl and bert tokenize in a process pool when > 0
+        self.lazy_jsonl = lazy_jsonl  # only parse the lines requested by samplers, via the line offset index next to the jsonl
+        self.lazy_cache_size = lazy_cache_size  # LRU size of parsed examples when lazy_jsonl
+        self.use_pt = use_pt  # feature_based: encoder features read lazily from the mmap feature store next to each jsonl
+        self.max_span_width = max_span_width  # banded span layout, only spans of width <= max_span_width are targets
         if setup is None:
             setup = self.setup
         else:
@@ -151,55 +435,122 @@ class CL_Loader:
         if not quick_test:
             """train"""
             self.train_exm_lst, self.train_tid2exmids = self.load_data_with_taskid(data_dir + datafiles['train'],
-                                                                                   setup=setup, use_pt=use_pt)
+                                                                                   setup=setup)
 
         """dev"""
         self.dev_exm_lst, self.dev_tid2exmids = self.load_data_with_taskid(data_dir + datafiles['dev'],
-                                                                           setup=setup, use_pt=use_pt)
+                                                                           setup=setup)
         if quick_test:
             self.train_exm_lst = self.dev_exm_lst
             self.train_tid2exmids = self.dev_tid2exmids
+        self.split_files = {'train': data_dir + datafiles['dev' if quick_test else 'train'],
+                            'dev': data_dir + datafiles['dev'], 'test': data_dir + datafiles['test']}  # 特征库按源文件存放
 
         """test"""  # for Test Filter
         self.test_exm_lst, self.test_tid2exmids = self.load_data_with_taskid(data_dir + datafiles['test'],
-                                                                             setup='filter', use_pt=use_pt)
+                                                                             setup='filter')
 
         self.num_train = len(self.train_exm_lst)
         self.num_dev = len(self.dev_exm_lst)
         self.num_test = len(self.test_exm_lst)
-
-        self.train_dataset = self.datareader.build_dataset(self.train_exm_lst, arch=self.arch, loss_type='sigmoid')
-        self.dev_dataset = self.datareader.build_dataset(self.dev_exm_lst, arch=self.arch, loss_type='sigmoid')
-        self.test_dataset = self.datareader.build_dataset(self.test_exm_lst, arch=self.arch, loss_type='sigmoid')
+        if self.max_span_width is not None:
+            self.report_out_of_band_ents()
+
+        self.train_dataset = self.datareader.build_dataset(self.train_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                           num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        self.dev_dataset = self.datareader.build_dataset(self.dev_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                         num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        self.test_dataset = self.datareader.build_dataset(self.test_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                          num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        if self.use_pt:
+            self.attach_feature_stores()
         # fewnerd self.test_dateset - 1 because 1 of test_exm_lst have max_len>510
         self.init_dataloaders()
 
+    def build_dataloader(self, dataset, exmids, batch_size, shuffle=False):
+        """ random(train) or sequential(dev/test) dataloader over exmids,
+            train batches packed by self.span_budget if set, bucketed by ori_len if self.bucket_batch """
+        if shuffle and getattr(self, 'span_budget', None):
+            lengths = dataset.get_lengths()
+            batch_sampler = SpanBudgetBatchSampler(exmids, lengths, self.span_budget, len(self.ent2id),
+                                                   shuffle=True, generator=self.task_train_generator,
+                                                   max_span_width=self.max_span_width)
+            return self.new_dataloader(dataset, batch_sampler=batch_sampler)
+        if getattr(self, 'bucket_batch', False):
+            lengths = dataset.get_lengths()
+            batch_sampler = BucketBatchSampler(exmids, lengths, batch_size, shuffle=shuffle,
+                                               generator=self.task_train_generator if shuffle else None)
+            return self.new_dataloader(dataset, batch_sampler=batch_sampler)
+        if shuffle:
+            sampler = SubsetRandomSampler(exmids, generator=self.task_train_generator)
+        else:
+            sampler = SubsetSequentialSampler(exmids)
+        return self.new_dataloader(dataset, batch_size=batch_size, sampler=sampler)
+
+    def new_dataloader(self, dataset, **kwargs):
+        """ DataLoader with cpu collate (in workers if num_workers > 0), wrapped by DevicePrefetcher to gpu or cpu
+            the samplers run in the main process, so task_train_generator is consumed the same as num_workers=0 """
+        num_workers = getattr(self, 'num_workers', 0)
+        if num_workers > 0:
+            kwargs.update(num_workers=num_workers, prefetch_factor=self.prefetch_factor, generator=self.worker_generator)
+        dataloader = torch.utils.data.DataLoader(dataset, collate_fn=self.datareader.get_batcher_fn(arch=self.arch),
+                                                 pin_memory=self.gpu and torch.cuda.is_available(), **kwargs)
+        return DevicePrefetcher(dataloader, device=None if self.gpu else torch.device('cpu'))
+
+    def padding_waste(self, dataloader):
+        """ padding waste ratio (token, span) of one epoch, without consuming task_train_generator """
+        lengths = dataloader.dataset.get_lengths()
+        if isinstance(dataloader.batch_sampler, SpanBudgetBatchSampler):
+            batches = dataloader.batch_sampler.plan(dataloader.batch_sampler.next_epoch)
+        else:
+            g_state = self.task_train_generator.get_state()
+            batches = list(dataloader.batch_sampler)
+            self.task_train_generator.set_state(g_state)
+        return calc_padding_waste(batches, lengths, max_span_width=getattr(self, 'max_span_width', None))
+
+    def attach_feature_stores(self):
+        """ feature_based: 各数据集按样本下标从mmap特征库读取编码器特征
+            特征库不存在时由冻结的编码器按batch抽取, 有旧的{jsonl}.pt时直接转换 """
+        self.datareader.args.pretrain_mode = 'feature_based'  # batcher组装batch_input_pts
+        for split, dataset in [('train', self.train_dataset), ('dev', self.dev_dataset), ('test', self.test_dataset)]:
+            jsonl_file = self.split_files[split]
+            feature_store = self.datareader.load_feature_store(jsonl_file, self.bert_model_dir)
+            if feature_store is None:
+                if os.path.exists(f'{jsonl_file}.pt'):
+                    self.datareader.convert_pt_to_feature_store(f'{jsonl_file}.pt', jsonl_file, self.bert_model_dir)
+                else:
+                    self.datareader.extract_features(dataset, jsonl_file, self.bert_model_dir,
+                                                     device=torch.device('cuda' if self.gpu else 'cpu'))
+                feature_store = self.datareader.load_feature_store(jsonl_file, self.bert_model_dir)
+            assert len(feature_store) == len(dataset)
+            dataset.feature_store = feature_store
+            print(f'{split}: encoder features from {feature_store.feature_dir}')
+
+    def report_out_of_band_ents(self):
+        """ 打印各数据集中宽度超过max_span_width的gold实体数 这些实体在带状span布局下不会被预测 """
+        for split, exm_lst in [('train', self.train_exm_lst), ('dev', self.dev_exm_lst), ('test', self.test_exm_lst)]:
+            res = count_out_of_band_ents(exm_lst, self.max_span_width)
+            if res is None:
+                print(f'{split}: out-of-band entity count skipped for lazy jsonl')
+                continue
+            num_out, num_total = res
+            print(f'{split}: {num_out}/{num_total} ({num_out / max(num_total, 1):.2%}) gold entities wider than max_span_width={self.max_span_width}')
+
     def init_dataloaders(self):
         """ initialize dataloaders for CL"""
         setup = self.setup
-        gpu = self.gpu
         self.train_tasks_dataloaders = []  # CL Train Split or Filter
         for tid in range(self.num_tasks):
             exmids = sorted(self.train_tid2exmids[tid])
-            print(f'task_id {tid} have {len(exmids)} train examples')
-            dataloader = torch.utils.data.DataLoader(self.train_dataset,
-                                                     batch_size=self.bsz,
-                                                     sampler=SubsetRandomSampler(exmids,
-                                                                                 generator=self.task_train_generator
-                                                                                 ),
-                                                     collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                     )
+            dataloader = self.build_dataloader(self.train_dataset, exmids, self.bsz, shuffle=True)
+            print(f'task_id {tid} have {len(exmids)} train examples, padding waste token:{{:.2%}} span:{{:.2%}}'.format(*self.padding_waste(dataloader)))
             self.train_tasks_dataloaders.append(dataloader)
 
         self.dev_tasks_dataloaders = []  # CL Dev Split or Filter
         for tid in range(self.num_tasks):
             exmids = sorted(self.dev_tid2exmids[tid])
-            print(f'task_id {tid} have {len(exmids)} dev examples')
-            dataloader = torch.utils.data.DataLoader(self.dev_dataset,
-                                                     batch_size=self.test_bsz,
-                                                     sampler=SubsetSequentialSampler(exmids),
-                                                     collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                     )
+            dataloader = self.build_dataloader(self.dev_dataset, exmids, self.test_bsz)
+            print(f'task_id {tid} have {len(exmids)} dev examples, padding waste token:{{:.2%}} span:{{:.2%}}'.format(*self.padding_waste(dataloader)))
             self.dev_tasks_dataloaders.append(dataloader)  # CL
 
         self.test_tasks_dataloaders_filtered = []  # Test Filter
@@ -209,33 +560,23 @@ class CL_Loader:
                 so_far_exmids.update(self.test_tid2exmids[i])
             so_far_exmids = sorted(so_far_exmids)
             print(f'task_id {tid} have {len(so_far_exmids)} test filtered examples')
-            dataloader = torch.utils.data.DataLoader(self.test_dataset,
-                                                     batch_size=self.test_bsz,
-                                                     sampler=SubsetSequentialSampler(so_far_exmids),
-                                                     collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                     )
+            dataloader = self.build_dataloader(self.test_dataset, so_far_exmids, self.test_bsz)
             self.test_tasks_dataloaders_filtered.append(dataloader)
 
-        print(f'total {len(self.test_dataset)} test examples:')
-        self.test_dataloader = torch.utils.data.DataLoader(self.test_dataset,  # Test All
-                                                           batch_size=self.test_bsz,
-                                                           shuffle=False,
-                                                           collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                           )
+        self.test_dataloader = self.build_dataloader(self.test_dataset, list(range(len(self.test_dataset))), self.test_bsz)  # Test All
+        print(f'total {len(self.test_dataset)} test examples, padding waste token:{{:.2%}} span:{{:.2%}}'.format(*self.padding_waste(self.test_dataloader)))
 
         # experimental all tasks
-        self.train_alltask_dataloader = torch.utils.data.DataLoader(self.train_dataset,
-                                                                    batch_size=self.bsz,
-                                                                    shuffle=True,
-                                                                    collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                                    # generator=self.task_train_generators[0]
-                                                                    )
+        self.train_alltask_dataloader = self.new_dataloader(self.train_dataset,
+                                                            batch_size=self.bsz,
+                                                            shuffle=True,
+                                                            # generator=self.task_train_generators[0]
+                                                            )
         # experimental all tasks
-        self.dev_alltask_dataloader = torch.utils.data.DataLoader(self.dev_dataset,
-                                                                  batch_size=self.test_bsz,
-                                                                  shuffle=False,
-                                                                  collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                                  )
+        self.dev_alltask_dataloader = self.new_dataloader(self.dev_dataset,
+                                                          batch_size=self.test_bsz,
+                                                          shuffle=False,
+                                                          )
 
         # non_CL Train
         self.so_far_train_tasks_dataloaders = [self.train_tasks_dataloaders[0]]  # need the first NonCL one align with CL first one 要第一个相当于与CL的对齐
@@ -245,13 +586,7 @@ class CL_Loader:
                 so_far_exmids.update(self.train_tid2exmids[i])
             so_far_exmids = sorted(so_far_exmids)
             print(f'non_cl task_id {tid} have {len(so_far_exmids)} train examples')
-            dataloader = torch.utils.data.DataLoader(self.train_dataset,
-                                                     batch_size=self.bsz,
-                                                     sampler=SubsetRandomSampler(so_far_exmids,
-                                                                                 generator=self.task_train_generator
-                                                                                 ),
-                                                     collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                     )
+            dataloader = self.build_dataloader(self.train_dataset, so_far_exmids, self.bsz, shuffle=True)
             self.so_far_train_tasks_dataloaders.append(dataloader)
         # non_CL Dev
         self.so_far_dev_tasks_dataloaders = [self.dev_tasks_dataloaders[0]]
@@ -261,11 +596,7 @@ class CL_Loader:
                 so_far_exmids.update(self.dev_tid2exmids[i])
             so_far_exmids = sorted(so_far_exmids)
             print(f'non_cl task_id {tid} have {len(so_far_exmids)} dev examples')
-            dataloader = torch.utils.data.DataLoader(self.dev_dataset,
-                                                     batch_size=self.bsz,
-                                                     sampler=SubsetSequentialSampler(so_far_exmids),
-                                                     collate_fn=self.datareader.get_batcher_fn(gpu=gpu, arch=self.arch),
-                                                     )
+            dataloader = self.build_dataloader(self.dev_dataset, so_far_exmids, self.bsz)
             self.so_far_dev_tasks_dataloaders.append(dataloader)
         print(f'initialize CL dataloaders success, setup: {setup}')
 
@@ -282,9 +613,14 @@ class CL_Loader:
 
         self.entity_lst = sum(self.entity_task_lst, [])
         self.datareader = NerDataReader(self.bert_model_dir, self.max_len, ent_file_or_ent_lst=self.entity_lst)
-        self.train_dataset = self.datareader.build_dataset(self.train_exm_lst, arch=self.arch, loss_type='sigmoid')
-        self.dev_dataset = self.datareader.build_dataset(self.dev_exm_lst, arch=self.arch, loss_type='sigmoid')
-        self.test_dataset = self.datareader.build_dataset(self.test_exm_lst, arch=self.arch, loss_type='sigmoid')
+        self.train_dataset = self.datareader.build_dataset(self.train_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                           num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        self.dev_dataset = self.datareader.build_dataset(self.dev_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                         num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        self.test_dataset = self.datareader.build_dataset(self.test_exm_lst, arch=self.arch, loss_type='sigmoid',
+                                                          num_proc=self.tokenize_num_proc, max_span_width=self.max_span_width)
+        if getattr(self, 'use_pt', False):
+            self.attach_feature_stores()
         self.ent2id = self.datareader.ent2id
         self.tid2entids = {tid: [self.ent2id[ent] for ent in ents] for tid, ents in self.tid2ents.items()}
         self.tid2offset = {tid: [min(entids), max(entids) + 1] for tid, entids in self.tid2entids.items()}
@@ -310,14 +646,35 @@ class CL_Loader:
         self.test_tid2exmids = perm_tid2emxids
         self.init_dataloaders()
 
-    def load_data_with_taskid(self, exm_file, setup='split', split_seed=None, use_pt=False):
+    def load_exm_lst(self, jsonl_file, external_attrs):
+        """ NerExample.load_from_jsonl, or MmapExmList from the compiled cache if self.use_exm_cache,
+            or JsonlExmList reading lines on demand by the offset index if self.lazy_jsonl """
+        if getattr(self, 'use_exm_cache', False):
+            exm_lst = self.datareader.load_exm_cache(jsonl_file, keep_ent_types=self.entity_lst)
+            if exm_lst is not None:
+                print(f'{jsonl_file} loaded from compiled cache')
+                return exm_lst
+        elif getattr(self, 'lazy_jsonl', False):
+            return self.datareader.load_jsonl_lazily(jsonl_file, keep_ent_types=self.entity_lst, external_attrs=external_attrs,
+                                                     cache_size=self.lazy_cache_size)
+        exm_lst = NerExample.load_from_jsonl(jsonl_file, token_deli=' ', external_attrs=external_attrs,
+                                             num_proc=self.tokenize_num_proc)
+        if getattr(self, 'use_exm_cache', False):
+            self.datareader.compile_exm_cache(exm_lst, jsonl_file, num_proc=self.tokenize_num_proc)  # 实体未过滤 过滤在加载时进行
+        return exm_lst
+
+    def load_data_with_taskid(self, exm_file, setup='split', split_seed=None):
         tid2exmids = {tid: set() for tid in range(self.num_tasks)} # task_id to exm_ids
         if setup == 'filter':  # task contain all exm with the required entities, non negative
-            exm_lst = NerExample.load_from_jsonl(exm_file, token_deli=' ',
-                                                 external_attrs=['bert_tok_char_lst', 'ori_2_tok'])
-            for exmid, exm in enumerate(exm_lst):
-                exm.remove_ent_by_type(self.entity_lst, input_keep=True)
-                for ent in exm.ent_dct: # 没有实体就不会添加到tid2exmids
+            exm_lst = self.load_exm_lst(exm_file, external_attrs=['bert_tok_char_lst', 'ori_2_tok'])
+            for exmid in range(len(exm_lst)):
+                if isinstance(exm_lst, (MmapExmList, JsonlExmList)):  # 实例化时才过滤实体
+                    ent_types = exm_lst.ent_type_lst(exmid)
+                else:
+                    exm = exm_lst[exmid]
+                    exm.remove_ent_by_type(self.entity_lst, input_keep=True)
+                    ent_types = exm.ent_dct
+                for ent in ent_types: # 没有实体就不会添加到tid2exmids
                     tid2exmids[self.ent2tid[ent]].add(exmid)
 
         elif setup == 'split':  # task contain a set of exm and only contain the required entities, have negative
@@ -327,11 +684,11 @@ class CL_Loader:
             # Compare to train.jsonl, train_task.jsonl contain task_id as attr per exm by split
             task_emx_file = exm_file.replace('.jsonl', '_task.jsonl')
             if os.path.exists(task_emx_file):
-                exm_lst = NerExample.load_from_jsonl(task_emx_file, token_deli=' ',
-                                                     external_attrs=['task_id', 'bert_tok_char_lst', 'ori_2_tok']) # 返回一个NerExample列表，每个NerExample包含text、tag、entity_dict等
+                exm_lst = self.load_exm_lst(task_emx_file, external_attrs=['task_id', 'bert_tok_char_lst', 'ori_2_tok']) # 返回一个NerExample列表，每个NerExample包含text、tag、entity_dict等
             else:
                 exm_lst = NerExample.load_from_jsonl(exm_file, token_deli=' ',
-                                                     external_attrs=['bert_tok_char_lst', 'ori_2_tok'])
+                                                     external_attrs=['bert_tok_char_lst', 'ori_2_tok'],
+                                                     num_proc=self.tokenize_num_proc)
 
                 num_data = len(exm_lst)
                 data_order = list(range(num_data))
@@ -356,20 +713,16 @@ class CL_Loader:
                 NerExample.save_to_jsonl(exm_lst, task_emx_file,
                                          external_attrs=['task_id', 'bert_tok_char_lst', 'ori_2_tok'])
 
-            for exmid, exm in enumerate(exm_lst):
-                tid2exmids[exm.task_id].add(exmid)
+            if isinstance(exm_lst, (MmapExmList, JsonlExmList)):
+                for exmid, task_id in enumerate(exm_lst.task_id.tolist()):
+                    tid2exmids[task_id].add(exmid)
+            else:
+                for exmid, exm in enumerate(exm_lst):
+                    tid2exmids[exm.task_id].add(exmid)
 
         else:
             raise NotImplementedError
 
-        if use_pt:
-            print(f'{exm_file}.pt loading...')
-            pt_lst = torch.load(f'{exm_file}.pt')
-            print(f'{exm_file}.pt loaded!')
-            assert len(exm_lst) == len(pt_lst)
-            for exm, pt in zip(exm_lst, pt_lst):
-                exm.pt = pt
-
         return exm_lst, tid2exmids
 
     def get_task_dataloader(self, mode='test', tid=None, ent=None):
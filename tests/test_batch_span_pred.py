@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from datautils import NerExample, BatchSpanPred
+
+ID2ENT = {0: 'ORG', 1: 'PER', 2: 'LOC', 3: 'MISC'}
+
+
+def loop_decode(span_prob, length, id2ent, threshold=0.5, max_width=None):
+    """ 旧from_span_level_ner_tgt_lst_sigmoid: 逐命中查(start, end)表 (max_width时表为带状) """
+    span_index_lst = [(i, j) for i in range(length) for j in range(i, length) if max_width is None or j - i < max_width]
+    pred_ent_dct = {}
+    for span_idx, ent_id in zip(*np.where(span_prob >= threshold)):
+        start, end = span_index_lst[span_idx]
+        pred_ent_dct.setdefault(id2ent[ent_id], []).append([int(start), int(end) + 1, float(span_prob[span_idx, ent_id])])
+    return pred_ent_dct
+
+
+def random_batch_prob(lengths, max_width=None, seed=0):
+    rng = np.random.RandomState(seed)
+    batch_prob = rng.rand(int(NerExample.num_spans(np.array(lengths), max_width).sum()), len(ID2ENT)).astype('float32')
+    return batch_prob ** 4  # 大部分低于阈值
+
+
+class TestBatchSpanPred(unittest.TestCase):
+    """ 整batch的阈值解码BatchSpanPred 与逐样本逐span的旧解码结果一致 """
+
+    lengths = [7, 1, 12, 3, 9]
+
+    def check(self, max_width, threshold=0.5):
+        batch_prob = random_batch_prob(self.lengths, max_width)
+        span_ofs = np.concatenate([[0], np.cumsum(NerExample.num_spans(np.array(self.lengths), max_width))])
+        batch_pred = BatchSpanPred.from_prob(batch_prob, self.lengths, threshold=threshold, max_width=max_width)
+        self.assertEqual(len(batch_pred), len(self.lengths))
+        ent_dct_lst = batch_pred.ent_dct_lst(ID2ENT)
+        for bdx, length in enumerate(self.lengths):
+            span_prob = batch_prob[span_ofs[bdx]: span_ofs[bdx + 1]]
+            expected = loop_decode(span_prob, length, ID2ENT, threshold, max_width)
+            self.assertEqual(ent_dct_lst[bdx], expected)
+            self.assertEqual(batch_pred.ent_dct(bdx, ID2ENT), expected)
+            self.assertEqual(NerExample.from_span_level_ner_tgt_lst_sigmoid(span_prob, length, ID2ENT, threshold, max_width=max_width), expected)
+
+    def test_upper_triangle(self):
+        self.check(None)
+
+    def test_banded(self):
+        self.check(1)
+        self.check(4)
+
+    def test_no_hits(self):
+        batch_pred = BatchSpanPred.from_prob(np.zeros([int(NerExample.num_spans(np.array(self.lengths)).sum()), 4]), self.lengths)
+        self.assertEqual(batch_pred.ent_dct_lst(ID2ENT), [{}] * len(self.lengths))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+import torch
+
+import modules
+from datautils import NerExample
+from test_batch_span_pred import ID2ENT, loop_decode, random_batch_prob
+
+
+class TestDecodeSpanSigmoid(unittest.TestCase):
+    """ decode_span_sigmoid在tensor上阈值化 与逐样本的旧解码一致 (包括只算了部分实体头时的ent_offset) """
+
+    lengths = [5, 11, 2, 8]
+
+    def check(self, max_width):
+        batch_prob = random_batch_prob(self.lengths, max_width, seed=1)
+        span_ofs = np.concatenate([[0], np.cumsum(NerExample.num_spans(np.array(self.lengths), max_width))])
+        seq_len = torch.tensor(self.lengths)
+        ent_dct_lst = modules.decode_span_sigmoid(torch.from_numpy(batch_prob), seq_len, max_width=max_width).ent_dct_lst(ID2ENT)
+        offset_dct_lst = modules.decode_span_sigmoid(torch.from_numpy(batch_prob[:, 2:]), seq_len, max_width=max_width,
+                                                     ent_offset=2).ent_dct_lst(ID2ENT)
+        for bdx, length in enumerate(self.lengths):
+            span_prob = batch_prob[span_ofs[bdx]: span_ofs[bdx + 1]]
+            self.assertEqual(ent_dct_lst[bdx], loop_decode(span_prob, length, ID2ENT, max_width=max_width))
+            expected = {ent: v for ent, v in loop_decode(span_prob, length, ID2ENT, max_width=max_width).items() if ent in ['LOC', 'MISC']}
+            self.assertEqual(offset_dct_lst[bdx], expected)
+
+    def test_upper_triangle(self):
+        self.check(None)
+
+    def test_banded(self):
+        self.check(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
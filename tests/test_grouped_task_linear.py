@@ -0,0 +1,68 @@
+import unittest
+
+import torch
+
+from modules import GroupedTaskLinear
+
+NUM_ENTS_PER_TASK = [3, 1, 2]
+IN_FEATURES, HID = 8, 5
+
+
+def per_task_forward(task_layers, x, gates):
+    """ 旧实现: 每个任务一个nn.Linear作用于x * gate_t, 拼接后拆成start/end -> [2,b,e,l,h] """
+    bsz, length = x.shape[:2]
+    start_lst, end_lst = [], []
+    for tid, layer in enumerate(task_layers):
+        out = layer(x * gates[tid][None, None, :])  # [b,l,2*h*ent_t]
+        start, end = torch.chunk(out, 2, dim=-1)
+        start_lst.append(start.reshape(bsz, length, HID, -1))  # b,l,h,ent_t
+        end_lst.append(end.reshape(bsz, length, HID, -1))
+    start_hidden = torch.cat(start_lst, dim=-1).permute(0, 3, 1, 2)  # b,e,l,h
+    end_hidden = torch.cat(end_lst, dim=-1).permute(0, 3, 1, 2)
+    return torch.stack([start_hidden, end_hidden])
+
+
+class TestGroupedTaskLinear(unittest.TestCase):
+    """ 合并的GroupedTaskLinear与每个任务一个nn.Linear(旧ckpt)的输出和梯度一致 """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.task_layers = torch.nn.ModuleList([torch.nn.Linear(IN_FEATURES, 2 * HID * n) for n in NUM_ENTS_PER_TASK]).double()
+        for layer in self.task_layers:
+            torch.nn.init.normal_(layer.bias)
+        model = torch.nn.Module()  # 同SpanKL.task_layers 旧ckpt中为task_layers.{tid}.weight/bias
+        model.task_layers = GroupedTaskLinear(IN_FEATURES, NUM_ENTS_PER_TASK, HID).double()
+        model.load_state_dict({f'task_layers.{k}': v for k, v in self.task_layers.state_dict().items()})
+        self.grouped = model.task_layers
+        self.x = torch.randn(2, 7, IN_FEATURES, dtype=torch.float64)
+        self.gates = torch.rand(len(NUM_ENTS_PER_TASK), IN_FEATURES, dtype=torch.float64)
+
+    def test_old_checkpoint_outputs_and_grads(self):
+        x1, gates1 = self.x.clone().requires_grad_(), self.gates.clone().requires_grad_()
+        x2, gates2 = self.x.clone().requires_grad_(), self.gates.clone().requires_grad_()
+        expected = per_task_forward(self.task_layers, x1, gates1)
+        output = self.grouped(x2, gates2)
+        torch.testing.assert_close(output, expected)
+        grad_output = torch.randn_like(expected)
+        expected.backward(grad_output)
+        output.backward(grad_output)
+        torch.testing.assert_close(x2.grad, x1.grad)
+        torch.testing.assert_close(gates2.grad, gates1.grad)
+
+    def test_ent_ids(self):
+        output = self.grouped(self.x, self.gates)
+        torch.testing.assert_close(self.grouped(self.x, self.gates, ent_ids=slice(0, 4)), output[:, :, :4])
+        torch.testing.assert_close(self.grouped(self.x, self.gates, ent_ids=[5, 0, 3]), output[:, :, [5, 0, 3]])
+
+    def test_frozen_tasks(self):
+        self.grouped.frozen_tasks = {0, 2}
+        self.grouped(self.x, self.gates).sum().backward()
+        weight_grad = self.grouped.weight.grad.view(2, sum(NUM_ENTS_PER_TASK), HID, IN_FEATURES)
+        bias_grad = self.grouped.bias.grad.view(2, sum(NUM_ENTS_PER_TASK), HID)
+        self.assertTrue(torch.all(weight_grad[:, [0, 1, 2, 4, 5]] == 0))
+        self.assertTrue(torch.all(bias_grad[:, [0, 1, 2, 4, 5]] == 0))
+        self.assertTrue(torch.any(weight_grad[:, 3] != 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
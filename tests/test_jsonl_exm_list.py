@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from datautils import NerExample, Any2Id
+from data_reader import NerDataReader, JsonlExmList, LazyDataset
+
+ENTS = ['ORG', 'PER', 'LOC']
+
+
+class Tok:
+    def convert_tokens_to_ids(self, tokens):
+        return [5] * len(tokens)
+
+
+def build_reader():
+    reader = object.__new__(NerDataReader)
+    reader.ent2id = Any2Id(exist_dict={e: i for i, e in enumerate(ENTS)})
+    reader.tag2id = Any2Id(exist_dict={'O': 0})
+    reader.args = argparse.Namespace(pretrain_mode='fine_tuning', use_refine_mask=False)
+    reader.pad_id, reader.cls_id, reader.sep_id = 0, 101, 102
+    reader.tokenizer = Tok()
+    reader.tokenizer_path = 'tok'
+    reader.max_len = 512
+    return reader
+
+
+class TestJsonlExmListDistill(unittest.TestCase):
+    """ cache_size小于任务训练集时 蒸馏结果在多个epoch后仍保留 """
+
+    def setUp(self):
+        random.seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.jsonl_file = os.path.join(self.tmp_dir.name, 'train.jsonl')
+        with open(self.jsonl_file, 'w', encoding='U8') as f:
+            for _ in range(30):
+                n = random.randint(2, 12)
+                s = random.randint(0, n - 2)
+                obj = {'char_lst': ['w'] * n, 'ent_dct': {random.choice(ENTS): [[s, s + 2]]},
+                       'bert_tok_char_lst': ['w'] * n, 'ori_2_tok': list(range(n))}
+                f.write(json.dumps(obj) + '\n')
+        self.reader = build_reader()
+        self.reader.build_jsonl_index(self.jsonl_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build_dataset(self):
+        reader = self.reader
+        instances = JsonlExmList(self.jsonl_file, reader.jsonl_index_file(self.jsonl_file), reader,
+                                 external_attrs=['bert_tok_char_lst', 'ori_2_tok'], cache_size=8)
+        return instances, LazyDataset(instances, reader.post_process, dict(arch='span', loss_type='sigmoid'))
+
+    def check_epochs(self, dataset, teacher_logits, num_epochs=2):
+        """ use_distill训练 每个batch都要有全部样本的teacher logits """
+        batcher = self.reader.get_batcher_fn(arch='span')
+        for ep in range(num_epochs):
+            exm_ids = list(range(len(dataset)))
+            random.shuffle(exm_ids)
+            for start in range(0, len(exm_ids), 4):
+                batch_ids = exm_ids[start: start + 4]
+                batch = batcher([dataset[i] for i in batch_ids])
+                self.assertIsNotNone(batch['batch_span_tgt_distilled'])
+                np.testing.assert_array_equal(batch['batch_span_tgt_distilled'].numpy(),
+                                              np.concatenate([teacher_logits[i] for i in batch_ids]))
+
+    def test_distilled_logits_in_train_cache_survive_eviction(self):
+        instances, dataset = self.build_dataset()
+        lengths = dataset.get_lengths()
+        teacher_logits = {}
+        for idx in range(len(dataset)):  # 写入属性后马上被post_process移入train_cache 属性看起来没有被修改过
+            teacher_logits[idx] = np.random.randn(NerExample.num_spans(lengths[idx]), 2).astype('float32')
+            instances[idx].distilled_span_ner_pred_lst = teacher_logits[idx]
+            dataset[idx]
+        self.check_epochs(dataset, teacher_logits)
+        self.assertLessEqual(len(instances.lru), 8)
+
+    def test_pin_before_write_in_large_distill_batch(self):
+        instances, dataset = self.build_dataset()
+        batcher = self.reader.get_batcher_fn(arch='span')
+        lengths = dataset.get_lengths()
+        teacher_logits = {}
+        for start in range(0, len(dataset), 12):  # 蒸馏batch大于cache_size 写入前batch中靠前的样本已被淘汰
+            batch = batcher([dataset[i] for i in range(start, min(start + 12, len(dataset)))])
+            for exm_idx in batch['batch_exm_idx']:
+                teacher_logits[exm_idx] = np.random.randn(NerExample.num_spans(lengths[exm_idx]), 2).astype('float32')
+                dataset.pin_exm(exm_idx).distilled_span_ner_pred_lst = teacher_logits[exm_idx]
+        self.check_epochs(dataset, teacher_logits)
+
+    def test_unmodified_exms_are_evicted(self):
+        instances, dataset = self.build_dataset()
+        for _ in range(2):
+            for idx in range(len(dataset)):
+                dataset[idx]  # 只建立train_cache 不算修改
+        self.assertEqual(len(instances.pinned), 0)
+        self.assertEqual(len(instances.lru), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+from datautils import NerExample
+
+ENT2ID = {'ORG': 0, 'PER': 1, 'LOC': 2}
+
+
+def dense_spans(length, max_width=None):
+    """ 逐行展平的上三角(带状时只保留j-i<max_width) [(i, j)] j为闭区间 """
+    return [(i, j) for i in range(length) for j in range(i, length) if max_width is None or j - i < max_width]
+
+
+class TestSpanIndex(unittest.TestCase):
+    """ 打包/带状span下标(span_index, num_spans, span_start_end)与稠密上三角的遍历顺序一致 """
+
+    def test_span_index_matches_dense_triangle(self):
+        for length in range(1, 16):
+            for max_width in [None, 1, 2, 3, 5, length, length + 4]:
+                spans = dense_spans(length, max_width)
+                self.assertEqual(NerExample.num_spans(length, max_width), len(spans))
+                starts = np.array([i for i, _ in spans], dtype=np.int64)
+                ends = np.array([j for _, j in spans], dtype=np.int64)
+                np.testing.assert_array_equal(NerExample.span_index(starts, ends, length, max_width), np.arange(len(spans)))
+                span_starts, span_ends = NerExample.span_start_end(length, max_width)
+                np.testing.assert_array_equal(span_starts, starts)
+                np.testing.assert_array_equal(span_ends, ends)
+
+    def test_num_spans_vectorized(self):
+        lengths = np.array([1, 4, 7, 12])
+        for max_width in [None, 3]:
+            np.testing.assert_array_equal(NerExample.num_spans(lengths, max_width),
+                                          [len(dense_spans(int(length), max_width)) for length in lengths])
+
+    def test_tgt_pos_matches_dense_tgt_lst(self):
+        exm = NerExample(char_lst=list('abcdefghij'),
+                         ent_dct={'ORG': [[0, 2]], 'PER': [[3, 4], [5, 10]], 'LOC': [[7, 9]]})
+        for max_width in [None, 2, 3, 6]:
+            dense_tgt = exm.get_span_level_ner_tgt_lst(max_width=max_width)
+            self.assertEqual(len(dense_tgt), NerExample.num_spans(len(exm.char_lst), max_width))
+            expected = sorted((span_idx, ENT2ID[tag]) for span_idx, tag in enumerate(dense_tgt) if tag != 'O')
+            span_tgt_pos = exm.get_span_level_ner_tgt_pos(ENT2ID, max_width=max_width)
+            self.assertEqual(sorted(map(tuple, span_tgt_pos.tolist())), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import torch
+
+import modules
+from datautils import NerExample
+
+
+def build_model():
+    model = object.__new__(modules.SpanKL)
+    torch.nn.Module.__init__(model)
+    model.taskid2offset = {0: (0, 3), 1: (3, 5), 2: (5, 9)}
+    model.mse_loss_layer = torch.nn.MSELoss(reduction='none')
+    return model
+
+
+def per_exm_kl_loss(batch_target_lst, batch_predict_lst, ofs_s):
+    """ 旧实现: 逐样本 logsigmoid([x,-x])的KL over ent取平均 over spans求和 再按batch平均 """
+    batch_kl_loss = 0.
+    for kl_tgt, pred in zip(batch_target_lst, batch_predict_lst):
+        log_kl_pred = torch.nn.functional.logsigmoid(torch.stack([pred[:, :ofs_s], -pred[:, :ofs_s]], dim=-1))
+        log_kl_tgt = torch.nn.functional.logsigmoid(torch.stack([kl_tgt[:, :ofs_s], -kl_tgt[:, :ofs_s]], dim=-1))
+        kl_loss = torch.nn.functional.kl_div(log_kl_pred, log_kl_tgt, reduction='none', log_target=True)
+        batch_kl_loss += kl_loss.sum(-1).mean(-1).sum(-1)
+    return batch_kl_loss / len(batch_target_lst)
+
+
+def per_exm_mse_loss(batch_target_lst, batch_predict_lst, ofs_s):
+    batch_loss = 0.
+    for tgt, pred in zip(batch_target_lst, batch_predict_lst):
+        batch_loss += torch.nn.functional.mse_loss(pred[:, :ofs_s].sigmoid(), tgt[:, :ofs_s], reduction='none').mean(-1).sum(-1)
+    return batch_loss / len(batch_target_lst)
+
+
+class TestSpanKLLoss(unittest.TestCase):
+    """ packed [sum num_spans, ent]上segment sum的KL/MSE蒸馏loss 与逐样本循环的loss和梯度一致 """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = build_model()
+        self.task_id = 2
+        self.ofs_s = 5
+        self.num_spans = NerExample.num_spans(torch.tensor([6, 1, 4, 9]), 3)
+        total = int(self.num_spans.sum())
+        self.predict = torch.randn(total, 9)
+        self.target = torch.randn(total, self.ofs_s)  # 只有teacher的列
+
+    def check(self, packed_fn, ref_fn, target):
+        pred1 = self.predict.clone().requires_grad_()
+        pred2 = self.predict.clone().requires_grad_()
+        expected = ref_fn(torch.split(target, self.num_spans.tolist()), torch.split(pred1, self.num_spans.tolist()), self.ofs_s)
+        loss = packed_fn(target, pred2, self.task_id, self.num_spans)
+        torch.testing.assert_close(loss, expected)
+        expected.backward()
+        loss.backward()
+        torch.testing.assert_close(pred2.grad, pred1.grad)
+
+        # micro-batch: 各部分按整batch的bsz平均 相加等于整batch
+        span_ofs = [0] + torch.cumsum(self.num_spans, 0).tolist()
+        micro_loss = sum(packed_fn(target[span_ofs[s]: span_ofs[e]], self.predict[span_ofs[s]: span_ofs[e]], self.task_id,
+                                   self.num_spans[s: e], bsz=len(self.num_spans)) for s, e in [(0, 1), (1, 4)])
+        torch.testing.assert_close(micro_loss, expected.detach())
+
+    def test_kl_loss(self):
+        self.check(self.model.calc_kl_loss, per_exm_kl_loss, self.target)
+
+    def test_mse_loss(self):
+        self.check(self.model.calc_kl_loss_mse, per_exm_mse_loss, torch.sigmoid(self.target))
+
+
+if __name__ == '__main__':
+    unittest.main()
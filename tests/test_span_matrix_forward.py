@@ -0,0 +1,58 @@
+import math
+import unittest
+
+import torch
+
+import modules
+from datautils import NerExample
+
+
+def build_model(max_span_width=None, span_block_size=32, keep_dense_span_tensor=False):
+    model = object.__new__(modules.SpanKL)
+    torch.nn.Module.__init__(model)
+    model.max_span_width = max_span_width
+    model.span_block_size = span_block_size
+    model.keep_dense_span_tensor = keep_dense_span_tensor
+    model.use_slr = False
+    model.hidden_size_per_ent = 6
+    return model
+
+
+def naive_span_scores(output, seq_len, max_width=None):
+    """ 逐样本逐span按(b, i, j)顺序 -> [sum num_spans, ent] """
+    start_hidden, end_hidden = output[0], output[1]  # b,e,l,h
+    rows = []
+    for b, length in enumerate(seq_len.tolist()):
+        for i in range(length):
+            for j in range(i, length if max_width is None else min(length, i + max_width)):
+                rows.append((start_hidden[b, :, i] * end_hidden[b, :, j]).sum(-1) / math.sqrt(start_hidden.shape[-1]))
+    return torch.stack(rows)
+
+
+class TestSpanMatrixForward(unittest.TestCase):
+    """ 只算上三角(分block)打包的span分数 与逐span计算及稠密[b,l,l,e]再masked_select一致 """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.seq_len = torch.tensor([9, 1, 5, 13, 7])
+        self.output = torch.randn(2, 5, 4, 13, 6, dtype=torch.float64)  # [2,b,ent,l,h]
+
+    def check(self, max_span_width):
+        expected = naive_span_scores(self.output, self.seq_len, max_span_width)
+        self.assertEqual(expected.shape[0], int(NerExample.num_spans(self.seq_len, max_span_width).sum()))
+        dense = build_model(max_span_width, keep_dense_span_tensor=True).span_matrix_forward(self.output, self.seq_len)
+        torch.testing.assert_close(dense, expected)
+        for span_block_size in [1, 3, 4, 32]:
+            packed = build_model(max_span_width, span_block_size).span_matrix_forward(self.output, self.seq_len)
+            torch.testing.assert_close(packed, expected)
+
+    def test_upper_triangle(self):
+        self.check(None)
+
+    def test_banded(self):
+        for max_span_width in [1, 2, 4, 13, 20]:
+            self.check(max_span_width)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from datautils import NerExample
+from data_reader import JsonlExmList, LazyDataset, TeacherLogitStore, TeacherLogitStoreWriter
+from test_jsonl_exm_list import ENTS, build_reader
+
+
+class TestTeacherStoreReuse(unittest.TestCase):
+    """ 同一任务前缀跑两次--teacher_store: 第一次写入(miss) 第二次复用(hit) 训练看到的batch完全一致 """
+
+    def setUp(self):
+        random.seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.jsonl_file = os.path.join(self.tmp_dir.name, 'train.jsonl')
+        with open(self.jsonl_file, 'w', encoding='U8') as f:
+            for _ in range(20):
+                n = random.randint(2, 12)
+                obj = {'char_lst': ['w'] * n, 'ent_dct': {random.choice(ENTS): [[0, 1]]},
+                       'bert_tok_char_lst': ['w'] * n, 'ori_2_tok': list(range(n))}
+                f.write(json.dumps(obj) + '\n')
+        self.reader = build_reader()
+        self.reader.build_jsonl_index(self.jsonl_file)
+        self.task_exmids = list(range(0, 20, 2))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build_dataset(self):
+        reader = self.reader
+        instances = JsonlExmList(self.jsonl_file, reader.jsonl_index_file(self.jsonl_file), reader,
+                                 external_attrs=['bert_tok_char_lst', 'ori_2_tok'], cache_size=4)
+        return LazyDataset(instances, reader.post_process, dict(arch='span', loss_type='sigmoid'))
+
+    def run_task(self, store_dir, dtype):
+        """ 与spankl_ner一致: 先load 没有才写入 然后按下标读取训练batch """
+        dataset = self.build_dataset()
+        store = TeacherLogitStore.load(store_dir, len(dataset))
+        hit = store is not None
+        if not hit:
+            lengths = np.array(dataset.get_lengths())
+            num_spans = np.zeros(len(dataset), dtype=np.int64)
+            num_spans[self.task_exmids] = NerExample.num_spans(lengths[self.task_exmids])
+            writer = TeacherLogitStoreWriter(store_dir, num_spans, 2, dtype=dtype)
+            rng = np.random.RandomState(0)
+            for idx in self.task_exmids:
+                writer.write(idx, rng.randn(num_spans[idx], 2).astype('float32'))
+            store = writer.close()
+        dataset.teacher_store = store
+        batcher = self.reader.get_batcher_fn(arch='span')
+        batches = [batcher([dataset[i] for i in self.task_exmids[start: start + 3]]) for start in range(0, len(self.task_exmids), 3)]
+        return hit, [b['batch_span_tgt_distilled'].numpy() for b in batches]
+
+    def check_reuse(self, dtype):
+        store_dir = os.path.join(self.tmp_dir.name, f'store-{dtype}')
+        hit1, distilled1 = self.run_task(store_dir, dtype)
+        hit2, distilled2 = self.run_task(store_dir, dtype)
+        self.assertEqual((hit1, hit2), (False, True))
+        self.assertEqual(len(distilled1), len(distilled2))
+        for d1, d2 in zip(distilled1, distilled2):
+            np.testing.assert_array_equal(d1, d2)
+
+    def test_reuse_fp16(self):
+        self.check_reuse('fp16')
+
+    def test_reuse_int8(self):
+        self.check_reuse('int8')
+
+    def test_load_rejects_other_train_set(self):
+        store_dir = os.path.join(self.tmp_dir.name, 'store')
+        self.run_task(store_dir, 'fp16')
+        self.assertIsNone(TeacherLogitStore.load(store_dir, 21))
+        self.assertIsNone(TeacherLogitStore.load(os.path.join(self.tmp_dir.name, 'missing'), 20))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-import os, sys, copy, time, argparse, subprocess
+import os, sys, copy, time, argparse, subprocess, json, hashlib
 from pathlib import Path
 from typing import *
 from tqdm import tqdm
@@ -10,6 +10,7 @@ import logging, pprint
 import datautils as utils
 import modules
 import ner_loader
+from data_reader import TeacherLogitStore, TeacherLogitStoreWriter
 
 
 torch.set_printoptions(linewidth=4000, sci_mode=False)  # How long line breaks, not print scientific notation
@@ -40,17 +41,18 @@ def spankl_eval(model, test_dataloader, task_id, loader, info_str, mode='so_far'
     kl_loss_meaner = utils.Meaner()
     tmp_exm_lst = []
     probe_dct = {'batch_exm': []}
+    model.keep_dense_span_tensor = bool(save_prob_dct)  # 只有探针需要稠密的[b,l,l,e]
     iterator = tqdm(test_dataloader, ncols=300, dynamic_ncols=True)
     for i, inputs_dct in enumerate(iterator):  # iter steps
         seq_len = inputs_dct['ori_seq_len']
-        batch_ner_exm = inputs_dct['batch_ner_exm']
+        batch_ner_exm = list(inputs_dct['batch_ner_exm'])  # LazyExms -> 样本 每个batch只取一次
         with torch.no_grad():
             if mode == 'so_far':  # calculate performance of ent so far
                 batch_predict, f1, detail_f1, span_loss, kl_loss = model(inputs_dct, task_id, mode='test')  # 计算截至当前任务的所有实体
             if mode == 'curr':  # calculate performance of ent currently
                 batch_predict, f1, detail_f1, span_loss, kl_loss = model(inputs_dct, task_id, mode='train')  # 只要当前任务的实体
         batch_predict = batch_predict.detach()
-        batch_predict = torch.sigmoid(batch_predict).cpu()  # Not forget activate!
+        batch_predict = torch.sigmoid(batch_predict)  # Not forget activate!  留在设备上阈值化
 
         if save_prob_dct:
             for span_tensor, l, exm in zip(model.batch_span_tensor, seq_len.tolist(), batch_ner_exm):
@@ -64,24 +66,23 @@ def spankl_eval(model, test_dataloader, task_id, loader, info_str, mode='so_far'
         span_loss_meaner.add(span_loss.item())
         if kl_loss is not None:
             kl_loss_meaner.add(kl_loss.item())
-        if mode == 'curr':  # or train
-            batch_predict = torch.nn.functional.pad(batch_predict, (offset1, 0), mode='constant', value=0.0)  # 在ent维度左边补0 右边不补
+        # 整个batch packed的[sum num_spans, ent]一次阈值解码 只拷回命中的span; curr时ent维从当前任务的offset1开始
+        batch_span_pred = modules.decode_span_sigmoid(batch_predict, seq_len, max_width=model.max_span_width, ent_offset=offset1 if mode == 'curr' else 0)
 
-        batch_predict_lst = torch.split(batch_predict, (seq_len * (seq_len + 1) / 2).int().tolist())  # 根据每个batch中的样本拆开 list of [num_spans, ent] #seq_len是一个包含每个序列长度的张量，seq_len * (seq_len + 1) / 2计算的是每个序列中的span数量（这是因为一个长度为n的序列有n*(n+1)/2个span，包括单个元素的span）。然后，.int().tolist()将这个张量转换为一个整数列表。
-
-        for exm, length, pred_prob in zip(batch_ner_exm, seq_len.tolist(), batch_predict_lst):
+        for bdx, exm in enumerate(batch_ner_exm):
             # ipdb.set_trace()
             tmp_exm = copy.deepcopy(exm)
             if mode == 'so_far':
                 tmp_exm.remove_ent_by_type(so_far_task_ent, input_keep=True)
             if mode == 'curr':
                 tmp_exm.remove_ent_by_type(curr_task_ent, input_keep=True) # 保留当前任务的实体
-            tmp_exm.pred_ent_dct = utils.NerExample.from_span_level_ner_tgt_lst_sigmoid(pred_prob.numpy(), length, id2ent)  # sigmoid
+            tmp_exm.pred_ent_dct = batch_span_pred.ent_dct(bdx, id2ent)  # sigmoid
             tmp_exm_lst.append(tmp_exm)
 
         iterator.set_description(f'Task{task_id} {info_str}[{mode}] Step{i} | BS:{test_dataloader.batch_size} | '
                                  f'Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1:{f1_meaner.f1:.3f} '
                                  f'Loss:{span_loss_meaner.v:.3f} {kl_loss_meaner.v:.3f}')
+    model.keep_dense_span_tensor = False
 
     m = {}  # to store metrics
     # raw_f1 = f1_meaner.f1  # raw means use_flat_pred_ent_dct=False, i,e, not remove the overlapped
@@ -118,7 +119,7 @@ def baseline_ext_eval(model: modules.BaselineExtend, test_dataloader, task_id, l
     probe_dct = {'batch_exm': []}
     iterator = tqdm(test_dataloader, ncols=300, dynamic_ncols=True)
     for i, inputs_dct in enumerate(iterator):  # iter steps
-        batch_ner_exm = inputs_dct['batch_ner_exm']
+        batch_ner_exm = list(inputs_dct['batch_ner_exm'])  # LazyExms -> 样本 每个batch只取一次
         with torch.no_grad():
             ent_output = model.encode(inputs_dct)
         seq_len = inputs_dct['ori_seq_len']
@@ -207,7 +208,7 @@ def baseline_add_eval(model: modules.BaselineAdd, test_dataloader, task_id, load
     probe_dct = {'batch_exm': []}
     iterator = tqdm(test_dataloader, ncols=300, dynamic_ncols=True)
     for i, inputs_dct in enumerate(iterator):  # iter step
-        batch_ner_exm = inputs_dct['batch_ner_exm']
+        batch_ner_exm = list(inputs_dct['batch_ner_exm'])  # LazyExms -> 样本 每个batch只取一次
         with torch.no_grad():
             ent_output1 = model.encode(inputs_dct)
         ent_output = ent_output1.cpu().numpy()
@@ -468,23 +469,32 @@ def baseline_ner(model, loader, args, model_type, learn_mode='cl'):
                                  info=f'load prev task model: task_{task_id - 1}_model.pt. last best_dev_epo: {metrics["task_best_dev_epo"][task_id - 1]}')
 
         # 如果学习模式为'cl'，并且启用了蒸馏，并且任务ID大于0，对上一个任务的模型进行评估，并从中蒸馏知识
+        loader.train_dataset.teacher_store = None  # 上一个任务的teacher logits不再使用
         if learn_mode == 'cl' and args.use_distill and task_id > 0:
             last_task_id = task_id - 1
             model.eval()
-            # distill Train set
-            iterator = tqdm(train_dataloader, dynamic_ncols=True)
+            ofs, ofe = model.task_offset_lst[last_task_id]  # offset of current task 当前任务的offset
+            distill_dataloader = train_dataloader
+            teacher_store, store_writer = None, None
+            if args.teacher_store:  # 每个任务的token logits写入一次mmap的fp16/int8 store 已有则直接复用
+                train_dataset = loader.train_dataset
+                store_dir, store_key = teacher_store_dir(args, loader, task_id)
+                teacher_store = TeacherLogitStore.load(store_dir, len(train_dataset))
+                if teacher_store is not None:
+                    logger.info(f'Task{task_id} reuse teacher logits from {store_dir}')
+                else:
+                    task_exmids = sorted(loader.train_tid2exmids[task_id])
+                    num_toks = np.zeros(len(train_dataset), dtype=np.int64)
+                    num_toks[task_exmids] = np.array(train_dataset.get_lengths())[task_exmids]
+                    store_writer = TeacherLogitStoreWriter(store_dir, num_toks, ofe, dtype=args.teacher_store_dtype, meta=dict(key=store_key))
+                    distill_dataloader = loader.build_dataloader(train_dataset, task_exmids, loader.test_bsz)  # 顺序读取 不消耗task_train_generator
             [delattr(exm, 'distilled_task_ent_output') for exm in train_dataloader.dataset.instances if hasattr(exm, 'distilled_task_ent_output')] # clear previous distill result
-            for i, inputs_dct in enumerate(iterator):  # iter step
-                seq_len = inputs_dct['ori_seq_len']
-                batch_ner_exm = inputs_dct['batch_ner_exm']
-                ent_output = model.encode(inputs_dct)
-                ofs, ofe = model.task_offset_lst[last_task_id]  # offset of current task 当前任务的offset
-                task_ent_output = ent_output[:, :, :ofe]  # [batch, seq_len, ent]
-                task_ent_output = task_ent_output.cpu().detach().numpy()  # [b,l,ent]
-
-                for exm, out, length in zip(batch_ner_exm, task_ent_output, seq_len): 
-                    exm.distilled_task_ent_output = out[:length, :]  # [l,ent]
-                iterator.set_description(f'Task{task_id} Distilling Train set Step{i}')
+            if teacher_store is None:
+                baseline_distill_train_set(model, distill_dataloader, task_id, loader, ofe, store_writer)
+                if store_writer is not None:
+                    teacher_store = store_writer.close()
+            if teacher_store is not None:
+                loader.train_dataset.teacher_store = teacher_store  # 训练时LazyDataset按下标读取 collate时才拼成batch
 
         # 初始化最佳开发集F1分数
         if args.use_best_dev:
@@ -492,7 +502,8 @@ def baseline_ner(model, loader, args, model_type, learn_mode='cl'):
 
         # 初始化优化器和学习率
         model.init_opt()
-        model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step)
+        model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step,
+                       num_training_steps=ner_loader.calc_num_training_steps(train_dataloader, args.num_epochs))
 
         step_in_task = 0
         # 遍历每个训练周期
@@ -507,6 +518,8 @@ def baseline_ner(model, loader, args, model_type, learn_mode='cl'):
             for i, inputs_dct in enumerate(iterator):
                 # 计算任务步骤
                 step_in_task += 1
+                if args.report_grad_checkpoint and step_in_task == 1:  # 每个任务的第一个batch上打印grad_checkpoint省下的显存和多花的时间
+                    model.report_grad_checkpoint(lambda: model.runloss(inputs_dct, task_id, step=False) if learn_mode == 'cl' else model.run_loss_non_cl(inputs_dct, task_id, step=False))
                 # 根据学习模式计算损失
                 if learn_mode == 'cl':
                     loss, ce_loss, kl_loss = model.runloss(inputs_dct, task_id)
@@ -516,7 +529,7 @@ def baseline_ner(model, loader, args, model_type, learn_mode='cl'):
                 iterator.set_description(
                     f'Task{task_id} Train Ep {ep}/{args.num_epochs} Step{i} | '
                     f'Loss:{loss:.3f} {ce_loss:.3f} {kl_loss:.3f} | '
-                    f'BS:{train_dataloader.batch_size} LR:{model.curr_lr:.6f} '
+                    f'BS:{len(inputs_dct["batch_ner_exm"])} LR:{model.curr_lr:.6f} '
                     f'gnorm:{model.total_norm:.3f} gclip:{model.grad_clip}'
                 )
             # 保存参数到json文件
@@ -572,6 +585,82 @@ def baseline_ner(model, loader, args, model_type, learn_mode='cl'):
     return None
 
 
+TEACHER_STORE_KEY_ARGS = ['corpus', 'setup', 'seed', 'm', 'pretrain_mode', 'bert_model_dir', 'enc_dropout', 'batch_size', 'bucket_batch',
+                          'span_budget', 'max_span_width', 'amp', 'num_epochs', 'bert_lr', 'lr', 'warmup_step', 'use_distill', 'use_best_dev',
+                          'quick_test', 'use_task_embed', 'use_gumbel_softmax', 'teacher_store_dtype',
+                          'grad_checkpoint', 'micro_batch_budget']
+
+
+def teacher_store_dir(args, loader, task_id):
+    """
+    上一个任务模型在task_id训练集上的logits的存放目录 (--teacher_store)
+    按影响teacher的参数和前task_id+1个任务的实体区分: 之后的epoch、中断后恢复的run、前缀相同的其他permutation都可复用
+    """
+    store_key = {k: str(getattr(args, k, None)) for k in TEACHER_STORE_KEY_ARGS}
+    store_key['task_prefix'] = loader.entity_task_lst[:task_id + 1]
+    digest = hashlib.md5(json.dumps(store_key, sort_keys=True).encode()).hexdigest()[:16]
+    return Path(args.teacher_store) / f'{args.corpus}-task{task_id}-{digest}', store_key
+
+
+
+def baseline_distill_train_set(model, distill_dataloader, task_id, loader, ofe, store_writer=None):
+    """
+    上一个任务模型的token logits [l, :ofe] 写入store_writer 或训练集样本的distilled_task_ent_output属性
+    只有跑这一遍时才调用 复用已有store时跳过 所以之后的代码不能依赖这里的局部变量
+    """
+    iterator = tqdm(distill_dataloader, dynamic_ncols=True)
+    for i, inputs_dct in enumerate(iterator):  # iter step
+        seq_len = inputs_dct['ori_seq_len']
+        with torch.no_grad():
+            ent_output = model.encode(inputs_dct)
+        task_ent_output = ent_output[:, :, :ofe]  # [batch, seq_len, ent]
+        task_ent_output = task_ent_output.cpu().detach().numpy()  # [b,l,ent]
+
+        for exm_idx, out, length in zip(inputs_dct['batch_exm_idx'], task_ent_output, seq_len.tolist()):
+            if store_writer is not None:
+                store_writer.write(exm_idx, out[:length, :])
+            else:
+                exm = loader.train_dataset.pin_exm(exm_idx)  # JsonlExmList中固定该样本 不写到已被LRU淘汰的副本上
+                exm.distilled_task_ent_output = out[:length, :]  # [l,ent]
+        iterator.set_description(f'Task{task_id} Distilling Train set Step{i}')
+
+
+def spankl_distill_train_set(model, distill_dataloader, task_id, loader, store_writer=None):
+    """
+    上一个任务模型的span logits [num_spans, ent] 写入store_writer 或训练集样本的distilled_span_ner_pred_lst属性
+    只有跑这一遍时才调用 复用已有store/online teacher时跳过 所以之后的代码不能依赖这里的局部变量
+    """
+    last_task_id = task_id - 1
+    f1_meaner = utils.F1_Meaner()
+    distill_start, distill_bytes = time.time(), 0
+    # 对训练数据集进行迭代
+    iterator = tqdm(distill_dataloader, dynamic_ncols=True)
+    for i, inputs_dct in enumerate(iterator):  # iter steps
+        # 删除不需要返回kl_loss的键值对
+        inputs_dct.pop('batch_span_tgt_lst_distilled')
+        # 获取原始序列长度
+        seq_len = inputs_dct['ori_seq_len']
+        with torch.no_grad():
+            # 对模型进行测试，获取预测结果、f1值、详细f1值、span_loss和kl_loss
+            batch_predict, f1, detail_f1, span_loss, kl_loss = model(inputs_dct, last_task_id, mode='test')
+        # 将预测结果从GPU转移到CPU，并从计算图中分离出来
+        batch_predict = batch_predict.detach().cpu()
+        # 将详细f1值添加到f1_meaner中
+        f1_meaner.add(*detail_f1)
+        # 根据每个batch中的样本拆开预测结果，得到一个包含[num_spans, ent]的列表
+        batch_predict_lst = torch.split(batch_predict, utils.NerExample.num_spans(seq_len, model.max_span_width).tolist())
+        distill_bytes += batch_predict.numel() * 4
+        for exm_idx, pred_logit in zip(inputs_dct['batch_exm_idx'], batch_predict_lst):
+            if store_writer is not None:
+                store_writer.write(exm_idx, pred_logit.numpy())
+            else:
+                # 将预测结果转换为numpy数组，并保存到distilled_span_ner_pred_lst属性中
+                exm = loader.train_dataset.pin_exm(exm_idx)  # JsonlExmList中固定该样本 不写到已被LRU淘汰的副本上
+                exm.distilled_span_ner_pred_lst = pred_logit.numpy()  # 添加蒸馏的预测结果，以便后续计算kl_loss
+        # 更新迭代器的描述信息
+        iterator.set_description(f'Task{task_id} Distilling Train set Step{i} | Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1: {f1_meaner.f1:.3f}')
+    logger.info(f'Task{task_id} precompute teacher pass took {time.time() - distill_start:.1f}s, {distill_bytes / 1024 ** 2:.1f}MB fp32 teacher logits')
+
 def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl'):
     """
     Perform SpanKL-based named entity recognition (NER) training and evaluation.
@@ -635,38 +724,47 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
             else:
                 model.load_model(args.curr_ckpt_dir / f'task_{task_id - 1}_model.pt',
                                  info=f'load prev task model: task_{task_id - 1}_model.pt. last best_dev_epo: {metrics["task_best_dev_epo"][task_id - 1]}')
+        loader.train_dataset.teacher_store = None  # 上一个任务的teacher logits不再使用
+        model.teacher = None  # 上一个任务的online teacher不再使用
         # 如果学习模式为'cl'，并且启用了蒸馏，并且任务id大于0，对上一个任务的模型进行评估，并从中蒸馏知识
         if learn_mode == 'cl' and args.use_distill and task_id > 0:
-            # 初始化F1_Meaner对象
-            f1_meaner = utils.F1_Meaner()
             # 获取上一个任务的id
             last_task_id = task_id - 1
             # 将模型设置为评估模式
             model.eval()
-            # 对训练数据集进行迭代
-            iterator = tqdm(train_dataloader, dynamic_ncols=True)
-            for i, inputs_dct in enumerate(iterator):  # iter steps
-                # 删除不需要返回kl_loss的键值对
-                inputs_dct.pop('batch_span_tgt_lst_distilled')
-                # 获取原始序列长度
-                seq_len = inputs_dct['ori_seq_len']
-                with torch.no_grad():
-                    # 对模型进行测试，获取预测结果、f1值、详细f1值、span_loss和kl_loss
-                    batch_predict, f1, detail_f1, span_loss, kl_loss = model(inputs_dct, last_task_id, mode='test')
-                # 将预测结果从GPU转移到CPU，并从计算图中分离出来
-                batch_predict = batch_predict.detach().cpu()
-                # 将详细f1值添加到f1_meaner中
-                f1_meaner.add(*detail_f1)
-                # 根据每个batch中的样本拆开预测结果，得到一个包含[num_spans, ent]的列表
-                batch_predict_lst = torch.split(batch_predict, (seq_len * (seq_len + 1) / 2).int().tolist()) # 等差数列的和，目的是得到一个包含每个样本的span数量的列表，列表的每个元素是从1到seq_len的整数
-                for exm, pred_logit in zip(inputs_dct['batch_ner_exm'], batch_predict_lst):
-                    # 将预测结果转换为numpy数组，并保存到distilled_span_ner_pred_lst属性中
-                    exm.distilled_span_ner_pred_lst = pred_logit.numpy() # 添加蒸馏的预测结果，以便后续计算kl_loss
-                # 更新迭代器的描述信息
-                iterator.set_description(f'Task{task_id} Distilling Train set Step{i} | Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1: {f1_meaner.f1:.3f}')
+            distill_dataloader = train_dataloader
+            teacher_store, store_writer = None, None
+            if args.online_teacher:  # 不预先跑一遍训练集 冻结的teacher在observe中对每个batch现算
+                teacher = model.init_online_teacher(args.teacher_dtype)
+                teacher_mb = sum(p.numel() * p.element_size() for p in teacher.parameters()) / 1024 ** 2
+                task_lengths = np.array(loader.train_dataset.get_lengths())[sorted(loader.train_tid2exmids[task_id])]
+                precompute_mb = utils.NerExample.num_spans(task_lengths, model.max_span_width).sum() * model.compute_offsets(task_id)[0] * 4 / 1024 ** 2
+                logger.info(f'Task{task_id} online teacher ({args.teacher_dtype}) holds {teacher_mb:.1f}MB on {args.device}, '
+                            f'precompute path would hold {precompute_mb:.1f}MB fp32 teacher logits for {len(task_lengths)} train exms')
+            elif args.teacher_store:  # teacher logits写入mmap的store 已有则直接复用
+                train_dataset = loader.train_dataset
+                store_dir, store_key = teacher_store_dir(args, loader, task_id)
+                teacher_store = TeacherLogitStore.load(store_dir, len(train_dataset))
+                if teacher_store is not None:
+                    logger.info(f'Task{task_id} reuse teacher logits from {store_dir}')
+                else:
+                    task_exmids = sorted(loader.train_tid2exmids[task_id])
+                    num_spans = np.zeros(len(train_dataset), dtype=np.int64)
+                    num_spans[task_exmids] = utils.NerExample.num_spans(np.array(train_dataset.get_lengths())[task_exmids], model.max_span_width)
+                    store_writer = TeacherLogitStoreWriter(store_dir, num_spans, model.compute_offsets(last_task_id, mode='test')[1],
+                                                           dtype=args.teacher_store_dtype, meta=dict(key=store_key))
+                    distill_dataloader = loader.build_dataloader(train_dataset, task_exmids, loader.test_bsz)  # 顺序读取 不消耗task_train_generator
+            if teacher_store is None and not args.online_teacher:
+                spankl_distill_train_set(model, distill_dataloader, task_id, loader, store_writer)
+                if store_writer is not None:
+                    teacher_store = store_writer.close()
+            if teacher_store is not None:
+                loader.train_dataset.teacher_store = teacher_store  # 训练时LazyDataset按下标读取 各epoch共用
 
             # 如果设置了对开发集进行蒸馏
             if args.distill_dev:
+                # 初始化F1_Meaner对象
+                f1_meaner = utils.F1_Meaner()
                 # 对开发数据集进行迭代
                 iterator = tqdm(dev_dataloader, dynamic_ncols=True)
                 # 获取当前任务的实体列表
@@ -684,8 +782,10 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
                     # 将详细f1值添加到f1_meaner中
                     f1_meaner.add(*detail_f1)
                     # 根据每个batch中的样本拆开预测结果，得到一个包含[num_spans, ent]的列表
-                    for exm, length, pred in zip(inputs_dct['batch_ner_exm'], seq_len.tolist(), batch_predict_lst):
-                        exm.pred_ent_dct = utils.NerExample.from_span_level_ner_tgt_lst_sigmoid(torch.sigmoid(pred).numpy(), length, id2ent, threshold=0.5)  # sigmoid
+                    dev_predict_lst = torch.split(batch_predict, utils.NerExample.num_spans(seq_len, model.max_span_width).tolist())
+                    for exm_idx, length, pred in zip(inputs_dct['batch_exm_idx'], seq_len.tolist(), dev_predict_lst):
+                        exm = loader.dev_dataset.pin_exm(exm_idx)  # 写在主进程的样本上 不是collate出来的副本
+                        exm.pred_ent_dct = utils.NerExample.from_span_level_ner_tgt_lst_sigmoid(torch.sigmoid(pred).numpy(), length, id2ent, threshold=0.5, max_width=model.max_span_width)  # sigmoid
                         flat_pred_ent_dct = exm.get_flat_pred_ent_dct()
                         delattr(exm, 'pred_ent_dct')
                         if not hasattr(exm, 'ori_ent_dct'):
@@ -693,9 +793,8 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
                         exm.ent_dct = {ent: v for ent, v in exm.ori_ent_dct.items() if ent in curr_task_ent}  # curr task ents
                         exm.ent_dct.update(flat_pred_ent_dct)  # last task so far ents
 
-                    for exm, pred_logit in zip(inputs_dct['batch_ner_exm'], batch_predict_lst):
                         # pred_prob = torch.sigmoid(pred)  # prob
-                        exm.distilled_span_ner_pred_lst = pred_logit.numpy()  # [*,ent]  # ent learned so far the previous task 截至到当前任务的实体
+                        exm.distilled_span_ner_pred_lst = pred.numpy()  # [*,ent]  # ent learned so far the previous task 截至到当前任务的实体
                     iterator.set_description(f'Task{task_id} Distilling Dev   set| Step{i} | Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1: {f1_meaner.f1:.3f}')
 
         # 如果使用最佳开发集，初始化最佳开发集的F1值为-1
@@ -704,7 +803,8 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
         # 初始化模型的优化器
         model.init_opt()
         # 初始化学习率调度器，设置每个epoch的步数、总的epoch数和预热步数
-        model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step)
+        model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step,
+                       num_training_steps=ner_loader.calc_num_training_steps(train_dataloader, args.num_epochs))
 
         # 初始化任务中的步数为0
         step_in_task = 0
@@ -720,9 +820,13 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
             logger.info(utils.header_format(f'task {task_id} train epo {ep}', sep='='))
             # 对训练数据集进行迭代
             iterator = tqdm(train_dataloader, ncols=300, dynamic_ncols=True)
+            epo_start, epo_num_exm, model.teacher_time = time.time(), 0, 0.
             for i, inputs_dct in enumerate(iterator):  # iter steps
                 # 任务中的步数加1
                 step_in_task += 1
+                epo_num_exm += len(inputs_dct['batch_ner_exm'])
+                if args.report_grad_checkpoint and step_in_task == 1:  # 每个任务的第一个batch上打印grad_checkpoint省下的显存和多花的时间
+                    model.report_grad_checkpoint(lambda: model.observe(inputs_dct, task_id, None, step=False) if learn_mode == 'cl' else model.observe_non_cl(inputs_dct, task_id, None, step=False))
                 # 如果学习模式为'cl'，调用模型的observe方法，获取loss、span_loss、sparse_loss和kl_loss
                 if learn_mode == 'cl':
                     loss, span_loss, sparse_loss, kl_loss = model.observe(inputs_dct, task_id, f1_meaner)
@@ -736,10 +840,16 @@ def spankl_ner(model: modules.SpanKL, loader: ner_loader, args, learn_mode='cl')
                     f'Task{task_id} Train Ep {ep}/{args.num_epochs} Step{i} | '
                     f'Loss:{loss:.3f} ({span_loss:.3f} {sparse_loss:.3f} {kl_loss:.3f} {float(model.entropy_loss):.3f}) | '
                     f'Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1:{f1_meaner.f1:.3f} | '
-                    f'BS:{train_dataloader.batch_size} LR:{model.curr_lr:.6f} '
+                    f'BS:{len(inputs_dct["batch_ner_exm"])} LR:{model.curr_lr:.6f} '
                     f'gnorm:{model.total_norm:.3f} gclip:{model.grad_clip} '
                     f'OpenGate:{opengate}'
                 )
+            epo_time = time.time() - epo_start
+            if model.teacher is not None:  # 与precompute path的teacher pass耗时对比
+                logger.info(f'Task{task_id} Ep{ep} train {epo_num_exm / epo_time:.1f} exm/s, '
+                            f'online teacher forward {model.teacher_time:.1f}s/{epo_time:.1f}s ({model.teacher_time / epo_time:.1%})')
+            else:
+                logger.info(f'Task{task_id} Ep{ep} train {epo_num_exm / epo_time:.1f} exm/s')
             # 评估模型
             utils.save_args_to_json_file(args, f'{args.curr_ckpt_dir}/args.json')
             if args.use_best_dev:
@@ -850,7 +960,8 @@ def spankl_ner_all_tasks(model: modules.SpanKL, loader: ner_loader, args):
 
     # 初始化模型的优化器和学习率
     model.init_opt()
-    model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step)
+    model.init_lrs(num_step_per_epo=len(train_dataloader), epo=args.num_epochs, num_warmup_steps=args.warmup_step,
+                   num_training_steps=ner_loader.calc_num_training_steps(train_dataloader, args.num_epochs))
 
     # 对每个epoch进行迭代
     for ep in range(args.num_epochs):
@@ -872,7 +983,7 @@ def spankl_ner_all_tasks(model: modules.SpanKL, loader: ner_loader, args):
                 f'Loss:{loss:.3f} ({span_loss:.3f} {sparse_loss:.3f} {kl_loss:.3f}) | '
                 f'Prec:{f1_meaner.prec:.3f} Rec:{f1_meaner.rec:.3f} F1:{f1_meaner.f1:.3f} | '
                 f'LR:{model.curr_lr:.6f} gnorm:{model.total_norm:.3f} |'
-                f'BS:{train_dataloader.batch_size} gclip:{model.grad_clip}'
+                f'BS:{len(inputs_dct["batch_ner_exm"])} gclip:{model.grad_clip}'
             )
         # 保存参数到json文件
         utils.save_args_to_json_file(args, f'{args.curr_ckpt_dir}/args.json')
@@ -957,7 +1068,11 @@ def train_main(args):
 
     # 初始化数据加载器的数据
     loader.init_data(bsz=args.batch_size, quick_test=args.quick_test, arch=arch,
-                     use_pt=args.pretrain_mode == 'feature_based', gpu=args.use_gpu) 
+                     use_pt=args.pretrain_mode == 'feature_based', gpu=args.use_gpu,
+                     bucket_batch=args.bucket_batch, span_budget=args.span_budget,
+                     num_workers=args.num_workers, prefetch_factor=args.prefetch_factor, use_exm_cache=args.exm_cache,
+                     tokenize_num_proc=args.tokenize_num_proc, lazy_jsonl=args.lazy_jsonl, lazy_cache_size=args.lazy_cache_size,
+                     max_span_width=args.max_span_width)
 
     # 根据参数设置，对任务顺序进行排列
     if args.perm == 'perm0':
@@ -1046,7 +1161,12 @@ def eval_ckpt(args, existed_model_ckpt_dir, save_res_in_new=False):
     arch = 'span' if model_type == 'spankl' else 'seq'
 
     loader.init_data(bsz=args.batch_size, quick_test=args.quick_test, arch=arch,
-                     use_pt=args.pretrain_mode == 'feature_based', gpu=args.use_gpu)
+                     use_pt=args.pretrain_mode == 'feature_based', gpu=args.use_gpu,
+                     bucket_batch=getattr(args, 'bucket_batch', False),  # old ckpt args.json may not have it
+                     num_workers=getattr(args, 'num_workers', 0), prefetch_factor=getattr(args, 'prefetch_factor', 2),
+                     use_exm_cache=getattr(args, 'exm_cache', False), tokenize_num_proc=getattr(args, 'tokenize_num_proc', 0),
+                     lazy_jsonl=getattr(args, 'lazy_jsonl', False), lazy_cache_size=getattr(args, 'lazy_cache_size', 10000),
+                     max_span_width=getattr(args, 'max_span_width', None))
 
     # load model
     model = {
@@ -1173,6 +1293,20 @@ if __name__ == "__main__":
         48
     ][2], type=int)
 
+    parser.add_argument('--bucket_batch', default=False, type=utils.str2bool)  # batch examples of similar length to reduce padding
+    parser.add_argument('--exm_cache', default=False, type=utils.str2bool)  # compile *.jsonl into mmap arrays at the first run, then load from them
+    parser.add_argument('--lazy_jsonl', default=False, type=utils.str2bool)  # read examples on demand by a line offset index, for large corpora
+    parser.add_argument('--lazy_cache_size', default=10000, type=int)  # LRU size of parsed examples when lazy_jsonl
+    parser.add_argument('--tokenize_num_proc', default=0, type=int)  # parse jsonl and bert tokenize examples in a process pool
+    parser.add_argument('--num_workers', default=0, type=int)  # DataLoader workers for collate, batches are moved to gpu in the main process
+    parser.add_argument('--prefetch_factor', default=2, type=int)  # batches prefetched per worker
+    parser.add_argument('--span_budget', default=None, type=int)  # train batch by b*len*(len+1)/2*num_ents <= span_budget instead of batch_size, e.g. 2000000
+    parser.add_argument('--max_span_width', default=None, type=int)  # only score spans of width <= max_span_width (banded, O(len*width)), e.g. 15
+    parser.add_argument('--amp', default='off', choices=['off', 'bf16', 'fp16'], type=str)  # autocast encoder and span heads, losses stay fp32; fp16 uses GradScaler (cuda only)
+    parser.add_argument('--grad_checkpoint', default=False, type=utils.str2bool)  # recompute bert layer activations (and spankl task layer + span scores) in backward
+    parser.add_argument('--report_grad_checkpoint', default=False, type=utils.str2bool)  # log peak memory / time of fwd+bwd with grad_checkpoint off vs on on the first batch of each task, rng states are restored afterwards
+    parser.add_argument('--micro_batch_budget', default=None, type=int)  # split each batch into micro-batches (spankl: b*num_spans*num_ents, baselines: b*len tokens) and accumulate grads, the effective batch size is unchanged
+
     parser.add_argument('--non_cl', default=False, type=utils.str2bool)  # use non-CL-complete or not
     parser.add_argument('--setup', default='split', choices=['split', 'filter'], type=str)  # Synthetic Setup of Training Set
 
@@ -1185,6 +1319,10 @@ if __name__ == "__main__":
     parser.add_argument('--use_best_dev', default=True, type=utils.str2bool)
     parser.add_argument('--also_Test_Filter', default=False, type=utils.str2bool)
     parser.add_argument('--quick_test', default=False, action='store_true', help='use a partial data for quick verification of the code')
+    parser.add_argument('--teacher_store', default=None, type=Path)  # spankl/baselines: write teacher logits of each task into mmap stores under this dir, reused by later epochs, resumed runs and permutations sharing the task prefix
+    parser.add_argument('--teacher_store_dtype', default='fp16', choices=['fp16', 'int8'], type=str)  # int8 with a fp16 scale per span
+    parser.add_argument('--online_teacher', default=False, type=utils.str2bool)  # spankl: keep a frozen copy of the last task model on device and compute teacher logits per batch in observe, no precompute pass over the train set
+    parser.add_argument('--teacher_dtype', default='fp32', choices=['fp32', 'bf16', 'fp16'], type=str)  # weight precision of the online teacher
     parser.add_argument('--distill_dev', default=False, type=utils.str2bool)  # try to also distill Dev set to imporve the measure accuracy, not boost much, not use in published paper.
 
     # Below params is not applicable for this published paper, as experimental setup during research.